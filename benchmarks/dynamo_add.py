@@ -0,0 +1,58 @@
+"""Measure sustained DynamoLedger.add throughput to a single package.
+
+Requires a local DynamoDB stand-in such as DynamoDB Local or moto_server:
+
+    java -Djava.library.path=DynamoDBLocal_lib -jar DynamoDBLocal.jar -inMemory
+    python benchmarks/dynamo_add.py --endpoint http://localhost:8000 --writers 32
+"""
+
+from __future__ import print_function
+
+import argparse
+import threading
+import time
+import uuid
+
+from sacker.ledgers.dynamo import DynamoLedger
+
+
+def writer(ledger, package_name, deadline, versions, errors):
+  while time.time() < deadline:
+    try:
+      versions.append(ledger.add(package_name, 'blob', '0' * 64, 0o644))
+    except ledger.Error:
+      errors.append(1)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--endpoint', default='http://localhost:8000')
+  parser.add_argument('--region', default='us-east-1')
+  parser.add_argument('--writers', type=int, default=32)
+  parser.add_argument('--duration', type=float, default=10.0)
+  args = parser.parse_args()
+
+  table = 'sacker-bench-%s' % uuid.uuid4().hex[:8]
+  DynamoLedger(args.region, table, endpoint_url=args.endpoint).init()
+
+  versions, errors = [], []
+  deadline = time.time() + args.duration
+  # boto3 resources are not thread-safe, so each writer gets its own ledger.
+  threads = [
+      threading.Thread(
+          target=writer,
+          args=(DynamoLedger(args.region, table, endpoint_url=args.endpoint), 'bench', deadline,
+                versions, errors))
+      for _ in range(args.writers)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  assert len(set(versions)) == len(versions), 'duplicate versions allocated'
+  print('%d writers: %d adds in %.1fs (%.1f adds/sec), %d failed' % (
+      args.writers, len(versions), args.duration, len(versions) / args.duration, len(errors)))
+
+
+if __name__ == '__main__':
+  main()
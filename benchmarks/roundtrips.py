@@ -0,0 +1,86 @@
+"""Count backend round trips of sacker commands and time them under simulated latency.
+
+Runs a sequence of CLI commands against the memory:// ledger and store, once
+per latency, and reports the number of ledger and store round trips and the
+wall-clock time of each command.
+
+    python benchmarks/roundtrips.py [latency_ms ...]
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from sacker.bin import sacker as cli
+from sacker.cache import LocalCache
+from sacker.ledger import parse_ledger
+from sacker.ledgers.memory import MemoryLedger
+from sacker.store import parse_store
+from sacker.stores.memory import MemoryStore
+
+
+VERSIONS = 20
+COMMANDS = [
+    ['info', 'bench', 'latest'],
+    ['versions', 'bench'],
+    ['tag', 'bench', '10', 'live'],
+    ['info', 'bench', 'live'],
+    ['download', 'bench', 'live', '-o', 'bench.out'],
+    ['download', 'bench', 'latest', '-o', 'bench.out', '--delta'],
+    ['tags', 'bench'],
+    ['prune', 'bench', '--keep-last', '5', '--dry-run'],
+]
+
+
+def run(argv, ledger, store, cache):
+  args = cli.setup_argparser().parse_args(argv)
+  args.ledger, args.store, args.cache = ledger, store, cache
+  with open(os.devnull, 'w') as devnull:
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+      args.func(ledger, store, args)
+    finally:
+      sys.stdout = stdout
+
+
+def main(latencies=(0, 5, 100)):
+  cli.register_all()
+  workdir = tempfile.mkdtemp()
+  cwd = os.getcwd()
+  os.chdir(workdir)
+  try:
+    for latency in latencies:
+      MemoryLedger.reset_all()
+      MemoryStore.reset_all()
+      query = '?latency=%s&jitter=%s' % (latency, latency / 10.0)
+      ledger = parse_ledger('memory://bench' + query)
+      store = parse_store('memory://bench' + query)
+      cache = LocalCache(os.path.join(workdir, 'cache-%s' % latency))
+
+      for version in range(VERSIONS):
+        with open('bench.bin', 'wb') as fp:
+          fp.write(os.urandom(64 * 1024))
+        run(['add', 'bench', 'bench.bin'], ledger, store, cache)
+
+      print('latency %sms' % latency)
+      print('  %-50s %8s %8s %10s' % ('command', 'ledger', 'store', 'elapsed'))
+      for argv in COMMANDS:
+        ledger.simulator.reset()
+        store.simulator.reset()
+        start = time.time()
+        run(argv, ledger, store, cache)
+        elapsed = time.time() - start
+        print('  %-50s %8d %8d %8.1fms' % (
+            ' '.join(argv), ledger.simulator.round_trips, store.simulator.round_trips,
+            1000 * elapsed))
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+  main(map(float, sys.argv[1:]) or (0, 5, 100))
@@ -0,0 +1,90 @@
+"""Measure sacker CLI startup time.
+
+Runs `sacker --help` in fresh interpreters, both as shipped with backends and
+command implementations imported lazily and with all of them imported eagerly
+up front as sacker used to, and reports the median wall-clock time of each and
+whether boto3 and sqlite3 were imported along the way.
+
+    python benchmarks/startup.py [iterations]
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+
+HELP_SCRIPT = '''
+import sys
+%s
+from sacker.bin.sacker import main
+sys.argv = ['sacker', '--help']
+try:
+  main()
+except SystemExit:
+  pass
+sys.stderr.write('boto3 imported: %%s, sqlite3 imported: %%s' %% (
+    'boto3' in sys.modules, 'sqlite3' in sys.modules))
+'''
+
+# the imports sacker made on startup before backends were registered lazily and commands
+# imported their implementations when run.
+EAGER_IMPORTS = '''
+import multiprocessing.pool
+import sacker.archive
+import sacker.cache
+import sacker.delta
+import sacker.hashcache
+import sacker.ledgers.dynamo
+import sacker.ledgers.s3
+import sacker.stores.s3
+'''
+
+MODES = [
+    ('lazy', HELP_SCRIPT % ''),
+    ('eager', HELP_SCRIPT % EAGER_IMPORTS),
+]
+
+
+def time_invocation(script):
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+      os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env.get('PYTHONPATH')]))
+  start = time.time()
+  process = subprocess.Popen(
+      [sys.executable, '-c', script], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  _, stderr = process.communicate()
+  return time.time() - start, stderr.decode('utf-8').strip()
+
+
+def median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+
+def main(iterations=20):
+  timings = dict((name, []) for name, _ in MODES)
+  reports = {}
+  baseline = []
+  # modes are interleaved so that drift in machine load affects them equally.
+  for _ in range(iterations):
+    baseline.append(time_invocation('pass')[0])
+    for name, script in MODES:
+      elapsed, reports[name] = time_invocation(script)
+      timings[name].append(elapsed)
+
+  print('%d runs each' % iterations)
+  print('%-24s median %6.1fms' % ('interpreter startup:', 1000 * median(baseline)))
+  for name, _ in MODES:
+    print('%-24s median %6.1fms, min %6.1fms  (%s)' % (
+        'sacker --help (%s):' % name, 1000 * median(timings[name]), 1000 * min(timings[name]),
+        reports[name]))
+  saved = median(timings['eager']) - median(timings['lazy'])
+  print('%-24s median %6.1fms (%.0f%%)' % (
+      'lazy imports save:', 1000 * saved, 100 * saved / median(timings['eager'])))
+
+
+if __name__ == '__main__':
+  main(*map(int, sys.argv[1:]))
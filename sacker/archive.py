@@ -0,0 +1,104 @@
+"""Member indexes for archived packages.
+
+An index maps each member of an uncompressed tar or a zip archive to the byte
+range of its data within the archive, so that a single member can be fetched
+from the store with ranged reads instead of downloading the whole blob.
+"""
+
+import json
+import os
+import struct
+import tarfile
+import zipfile
+import zlib
+
+from .util import temporary_dir
+
+
+STORED = 'stored'
+DEFLATED = 'deflated'
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+READ_SIZE = 8 * 1024 * 1024
+
+
+class ArchiveError(Exception): pass
+
+
+def index_name(sha):
+  return '%s.index' % sha
+
+
+def _tar_index(filename):
+  try:
+    tf = tarfile.open(filename, 'r:')
+  except tarfile.ReadError:
+    return None
+  with tf:
+    return dict(
+        (member.name, {'offset': member.offset_data, 'size': member.size, 'compression': STORED})
+        for member in tf.getmembers() if member.isfile())
+
+
+def _zip_index(filename):
+  if not zipfile.is_zipfile(filename):
+    return None
+  compressions = {zipfile.ZIP_STORED: STORED, zipfile.ZIP_DEFLATED: DEFLATED}
+  members = {}
+  with open(filename, 'rb') as fp:
+    for info in zipfile.ZipFile(fp).infolist():
+      if info.compress_type not in compressions or info.filename.endswith('/'):
+        continue
+      # the central directory does not record the length of the local header, so read it.
+      fp.seek(info.header_offset)
+      header = ZIP_LOCAL_HEADER.unpack(fp.read(ZIP_LOCAL_HEADER.size))
+      members[info.filename] = {
+          'offset': info.header_offset + ZIP_LOCAL_HEADER.size + header[10] + header[11],
+          'size': info.compress_size,
+          'compression': compressions[info.compress_type],
+      }
+  return members
+
+
+def build_index(filename):
+  """returns the member index of filename, or None if it is not an indexable archive."""
+  for format, indexer in (('zip', _zip_index), ('tar', _tar_index)):
+    members = indexer(filename)
+    if members is not None:
+      return {'format': format, 'members': members}
+  return None
+
+
+def publish_index(store, sha, index):
+  """upload index, as returned by build_index, as the member index of sha."""
+  with temporary_dir() as dirname:
+    index_filename = os.path.join(dirname, 'index.json')
+    with open(index_filename, 'wb') as fp:
+      json.dump(index, fp)
+    store.upload(index_name(sha), index_filename)
+
+
+def fetch_index(store, sha):
+  """returns the member index of sha, raises store.DoesNotExist"""
+  with temporary_dir() as dirname:
+    index_filename = os.path.join(dirname, 'index.json')
+    store.download(index_name(sha), index_filename)
+    with open(index_filename, 'rb') as fp:
+      return json.load(fp)
+
+
+def iter_member(store, sha, index, member_name):
+  """yields the contents of member_name using ranged reads against sha."""
+  try:
+    member = index['members'][member_name]
+  except KeyError:
+    raise ArchiveError('Archive has no member %r' % member_name)
+
+  decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if member['compression'] == DEFLATED else None
+  offset, end = member['offset'], member['offset'] + member['size']
+  while offset < end:
+    length = min(READ_SIZE, end - offset)
+    data = store.read_range(sha, offset, length)
+    offset += length
+    yield decompressor.decompress(data) if decompressor else data
+  if decompressor:
+    yield decompressor.flush()
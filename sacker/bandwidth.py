@@ -0,0 +1,192 @@
+"""Host-wide coordination of transfers.
+
+All sacker processes on a host that share a coordination directory respect a
+cap on concurrent transfers and an aggregate bandwidth limit.  Coordination only
+uses files and flock, so there is no daemon to run, and a process that dies
+releases its slot and its place in the queue along with its locks.
+
+A transfer waits for one of max_transfers slot files.  Waiting transfers queue
+by priority and then by arrival, and only the transfer at the head of the queue
+may take a free slot.  Bandwidth is shared through a token bucket kept in a
+file: transfers reserve the bytes they move, and reservations that the bucket
+cannot serve straight away queue for tokens in the same way, so that transfers
+of higher priority get the bandwidth first even when there is no cap on
+concurrent transfers.
+"""
+
+import errno
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .util import safe_mkdir, sacker_home
+
+
+PRIORITIES = ('interactive', 'normal', 'background')
+
+
+class Uncoordinated(object):
+  @contextmanager
+  def transfer(self):
+    yield None
+
+
+class TransferCoordinator(object):
+  POLL_INTERVAL = 0.05
+  # bytes transferred are reserved from the shared bucket in chunks of this size, to keep the
+  # number of bucket updates low.
+  RESERVE_SIZE = 1024 * 1024
+
+  @classmethod
+  def default(cls, **kw):
+    return cls(os.path.join(sacker_home(), 'transfers'), **kw)
+
+  def __init__(self, root, max_transfers=None, bandwidth_limit=None, priority='normal',
+               clock=time):
+    """bandwidth_limit is in bytes per second."""
+    if priority not in PRIORITIES:
+      raise ValueError('Unknown transfer priority %r' % priority)
+    self.root = root
+    self.max_transfers = max_transfers
+    self.bandwidth_limit = bandwidth_limit
+    self.priority = priority
+    self.clock = clock
+
+  @property
+  def queue_dir(self):
+    return os.path.join(self.root, 'queue')
+
+  @property
+  def bandwidth_queue_dir(self):
+    return os.path.join(self.root, 'bandwidth-queue')
+
+  def _try_lock(self, filename):
+    """returns an open file holding an exclusive lock on filename, or None if it is locked."""
+    fp = open(filename, 'a+')
+    try:
+      fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+      fp.close()
+      if e.errno in (errno.EAGAIN, errno.EACCES):
+        return None
+      raise
+    return fp
+
+  def _enqueue(self, queue_dir):
+    safe_mkdir(queue_dir)
+    ticket = '%d-%017.6f-%d-%d' % (
+        PRIORITIES.index(self.priority), time.time(), os.getpid(), threading.current_thread().ident)
+    # the ticket is locked before it is visible in the queue, or it could be taken for the ticket
+    # of a dead process and removed.
+    pending = os.path.join(self.root, '.%s' % ticket)
+    fp = self._try_lock(pending)
+    os.rename(pending, os.path.join(queue_dir, ticket))
+    return ticket, fp
+
+  def _is_head(self, queue_dir, ticket):
+    for name in sorted(os.listdir(queue_dir)):
+      if name >= ticket:
+        return True
+      fp = self._try_lock(os.path.join(queue_dir, name))
+      if fp is None:
+        return False
+      # the owner of the ticket died while waiting.
+      try:
+        os.unlink(os.path.join(queue_dir, name))
+      except OSError:
+        pass
+      fp.close()
+    return True
+
+  def _acquire_slot(self):
+    ticket, ticket_fp = self._enqueue(self.queue_dir)
+    try:
+      while True:
+        if self._is_head(self.queue_dir, ticket):
+          for slot in range(self.max_transfers):
+            fp = self._try_lock(os.path.join(self.root, 'slot-%d' % slot))
+            if fp is not None:
+              return fp
+        self.clock.sleep(self.POLL_INTERVAL)
+    finally:
+      os.unlink(os.path.join(self.queue_dir, ticket))
+      ticket_fp.close()
+
+  def _take_tokens(self, nbytes, queued):
+    """takes nbytes from the bucket if it holds them, or if it is full for reservations larger than
+    the bucket.  unless queued, tokens are only taken if no reservation is queued for them.
+    returns None if they were taken, or else the number of seconds until the bucket holds them."""
+    safe_mkdir(self.root)
+    with open(os.path.join(self.root, 'bucket'), 'a+') as fp:
+      fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+      fp.seek(0)
+      try:
+        tokens, last = map(float, fp.read().split())
+      except ValueError:
+        tokens, last = float(self.bandwidth_limit), self.clock.time()
+      now = self.clock.time()
+      # the bucket holds at most a second of bandwidth, which bounds bursts.
+      tokens = min(self.bandwidth_limit, tokens + (now - last) * self.bandwidth_limit)
+      needed = min(nbytes, self.bandwidth_limit)
+      if tokens < needed or not (queued or self._queue_is_empty(self.bandwidth_queue_dir)):
+        return max(needed - tokens, 0) / self.bandwidth_limit
+      fp.seek(0)
+      fp.truncate()
+      fp.write('%f %f' % (tokens - nbytes, now))
+      fp.flush()
+    return None
+
+  def _queue_is_empty(self, queue_dir):
+    try:
+      return not os.listdir(queue_dir)
+    except OSError:
+      return True
+
+  def reserve(self, nbytes):
+    """reserves nbytes from the host bandwidth budget, sleeping until they are available.
+    reservations wait for tokens by priority, and then by arrival."""
+    if self._take_tokens(nbytes, queued=False) is None:
+      return
+    ticket, ticket_fp = self._enqueue(self.bandwidth_queue_dir)
+    try:
+      while True:
+        if self._is_head(self.bandwidth_queue_dir, ticket):
+          wait = self._take_tokens(nbytes, queued=True)
+          if wait is None:
+            return
+        else:
+          wait = self.POLL_INTERVAL
+        self.clock.sleep(min(wait, self.POLL_INTERVAL))
+    finally:
+      os.unlink(os.path.join(self.bandwidth_queue_dir, ticket))
+      ticket_fp.close()
+
+  @contextmanager
+  def transfer(self):
+    """waits for a transfer slot and yields a callback to call with the number of bytes moved by
+    the transfer, or None if bandwidth is not limited."""
+    slot = self._acquire_slot() if self.max_transfers else None
+    try:
+      yield BandwidthMeter(self) if self.bandwidth_limit else None
+    finally:
+      if slot is not None:
+        slot.close()
+
+
+class BandwidthMeter(object):
+  """An S3Transfer callback that reserves the bytes transferred from a coordinator."""
+
+  def __init__(self, coordinator):
+    self.coordinator = coordinator
+    self._pending = 0
+    self._lock = threading.Lock()
+
+  def __call__(self, nbytes):
+    with self._lock:
+      self._pending += nbytes
+      if self._pending < self.coordinator.RESERVE_SIZE:
+        return
+      nbytes, self._pending = self._pending, 0
+    self.coordinator.reserve(nbytes)
@@ -0,0 +1,104 @@
+import json
+import shlex
+import sys
+import threading
+from contextlib import contextmanager
+from itertools import imap
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+
+class ThreadLocalStream(object):
+  """A stream that writes to a per-thread capture buffer if one is installed."""
+
+  def __init__(self, stream):
+    self._stream = stream
+    self._local = threading.local()
+
+  @contextmanager
+  def capture(self):
+    self._local.buffer = StringIO()
+    try:
+      yield self._local.buffer
+    finally:
+      self._local.buffer = None
+
+  @property
+  def _target(self):
+    return getattr(self._local, 'buffer', None) or self._stream
+
+  def write(self, data):
+    self._target.write(data)
+
+  def flush(self):
+    self._target.flush()
+
+  def __getattr__(self, name):
+    return getattr(self._stream, name)
+
+
+def parse_text_request(line):
+  return shlex.split(line)
+
+
+def parse_json_request(line):
+  request = json.loads(line)
+  return request['args'] if isinstance(request, dict) else request
+
+
+def format_text_response(rc, stdout, stderr):
+  return stdout, stderr
+
+
+def format_json_response(rc, stdout, stderr):
+  return json.dumps({'rc': rc, 'stdout': stdout, 'stderr': stderr}) + '\n', ''
+
+
+@contextmanager
+def captured_output():
+  """replaces sys.stdout and sys.stderr with streams that can be captured per thread."""
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = ThreadLocalStream(stdout), ThreadLocalStream(stderr)
+  try:
+    yield sys.stdout, sys.stderr
+  finally:
+    sys.stdout, sys.stderr = stdout, stderr
+
+
+def run_batch(requests, run, json_mode=False, concurrency=1):
+  """runs each request with run(argv), which returns an exit code, writing the output of each
+  request in request order.  returns the number of failed requests."""
+  parse = parse_json_request if json_mode else parse_text_request
+  format_response = format_json_response if json_mode else format_text_response
+
+  with captured_output() as (stdout, stderr):
+    def execute(request):
+      with stdout.capture() as out:
+        with stderr.capture() as err:
+          try:
+            rc = run(parse(request))
+          except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+              rc = e.code
+            else:
+              err.write('%s\n' % e.code)
+              rc = 1
+          except Exception as e:
+            err.write('%s\n' % e)
+            rc = 1
+      return rc or 0, out.getvalue(), err.getvalue()
+
+    pool = ThreadPool(concurrency) if concurrency > 1 else None
+    results = pool.imap(execute, requests) if pool else imap(execute, requests)
+    failures = 0
+    try:
+      for rc, out, err in results:
+        out, err = format_response(rc, out, err)
+        stdout.write(out)
+        stdout.flush()
+        stderr.write(err)
+        failures += rc != 0
+    finally:
+      if pool:
+        pool.close()
+    return failures
@@ -1,13 +1,26 @@
 from __future__ import absolute_import, print_function
 
 import argparse
+import json
 import os
+import shutil
+import stat
+import subprocess
 import sys
+import tempfile
 
+from sacker.bandwidth import PRIORITIES
 from sacker.config import Config
+from sacker.hashing import ALGORITHMS, DEFAULT_ALGORITHM
 from sacker.ledger import parse_ledger
+from sacker.package import Package
 from sacker.store import parse_store
-from sacker.util import compute_hash, die
+from sacker.util import TeeReader, die, warn
+
+
+# packages read from stdin are spooled in memory up to this size before spilling to disk.
+SPOOL_SIZE = 64 * 1024 * 1024
+STDIN_MODE = stat.S_IFREG | 0644
 
 
 def gc_command(ledger, store, delete=False):
@@ -28,7 +41,8 @@ def list_command(ledger, store, _):
 
 
 def versions_command(ledger, store, args):
-  for version in ledger.list_package_versions(args.package):
+  for version in ledger.list_package_versions(
+      args.package, start=args.since, limit=args.limit, reverse=args.reverse):
     print(version)
 
 
@@ -41,11 +55,22 @@ def info_command(ledger, store, args):
 
 # TODO(wickman) There should be a combined API object so that each consumer of the API
 # is not forced to implement the upload-to-store-if-necessary-then-register-in-ledger logic.
-# TODO(wickman) Stores should only upload if the sha does not already exist.
 def add_command(ledger, store, args):
-  with open(args.filename, 'rb') as fp:
-    sha = compute_hash(fp)
-  store.upload(sha, args.filename)
+  from sacker.archive import build_index, publish_index
+  from sacker.hashcache import hash_file
+  if args.filename == '-':
+    return add_stream(ledger, store, args)
+  # the index is built first so that nothing is uploaded for packages that cannot be indexed.
+  index = build_index(args.filename) if args.index else None
+  if args.index and index is None:
+    die('%s is not an uncompressed tar or zip archive, cannot index.' % args.filename)
+  sha = hash_file(args.filename, args.algorithm)
+  if not store.exists(sha):
+    store.upload(sha, args.filename)
+  if index is not None:
+    publish_index(store, sha, index)
+  if args.delta:
+    add_delta(ledger, store, args.cache, args.package, sha, args.filename)
   # todo(wickman) add metadata kwarg
   print(ledger.add(
       args.package,
@@ -54,17 +79,304 @@ def add_command(ledger, store, args):
       os.stat(args.filename).st_mode))
 
 
+def add_stream(ledger, store, args):
+  from sacker.hashing import hash_stream
+  if args.delta or args.index:
+    die('--delta and --index require a package filename.')
+  # the sha must be known before uploading, so the package is spooled rather than streamed.
+  with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as fp:
+    shutil.copyfileobj(getattr(sys.stdin, 'buffer', sys.stdin), fp)
+    fp.seek(0)
+    sha = hash_stream(fp, args.algorithm)
+    fp.seek(0)
+    store.put(sha, fp)
+  print(ledger.add(
+      args.package,
+      args.basename or os.path.basename(args.package),
+      sha,
+      STDIN_MODE))
+
+
+def add_delta(ledger, store, cache, package_name, sha, filename):
+  from sacker.delta import DeltaError, publish_delta
+  latest = ledger.latest(package_name)
+  if latest is not None:
+    base = ledger.info(package_name, latest)
+    try:
+      publish_delta(store, base.sha, cache.fetch(store, base.sha), sha, filename)
+    except (DeltaError, store.Error, EnvironmentError) as e:
+      # the package is still added, it can only be downloaded in full.
+      warn('Not publishing a delta for %s: %s' % (package_name, e))
+  cache.insert(sha, filename)
+
+
+def download_delta(ledger, store, cache, info, output_filename):
+  """reconstructs info from a delta against the cached previous version.  returns False if that
+  is not possible, and the package must be downloaded in full."""
+  from sacker.delta import fetch_delta
+  try:
+    base_version = ledger.previous(info.name, info.version)
+    if base_version is None:
+      return False
+    base = ledger.info(info.name, base_version)
+    if not cache.touch(base.sha):
+      return False
+    return fetch_delta(store, base.sha, cache.path(base.sha), info.sha, output_filename)
+  except Exception as e:
+    # deltas are only an optimization, so any failure falls back to a full download.
+    warn('Not using a delta for %s: %s' % (info.name, e))
+    return False
+
+
+def download_stream(store, info):
+  from sacker.hashing import verify_stream
+  stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+  try:
+    verified = verify_stream(TeeReader(store.open(info.sha), stdout), info.sha)
+  except store.DoesNotExist as e:
+    die(e)
+  stdout.flush()
+  if not verified:
+    die('Downloaded package %s appears to be corrupt.' % info.name)
+
+
 def download_command(ledger, store, args):
-  info = ledger.info(args.package, args.spec)
+  if args.lockfile:
+    packages = read_lockfile(args.lockfile)
+    if args.package:
+      packages = [package for package in packages if package.name == args.package]
+      if not packages:
+        die('Package %s is not in %s.' % (args.package, args.lockfile))
+    if len(packages) > 1 and args.output_filename:
+      die('-o can only be used to download a single package.')
+  elif args.package and args.spec:
+    packages = [ledger.info(args.package, args.spec)]
+  else:
+    die('Must specify either a package and spec or a lockfile.')
+
+  for info in packages:
+    download_package(ledger, store, args, info)
+
+
+def download_package(ledger, store, args, info):
+  from sacker.hashing import verify_file
+  if args.output_filename == '-':
+    return download_stream(store, info)
   output_filename = args.output_filename or info.basename
-  store.download(info.sha, output_filename)
+  if not (args.delta and download_delta(ledger, store, args.cache, info, output_filename) and
+          verify_file(output_filename, info.sha)):
+    store.download(info.sha, output_filename)
+    if not verify_file(output_filename, info.sha):
+      die('Downloaded package %s appears to be corrupt.' % output_filename)
+  if args.delta:
+    args.cache.insert(info.sha, output_filename)
   print(output_filename)
 
 
+def cat_command(ledger, store, args):
+  from sacker.archive import ArchiveError, fetch_index, iter_member
+  info = ledger.info(args.package, args.spec)
+  try:
+    index = fetch_index(store, info.sha)
+  except store.DoesNotExist:
+    die('Package %s version %d has no member index.' % (info.name, info.version))
+  try:
+    for chunk in iter_member(store, info.sha, index, args.member):
+      sys.stdout.write(chunk)
+  except ArchiveError as e:
+    die(e)
+
+
+def serve_command(ledger, store, args):
+  from sacker.serve import BlobServer
+  server = BlobServer(
+      (args.bind, args.port),
+      store,
+      args.cache,
+      max_cache_size=args.max_cache_size * 1024 * 1024 if args.max_cache_size else None)
+  print('Serving %s on %s:%d' % (args.cache.root, args.bind, args.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+def read_manifest(filename):
+  """returns (package_name, spec) pairs from a JSON manifest, or stdin if filename is -."""
+  if filename == '-':
+    manifest = json.load(sys.stdin)
+  else:
+    with open(filename) as fp:
+      manifest = json.load(fp)
+  return sorted(manifest.items()) if isinstance(manifest, dict) else map(tuple, manifest)
+
+
+def read_lockfile(filename):
+  with open(filename) as fp:
+    return [Package.from_dict(blob) for blob in json.load(fp)['packages']]
+
+
+def resolve_command(ledger, store, args):
+  try:
+    packages = ledger.resolve_many(read_manifest(args.manifest))
+  except ledger.DoesNotExist as e:
+    die(e)
+  json.dump({'packages': [package.to_dict() for package in packages]}, sys.stdout, indent=2,
+      separators=(',', ': '), sort_keys=True)
+  print()
+
+
+def url_command(ledger, store, args):
+  if len(args.specs) % 2:
+    die('Packages and specs must be given in pairs.')
+  specs = zip(args.specs[::2], args.specs[1::2])
+  if args.manifest:
+    specs.extend(read_manifest(args.manifest))
+  packages = read_lockfile(args.lockfile) if args.lockfile else []
+  if specs:
+    try:
+      packages.extend(ledger.resolve_many(specs))
+    except ledger.DoesNotExist as e:
+      die(e)
+  if not packages:
+    die('Must specify packages and specs, a manifest or a lockfile.')
+
+  try:
+    urls = [store.url(package.sha, expires=args.expires, check=args.check) for package in packages]
+  except NotImplementedError:
+    die('This store cannot generate URLs.')
+  except (ValueError, store.DoesNotExist) as e:
+    die(e)
+  if len(packages) == 1 and not (args.manifest or args.lockfile):
+    print(urls[0])
+  else:
+    for package, url in zip(packages, urls):
+      print('%s %d %s' % (package.name, package.version, url))
+
+
 def remove_command(ledger, store, args):
   ledger.remove(args.package, args.version)
 
 
+def watch_command(ledger, store, args):
+  from sacker.watch import TagWatcher
+
+  def on_change(package_name, tag_name, version):
+    print('%s %s %d' % (package_name, tag_name, version))
+    sys.stdout.flush()
+    if args.command:
+      env = dict(os.environ)
+      env.update(SACKER_PACKAGE=package_name, SACKER_TAG=tag_name, SACKER_VERSION=str(version))
+      subprocess.call(args.command, shell=True, env=env)
+
+  watcher = TagWatcher(ledger, min_interval=args.min_interval, max_interval=args.max_interval)
+  try:
+    watcher.watch([(args.package, args.label)] + args.watch, on_change, initial=args.initial)
+  except KeyboardInterrupt:
+    pass
+
+
+def compact_command(ledger, store, args):
+  ledger.compact(args.package)
+
+
+def prune_command(ledger, store, args):
+  from sacker.prune import RetentionPolicy, prune
+  try:
+    policy = RetentionPolicy(
+        keep_last=args.keep_last,
+        keep_newer_than=args.keep_days * 86400 if args.keep_days is not None else None,
+        keep_tagged=not args.include_tagged)
+  except ValueError as e:
+    die(e)
+
+  for package_name in args.packages or ledger.list_packages():
+    prunable, versions = prune(ledger, package_name, policy, dry_run=args.dry_run)
+    print('%s %s %d of %d versions%s' % (
+        'Would prune' if args.dry_run else 'Pruned',
+        package_name,
+        len(prunable),
+        versions,
+        ': %s' % ' '.join(map(str, prunable)) if args.dry_run and prunable else ''))
+
+
+def mirror_command(ledger, store, args):
+  import hashlib
+  import time
+  from sacker.mirror import Mirror, MirrorState
+  from sacker.util import sacker_home
+
+  state_filename = args.state or os.path.join(
+      sacker_home(), 'mirror', '%s.json' % hashlib.sha1(
+          '%s %s' % (args.to_ledger, args.to_store)).hexdigest()[:16])
+  target_store = parse_store(args.to_store)
+  coordinate(target_store, getattr(args, 'coordinator', None))
+  mirror = Mirror(
+      ledger,
+      store,
+      parse_ledger(args.to_ledger),
+      target_store,
+      MirrorState(state_filename),
+      concurrency=args.concurrency)
+
+  try:
+    while True:
+      for package_name, versions, blobs, tags in mirror.run(args.packages):
+        if versions or blobs or tags:
+          print('%s: %d versions, %d blobs, %d tags' % (package_name, versions, blobs, tags))
+          sys.stdout.flush()
+      if args.interval is None:
+        return 1 if mirror.failures else None
+      time.sleep(args.interval)
+  except KeyboardInterrupt:
+    pass
+
+
+def index_store_command(ledger, store, args):
+  count = store.build_index()
+  if count is None:
+    die('This store does not keep an existence index.')
+  print('Indexed %d blobs.' % count)
+
+
+def rekey_command(ledger, store, args):
+  if not hasattr(store, 'rekey'):
+    die('This store has a single key layout.')
+  try:
+    count = 0
+    for sha in store.rekey(delete_legacy=args.delete_legacy, concurrency=args.concurrency):
+      print(sha)
+      count += 1
+  except ValueError as e:
+    die(str(e))
+  print('Moved %d blobs.' % count)
+
+
+def snapshot_command(ledger, store, args):
+  from sacker.snapshot import SnapshotLedger
+  snapshot = SnapshotLedger.default(ledger.uri)
+  versions = snapshot.refresh(ledger, full=args.full)
+  print('Fetched %d versions into %s.' % (versions, snapshot.db_path))
+
+
+def batch_command(ledger, store, args):
+  from sacker.batch import run_batch
+  parser = setup_argparser()
+
+  def run(argv):
+    if '-' in argv:
+      die('Requests in a batch cannot use "-", since stdin holds the batch itself.')
+    request = parser.parse_args(argv)
+    if request.func is batch_command:
+      die('Batches cannot be nested.')
+    setup_defaults(request, parent=args)
+    return request.func(request.ledger, request.store, request)
+
+  requests = (line for line in sys.stdin if line.strip() and not line.startswith('#'))
+  if run_batch(requests, run, json_mode=args.json, concurrency=args.concurrency):
+    return 1
+
+
 def tag_command(ledger, store, args):
   ledger.tag(args.package, args.version, args.label)
 
@@ -78,6 +390,19 @@ def tags_command(ledger, store, args):
     print(tag)
 
 
+# commands that only read the ledger, which --snapshot serves from the local snapshot.
+SNAPSHOT_COMMANDS = frozenset([
+    list_command,
+    versions_command,
+    info_command,
+    download_command,
+    cat_command,
+    resolve_command,
+    url_command,
+    tags_command,
+])
+
+
 class LedgerAction(argparse.Action):
   def __call__(self, parser, namespace, values, option_string=None):
     setattr(namespace, self.dest, parse_ledger(values[0]))
@@ -102,6 +427,26 @@ def setup_argparser():
       action=StoreAction,
       nargs=1,
       default=None)
+  parser.add_argument(
+      '--priority',
+      help='Priority of transfers when the host limits them (see "max_transfers" and '
+           '"bandwidth_limit"), defaults to interactive for downloads, background for mirrors '
+           'and normal otherwise.',
+      choices=PRIORITIES,
+      default=None)
+  parser.add_argument(
+      '--snapshot',
+      help='Serve read-only commands (list, versions, info, download, cat, resolve, url and '
+           'tags) from the local ledger snapshot (see "sacker snapshot").  other commands always '
+           'use the ledger.',
+      action='store_true',
+      default=False)
+  parser.add_argument(
+      '--max-staleness',
+      help='Refresh the snapshot first if it is older than SECS seconds (default %(default)s).',
+      metavar='SECS',
+      type=float,
+      default=3600)
 
   subcommand_parser = parser.add_subparsers(help='subcommand help')
 
@@ -118,6 +463,12 @@ def setup_argparser():
   versions_parser = subcommand_parser.add_parser('versions', help='List package versions')
   versions_parser.set_defaults(func=versions_command)
   versions_parser.add_argument('package', help='Package name')
+  versions_parser.add_argument(
+      '--since', type=int, default=None, help='Only list versions from this version onwards.')
+  versions_parser.add_argument(
+      '--limit', type=int, default=None, help='List at most this many versions.')
+  versions_parser.add_argument(
+      '--reverse', default=False, action='store_true', help='List newest versions first.')
 
   info_parser = subcommand_parser.add_parser('info',
       help='Get information about a specific package version.')
@@ -128,14 +479,78 @@ def setup_argparser():
   add_parser = subcommand_parser.add_parser('add', help='Add a new package version.')
   add_parser.set_defaults(func=add_command)
   add_parser.add_argument('package', help='Package name')
-  add_parser.add_argument('filename', help='Package filename')
+  add_parser.add_argument('filename', help='Package filename, or - to read from stdin')
+  add_parser.add_argument(
+      '--basename', default=None,
+      help='Package basename when reading from stdin, defaults to the package name.')
+  add_parser.add_argument(
+      '--hash', dest='algorithm', default=DEFAULT_ALGORITHM, choices=sorted(ALGORITHMS),
+      help='Hash algorithm used to address the package.')
+  add_parser.add_argument(
+      '--delta', default=False, action='store_true',
+      help='Publish a binary delta against the previous version.')
+  add_parser.add_argument(
+      '--index', default=False, action='store_true',
+      help='Publish a member index of the archive for use by "sacker cat".')
 
   download_parser = subcommand_parser.add_parser('download', help='Download a package.')
-  download_parser.set_defaults(func=download_command)
-  download_parser.add_argument('package', help='Package name')
-  download_parser.add_argument('spec', help='Package version or tag')
+  download_parser.set_defaults(func=download_command, default_priority='interactive')
+  download_parser.add_argument('package', nargs='?', help='Package name')
+  download_parser.add_argument('spec', nargs='?', help='Package version or tag')
   download_parser.add_argument(
-      '-o', dest='output_filename', default=None, help='Optional destination for file.')
+      '--lockfile', default=None,
+      help='Download the packages pinned by a lockfile from "sacker resolve" without consulting '
+           'the ledger, or only the named package.')
+  download_parser.add_argument(
+      '-o', dest='output_filename', default=None,
+      help='Optional destination for file, or - to write to stdout.')
+  download_parser.add_argument(
+      '--delta', default=False, action='store_true',
+      help='Fetch a binary delta against the locally cached previous version if possible.')
+
+  cat_parser = subcommand_parser.add_parser(
+      'cat', help='Print a single member of an indexed archive package.')
+  cat_parser.set_defaults(func=cat_command)
+  cat_parser.add_argument('package', help='Package name')
+  cat_parser.add_argument('spec', help='Package version or tag')
+  cat_parser.add_argument('member', help='Archive member name')
+
+  resolve_parser = subcommand_parser.add_parser(
+      'resolve', help='Resolve a manifest of package specs into a lockfile of pinned shas.')
+  resolve_parser.set_defaults(func=resolve_command)
+  resolve_parser.add_argument(
+      'manifest',
+      help='JSON file mapping package names to versions or tags, or a list of [package, spec] '
+           'pairs.  Use - to read from stdin.')
+
+  url_parser = subcommand_parser.add_parser(
+      'url', help='Print presigned URLs from which packages can be fetched without credentials.')
+  url_parser.set_defaults(func=url_command)
+  url_parser.add_argument(
+      'specs', nargs='*', metavar='PACKAGE SPEC',
+      help='Package names and versions or tags, in pairs.')
+  url_parser.add_argument(
+      '--manifest', default=None,
+      help='Also resolve the packages of a JSON manifest as taken by "sacker resolve".')
+  url_parser.add_argument(
+      '--lockfile', default=None,
+      help='Also sign the packages pinned by a lockfile, without consulting the ledger.')
+  url_parser.add_argument(
+      '--expires', type=int, default=3600, metavar='SECS',
+      help='Number of seconds for which the URLs are valid.')
+  url_parser.add_argument(
+      '--check', default=False, action='store_true',
+      help='Check that each package exists before signing its URL, at the cost of a request per '
+           'package.  Needed for sharded stores with blobs that have not been rekeyed.')
+
+  serve_parser = subcommand_parser.add_parser(
+      'serve', help='Serve blobs over HTTP from a local cache filled from the store.')
+  serve_parser.set_defaults(func=serve_command)
+  serve_parser.add_argument('--bind', default='0.0.0.0', help='Address to listen on.')
+  serve_parser.add_argument('--port', type=int, default=8080, help='Port to listen on.')
+  serve_parser.add_argument(
+      '--max-cache-size', type=int, default=None, metavar='MB',
+      help='Evict least recently used blobs to keep the cache under this size.')
 
   remove_parser = subcommand_parser.add_parser(
       'remove', help='Remove a package version from available packages.')
@@ -143,6 +558,96 @@ def setup_argparser():
   remove_parser.add_argument('package', help='Package name')
   remove_parser.add_argument('version', help='Package version')
 
+  watch_parser = subcommand_parser.add_parser(
+      'watch', help='Watch package tags and report whenever they change version.')
+  watch_parser.set_defaults(func=watch_command)
+  watch_parser.add_argument('package', help='Package name')
+  watch_parser.add_argument('label', help='Package label')
+  watch_parser.add_argument(
+      '--watch', nargs=2, metavar=('PACKAGE', 'LABEL'), action='append', default=[],
+      help='Additional package label to watch.')
+  watch_parser.add_argument(
+      '--exec', dest='command', default=None,
+      help='Shell command to run on every change, with $SACKER_PACKAGE, $SACKER_TAG and '
+           '$SACKER_VERSION set.')
+  watch_parser.add_argument(
+      '--initial', default=False, action='store_true',
+      help='Also report the version of each tag when the watch starts.')
+  watch_parser.add_argument(
+      '--min-interval', type=float, default=1.0, help='Seconds between polls of a changing tag.')
+  watch_parser.add_argument(
+      '--max-interval', type=float, default=60.0,
+      help='Seconds between polls of a tag that has not changed for a while.')
+
+  compact_parser = subcommand_parser.add_parser(
+      'compact', help='Compact the version index of a package, if the ledger keeps one.')
+  compact_parser.set_defaults(func=compact_command)
+  compact_parser.add_argument('package', help='Package name')
+
+  prune_parser = subcommand_parser.add_parser(
+      'prune', help='Remove old package versions according to a retention policy.')
+  prune_parser.set_defaults(func=prune_command)
+  prune_parser.add_argument(
+      'packages', nargs='*', help='Package names, defaults to all packages in the ledger')
+  prune_parser.add_argument(
+      '--keep-last', type=int, default=None, metavar='N', help='Keep the N most recent versions.')
+  prune_parser.add_argument(
+      '--keep-days', type=float, default=None, metavar='DAYS',
+      help='Keep versions added within the last DAYS days.')
+  prune_parser.add_argument(
+      '--include-tagged', default=False, action='store_true',
+      help='Also prune tagged versions, which are kept by default.')
+  prune_parser.add_argument(
+      '--dry-run', default=False, action='store_true',
+      help='Report what would be pruned without removing anything.')
+
+  mirror_parser = subcommand_parser.add_parser(
+      'mirror', help='Copy new versions, tags and blobs to another ledger and store.')
+  mirror_parser.set_defaults(func=mirror_command, default_priority='background')
+  mirror_parser.add_argument(
+      'packages', nargs='*', help='Package names, defaults to all packages in the ledger')
+  mirror_parser.add_argument('--to-ledger', required=True, help='URI of the target ledger.')
+  mirror_parser.add_argument('--to-store', required=True, help='URI of the target store.')
+  mirror_parser.add_argument(
+      '--state', default=None,
+      help='File recording what has been mirrored, defaults to one per target under '
+           '$SACKER_HOME/mirror.')
+  mirror_parser.add_argument(
+      '-j', '--concurrency', type=int, default=8, help='Number of blobs to copy concurrently.')
+  mirror_parser.add_argument(
+      '--interval', type=float, default=None, metavar='SECS',
+      help='Mirror continuously, every SECS seconds.')
+
+  index_store_parser = subcommand_parser.add_parser(
+      'index-store', help='Rebuild the existence index of the store used by bulk operations.')
+  index_store_parser.set_defaults(func=index_store_command)
+
+  rekey_parser = subcommand_parser.add_parser(
+      'rekey', help='Move blobs stored in the legacy flat layout to the layout of the store.')
+  rekey_parser.set_defaults(func=rekey_command)
+  rekey_parser.add_argument(
+      '--delete-legacy', default=False, action='store_true',
+      help='Delete each blob from the flat layout once it is copied.')
+  rekey_parser.add_argument(
+      '-j', '--concurrency', type=int, default=8, help='Number of blobs to copy concurrently.')
+
+  snapshot_parser = subcommand_parser.add_parser(
+      'snapshot', help='Refresh the local ledger snapshot used by --snapshot.')
+  snapshot_parser.set_defaults(func=snapshot_command)
+  snapshot_parser.add_argument(
+      '--full', default=False, action='store_true',
+      help='Rebuild the snapshot from scratch, dropping versions removed from the ledger.')
+
+  batch_parser = subcommand_parser.add_parser(
+      'batch', help='Run subcommands read from stdin, one per line, against shared backends.')
+  batch_parser.set_defaults(func=batch_command)
+  batch_parser.add_argument(
+      '--json', default=False, action='store_true',
+      help='Read JSON argument lists and write JSON results instead of plain subcommand lines.')
+  batch_parser.add_argument(
+      '-j', '--concurrency', type=int, default=1,
+      help='Number of subcommands to run concurrently.  Output is always in input order.')
+
   tag_parser = subcommand_parser.add_parser('tag', help='Tag a package with a label.')
   tag_parser.set_defaults(func=tag_command)
   tag_parser.add_argument('package', help='Package name')
@@ -161,32 +666,69 @@ def setup_argparser():
   return parser
 
 
-def setup_defaults(args):
-  config = Config.from_environment()
+def coordinate(store, coordinator):
+  """has the transfers of store respect coordinator, if the store supports it."""
+  if coordinator is not None and hasattr(store, 'coordinator'):
+    store.coordinator = coordinator
+
+
+def setup_defaults(args, parent=None):
+  """completes args from the configuration, or from parent, the args of the batch that args is a
+  request of.  requests share the ledger, store, transfer coordinator and cache of their batch,
+  and use the snapshot if either the request or the batch asks for it."""
+  if parent is not None:
+    args.ledger = args.ledger or parent.ledger
+    args.coordinator = getattr(parent, 'coordinator', None)
+    if args.store:
+      coordinate(args.store, args.coordinator)
+    else:
+      args.store = parent.store
+    args.cache = parent.cache
+    args.snapshot = args.snapshot or parent.snapshot
+  else:
+    config = Config.from_environment()
+
+    if not args.ledger and config.ledger_uri:
+      args.ledger = parse_ledger(config.ledger_uri)
+
+    if not args.store and config.store_uri:
+      args.store = parse_store(config.store_uri)
+
+    if not args.store:
+      die('Must specify a store.')
 
-  if not args.ledger and config.ledger_uri:
-    args.ledger = parse_ledger(config.ledger_uri)
+    if not args.ledger:
+      die('Must specify a ledger.')
 
-  if not args.store and config.store_uri:
-    args.store = parse_store(config.store_uri)
+    if config.max_transfers or config.bandwidth_limit:
+      from sacker.bandwidth import TransferCoordinator
+      args.coordinator = TransferCoordinator.default(
+          max_transfers=config.max_transfers,
+          bandwidth_limit=config.bandwidth_limit * 1024 * 1024 if config.bandwidth_limit else None,
+          priority=args.priority or getattr(args, 'default_priority', 'normal'))
+      coordinate(args.store, args.coordinator)
 
-  if not args.store:
-    die('Must specify a store.')
+    from sacker.cache import LocalCache
+    if config.cache_dir:
+      args.cache = LocalCache(os.path.expanduser(config.cache_dir))
+    else:
+      args.cache = LocalCache.default()
 
-  if not args.ledger:
-    die('Must specify a ledger.')
+  if args.snapshot and args.func in SNAPSHOT_COMMANDS:
+    from sacker.snapshot import SnapshotLedger
+    args.ledger = SnapshotLedger.fresh(args.ledger, args.max_staleness)
 
 
-# TODO(wickman) Build a proper plugin mechanism
 def register_all():
   from sacker.ledger import register_ledger
-  from sacker.ledgers.dynamo import DynamoLedger
-  from sacker.ledgers.s3 import S3Ledger
   from sacker.store import register_store
-  from sacker.stores.s3 import S3Store
-  register_store('s3', S3Store)
-  register_ledger('dynamo', DynamoLedger)
-  register_ledger('s3', S3Ledger)
+  # backends are imported lazily, when a URI with their scheme is parsed.  third-party backends
+  # may also be declared in the sacker.ledgers and sacker.stores entry point groups.
+  register_store('memory', 'sacker.stores.memory:MemoryStore')
+  register_store('s3', 'sacker.stores.s3:S3Store')
+  register_ledger('dynamo', 'sacker.ledgers.dynamo:DynamoLedger')
+  register_ledger('memory', 'sacker.ledgers.memory:MemoryLedger')
+  register_ledger('s3', 'sacker.ledgers.s3:S3Ledger')
 
 
 def main():
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+
+from .hashing import verify_file
+from .util import safe_mkdir, sacker_home
+
+
+class LocalCache(object):
+  """A local directory of blobs, addressable only by sha."""
+
+  @classmethod
+  def default(cls):
+    return cls(os.path.join(sacker_home(), 'cache'))
+
+  def __init__(self, root):
+    self.root = root
+
+  def path(self, sha):
+    return os.path.join(self.root, sha)
+
+  def __contains__(self, sha):
+    return os.path.exists(self.path(sha))
+
+  def touch(self, sha):
+    """marks sha as just used, for trim.  returns False if sha is not in the cache."""
+    try:
+      os.utime(self.path(sha), None)
+    except OSError:
+      return False
+    return True
+
+  def insert(self, sha, filename):
+    """copies filename into the cache as sha.  the caller is responsible for verifying the sha."""
+    safe_mkdir(self.root)
+    fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.%s.' % sha)
+    os.close(fd)
+    try:
+      shutil.copyfile(filename, tmp)
+      os.rename(tmp, self.path(sha))
+    except (IOError, OSError):
+      os.unlink(tmp)
+      raise
+
+  def fetch(self, store, sha):
+    """ensures sha is in the cache, downloading and verifying it from store if necessary."""
+    if self.touch(sha):
+      return self.path(sha)
+    safe_mkdir(self.root)
+    fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.%s.' % sha)
+    os.close(fd)
+    try:
+      store.download(sha, tmp)
+      if not verify_file(tmp, sha):
+        raise store.Error('Blob %s appears to be corrupt.' % sha)
+      os.rename(tmp, self.path(sha))
+    finally:
+      if os.path.exists(tmp):
+        os.unlink(tmp)
+    return self.path(sha)
+
+  def trim(self, max_bytes, keep=None):
+    """evicts the least recently used blobs until the cache is at most max_bytes.
+
+    blobs are used when they are inserted, fetched or touched, which sets their mtime.  atimes are
+    not relied on since relatime and noatime mounts rarely or never update them.
+    """
+    entries = []
+    for name in os.listdir(self.root):
+      if name.startswith('.') or name == keep:
+        continue
+      try:
+        st = os.stat(self.path(name))
+      except OSError:
+        continue
+      entries.append((st.st_mtime, st.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    if keep is not None and keep in self:
+      total += os.path.getsize(self.path(keep))
+    for _, size, name in sorted(entries):
+      if total <= max_bytes:
+        break
+      self.remove(name)
+      total -= size
+
+  def remove(self, sha):
+    try:
+      os.unlink(self.path(sha))
+    except OSError:
+      pass
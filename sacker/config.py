@@ -7,11 +7,17 @@ class Config(object):
   def from_file(cls, filename):
     with open(filename, 'rb') as fp:
       config = json.load(fp)
-      return cls(config.get('ledger'), config.get('store'))
+      return cls(
+          config.get('ledger'),
+          config.get('store'),
+          config.get('cache'),
+          config.get('max_transfers'),
+          config.get('bandwidth_limit'),
+      )
 
   @classmethod
   def from_environment(cls):
-    global_config = cls(None, None)
+    global_config = cls(None, None, None)
 
     for path in os.environ.get('SACKER_CONFIG'), os.path.expanduser('~/.sacker.json'):
       if not path:
@@ -25,9 +31,20 @@ class Config(object):
         global_config.ledger_uri = config.ledger_uri
       if config.store_uri:
         global_config.store_uri = config.store_uri
+      if config.cache_dir:
+        global_config.cache_dir = config.cache_dir
+      if config.max_transfers:
+        global_config.max_transfers = config.max_transfers
+      if config.bandwidth_limit:
+        global_config.bandwidth_limit = config.bandwidth_limit
 
     return global_config
 
-  def __init__(self, ledger_uri=None, store_uri=None):
+  def __init__(self, ledger_uri=None, store_uri=None, cache_dir=None, max_transfers=None,
+               bandwidth_limit=None):
     self.ledger_uri = ledger_uri
     self.store_uri = store_uri
+    self.cache_dir = cache_dir
+    # host-wide limits on concurrent transfers and their aggregate bandwidth in MB/s.
+    self.max_transfers = max_transfers
+    self.bandwidth_limit = bandwidth_limit
@@ -0,0 +1,63 @@
+"""Binary deltas between consecutive versions of a package.
+
+Deltas are stored in the store alongside the blobs they reconstruct, under the
+name returned by delta_name.  A delta is only published if it is smaller than
+the blob it reconstructs.
+"""
+
+import os
+
+from .util import temporary_dir
+
+try:
+  import bsdiff4
+except ImportError:
+  bsdiff4 = None
+
+
+class DeltaError(Exception): pass
+
+
+def delta_name(base_sha, target_sha):
+  return '%s-%s.bsdiff' % (base_sha, target_sha)
+
+
+def has_delta_support():
+  return bsdiff4 is not None
+
+
+def _require_bsdiff():
+  if bsdiff4 is None:
+    raise DeltaError('Binary deltas require the bsdiff4 package (pip install sacker[delta]).')
+
+
+def publish_delta(store, base_sha, base_filename, target_sha, target_filename):
+  """compute and upload the delta from base to target.  returns True if a delta was uploaded."""
+  _require_bsdiff()
+  with temporary_dir() as dirname:
+    delta_filename = os.path.join(dirname, 'delta')
+    bsdiff4.file_diff(base_filename, target_filename, delta_filename)
+    if os.path.getsize(delta_filename) >= os.path.getsize(target_filename):
+      return False
+    store.upload(delta_name(base_sha, target_sha), delta_filename)
+  return True
+
+
+def fetch_delta(store, base_sha, base_filename, target_sha, output_filename):
+  """reconstruct target from base using a published delta.  returns False if there is none.
+
+  the caller is responsible for verifying the sha of the reconstructed file.
+  """
+  _require_bsdiff()
+  with temporary_dir() as dirname:
+    delta_filename = os.path.join(dirname, 'delta')
+    try:
+      store.download(delta_name(base_sha, target_sha), delta_filename)
+    except store.DoesNotExist:
+      return False
+    try:
+      bsdiff4.file_patch(base_filename, output_filename, delta_filename)
+    except (ValueError, EnvironmentError) as e:
+      # bsdiff4 raises these for corrupt or truncated deltas.
+      raise DeltaError('Could not apply delta %s: %s' % (delta_name(base_sha, target_sha), e))
+  return True
@@ -3,19 +3,49 @@ from apache.aurora.client.cli import ConfigurationPlugin
 from apache.aurora.config.loader import AuroraConfigLoader
 from apache.aurora.common.clusters import CLUSTERS
 from sacker import ledger as sacker_ledger, store as sacker_store
-from sacker.stores.s3 import S3Store
-from sacker.ledgers.dynamo import DynamoLedger
-from sacker.ledgers.s3 import S3Ledger
+from sacker.hashing import TreeAlgorithm, parse_address
 from pystachio.matcher import Any, Matcher
 from pystachio import Ref
 
 from . import schema as sacker_schema
 
 
+def tree_hash_command(algorithm, digest_command):
+  """returns a shell command computing the tree digest of stdin, see sacker.hashing.  each segment
+  is hashed as it is read, so stdin is read once and only segment digests are kept on disk."""
+  return (
+      # a group rather than a subshell, since "$((" would be taken for arithmetic expansion.
+      '{ d=$(mktemp -d) && '
+      '{ printf "%(name)s:%(size)d:"; first=1; while :; do '
+      'LC_ALL=C dd bs=%(block)d count=%(blocks)d iflag=fullblock 2>"$d/n" | '
+      '%(digest)s -binary > "$d/h" || break; '
+      'n=$(awk \'/copied/ { print $1; exit }\' "$d/n"); '
+      # stdin is empty once a segment other than the first is, and ends with a short segment.
+      '[ "$n" -gt 0 ] || [ $first ] || break; cat "$d/h"; first=; '
+      '[ "$n" -eq %(size)d ] || break; done; } | '
+      '%(digest)s; rc=$?; rm -rf "$d"; [ $rc -eq 0 ]; }' % {
+          'name': algorithm,
+          'size': TreeAlgorithm.SEGMENT_SIZE,
+          'block': 1024 * 1024,
+          'blocks': TreeAlgorithm.SEGMENT_SIZE // (1024 * 1024),
+          'digest': digest_command})
+
+
+# shell commands used by the copy command to verify downloads, keyed by hash algorithm.
+HASH_COMMANDS = {
+  'sha256': 'openssl sha -sha256',
+  'sha512': 'openssl dgst -sha512',
+  'blake2b': 'openssl dgst -blake2b512',
+  'sha256-tree': tree_hash_command('sha256-tree', 'openssl dgst -sha256'),
+  'blake2b-tree': tree_hash_command('blake2b-tree', 'openssl dgst -blake2b512'),
+}
+
+
 def get_sacker(cluster):
   ledger = sacker_ledger.parse_ledger(cluster.sacker_ledger_uri)
   store = sacker_store.parse_store(cluster.sacker_store_uri)
 
+  from sacker.stores.s3 import S3Store
   if not isinstance(store, S3Store):
     raise RuntimeError('Sacker binding helper only supports S3 store.')
 
@@ -26,15 +56,30 @@ def get_sacker_binding(cluster, name, version="latest"):
   cluster = cluster.with_trait(sacker_schema.SackerClientTrait)
   ledger, store = get_sacker(cluster)
   package = ledger.info(name, version)
+  algorithm, digest = parse_address(package.sha)
+
+  if algorithm not in HASH_COMMANDS:
+    raise RuntimeError('Sacker binding helper cannot verify %s packages.' % algorithm)
 
   s3_object = sacker_schema.SackerObject(
       sha=package.sha,
+      digest=digest,
+      hash_command=HASH_COMMANDS[algorithm],
       filename=package.basename,
       mode='%o' % (package.mode & 0777),  # limit to lowest bits
       bucket=store.bucket,
+      key=store.key(package.sha),
       version=package.version,
       metadata=package.metadata if package.metadata is not None else {},
   )
+  if cluster.has_sacker_presign_expires():
+    # the URL is signed when the config is bound, so tasks (re)scheduled after it expires cannot
+    # fetch the package until the job is deployed again.
+    try:
+      uri = store.url(package.sha, expires=cluster.sacker_presign_expires().get())
+    except ValueError as e:
+      raise RuntimeError('Cannot presign %s version %s: %s' % (name, package.version, e))
+    s3_object = s3_object(uri=uri)
   if cluster.sacker_uri_override:
     s3_object = s3_object(uri=cluster.sacker_uri_override)
   if cluster.sacker_download_command:
@@ -71,9 +116,9 @@ class SackerBindingHelper(BindingHelper):
 class SackerBindingHelperPlugin(ConfigurationPlugin):
   def before_execution(self, context):
     # register usable backends
-    sacker_ledger.register_ledger('s3', S3Ledger)
-    sacker_ledger.register_ledger('dynamo', DynamoLedger)
-    sacker_store.register_store('s3', S3Store)
+    sacker_ledger.register_ledger('s3', 'sacker.ledgers.s3:S3Ledger')
+    sacker_ledger.register_ledger('dynamo', 'sacker.ledgers.dynamo:DynamoLedger')
+    sacker_store.register_store('s3', 'sacker.stores.s3:S3Store')
 
     # register schema
     AuroraConfigLoader.register_schema(sacker_schema)
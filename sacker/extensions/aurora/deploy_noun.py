@@ -1,22 +1,22 @@
 import getpass
-import hashlib
 import json
 import logging
+import multiprocessing
 import os
-import shutil
+import stat
 import subprocess
+import sys
 import tempfile
 import time
 import webbrowser
-from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from pipes import quote
 
 from sacker import ledger as sacker_ledger
 from sacker import store as sacker_store
-from sacker.ledgers.s3 import S3Ledger
-from sacker.ledgers.dynamo import DynamoLedger
-from sacker.stores.s3 import S3Store
+from sacker.hashing import hash_bytes
 
+from apache.aurora.common.aurora_job_key import AuroraJobKey
 from apache.aurora.common.clusters import CLUSTERS
 from apache.aurora.config import AuroraConfig
 from apache.aurora.client.base import get_update_page
@@ -45,6 +45,7 @@ from gen.apache.aurora.api.ttypes import JobUpdateStatus, JobUpdateKey
 
 
 STAGE_KEY = 'config version'
+CONFIG_MODE = stat.S_IFREG | 0644
 
 
 class DeployClientTrait(Struct):
@@ -97,23 +98,20 @@ def get_metadata(context):
   return dict(iterate())
 
 
-@contextmanager
-def temporary_dir():
-  dirname = tempfile.mkdtemp()
-  yield dirname
-  shutil.rmtree(dirname)
-
-
 def get_config(jobkey, version='latest'):
   config_ledger = get_ledger(CLUSTERS[jobkey.cluster])
   config_store = get_store(CLUSTERS[jobkey.cluster])
   config_package_name = jobkey_to_config_name(jobkey)
   package = config_ledger.info(config_package_name, version)
+  return package, config_store.open(package.sha).read()
+
 
-  with temporary_dir() as dirname:
-    config_store.download(package.sha, os.path.join(dirname, 'config.json'))
-    with open(os.path.join(dirname, 'config.json')) as fp:
-      return package, fp.read()
+def compile_config(context, jobkey, config_file):
+  """returns the pretty-printed json of the config of jobkey and its sha."""
+  config = context.get_job_config(jobkey, config_file)
+  json_raw = json.loads(config.raw().json_dumps())
+  json_pretty = json.dumps(json_raw, indent=4, sort_keys=True)
+  return json_pretty, hash_bytes(json_pretty)
 
 
 class StageCommand(Verb):
@@ -139,10 +137,8 @@ class StageCommand(Verb):
     config_store = get_store(CLUSTERS[context.options.jobspec.cluster])
 
     # get config, embed version metadata and compute sha
-    config = context.get_job_config(context.options.jobspec, context.options.config_file)
-    json_raw = json.loads(config.raw().json_dumps())
-    json_pretty = json.dumps(json_raw, indent=4, sort_keys=True)
-    json_sha = hashlib.sha256(json_pretty).hexdigest()
+    json_pretty, json_sha = compile_config(
+        context, context.options.jobspec, context.options.config_file)
 
     # get user-supplied metadata
     metadata = get_metadata(context)
@@ -150,26 +146,167 @@ class StageCommand(Verb):
     # add our own
     metadata.update(stage_timestamp=str(time.time()))
 
-    # write to disk since the api requires actual file and not file-like
-    with temporary_dir() as dirname:
-      path = os.path.join(dirname, 'config.json')
-      with open(path, 'wb') as fp:
-        fp.write(json_pretty)
-      mode = os.stat(path).st_mode
+    # upload
+    config_store.put(json_sha, json_pretty)
 
-      # upload
-      config_store.upload(json_sha, path)
-
-      # commit to ledger
-      config_package_name = jobkey_to_config_name(context.options.jobspec)
-      actual_version = config_ledger.add(
-          config_package_name, 'config.json', json_sha, mode, metadata=metadata)
+    # commit to ledger
+    config_package_name = jobkey_to_config_name(context.options.jobspec)
+    actual_version = config_ledger.add(
+        config_package_name, 'config.json', json_sha, CONFIG_MODE, metadata=metadata)
 
     context.print_out('Staged %s version %d' % (context.options.jobspec, actual_version))
 
     return EXIT_OK
 
 
+# the context of the batch being compiled, inherited by forked compile workers.
+_compile_context = None
+
+
+def _init_compile_worker(context):
+  global _compile_context
+  _compile_context = context
+
+
+def _compile_job(job):
+  jobspec, config_file = job
+  try:
+    return compile_config(_compile_context, AuroraJobKey.from_path(jobspec), config_file), None
+  except Exception as e:
+    return None, str(e) or e.__class__.__name__
+
+
+class StageBatchCommand(Verb):
+  # concurrency of store and ledger requests.
+  CONCURRENCY = 16
+
+  @property
+  def name(self):
+    return 'stage-batch'
+
+  @property
+  def help(self):
+    return 'Stage compiled configs of many jobs into their ledgers.'
+
+  def get_options(self):
+    return [
+        BIND_OPTION,
+        JSON_READ_OPTION,
+        METADATA_OPTIONS,
+        CommandOption(
+            '--parallelism',
+            type=int,
+            default=None,
+            help='Number of configs to compile in parallel, by default one per CPU.'),
+        CommandOption(
+            'jobs',
+            nargs='+',
+            metavar='JOBSPEC=CONFIG',
+            help='Jobs to stage and their config files, or - to read them from stdin, one per '
+                 'line.'),
+    ]
+
+  def _jobs(self, context):
+    for arg in context.options.jobs:
+      lines = sys.stdin.read().split() if arg == '-' else [arg]
+      for line in lines:
+        jobspec, _, config_file = line.partition('=')
+        if not config_file:
+          raise context.CommandError(
+              EXIT_INVALID_PARAMETER, 'Jobs must be JOBSPEC=CONFIG pairs, got %r.' % line)
+        try:
+          AuroraJobKey.from_path(jobspec)
+        except AuroraJobKey.Error as e:
+          raise context.CommandError(EXIT_INVALID_PARAMETER, str(e))
+        yield jobspec, config_file
+
+  def _compile(self, context, jobs):
+    """returns a (json_pretty, sha), error pair for each job."""
+    processes = min(len(jobs), context.options.parallelism or multiprocessing.cpu_count())
+    if processes <= 1:
+      _init_compile_worker(context)
+      return map(_compile_job, jobs)
+    # compilation is cpu bound, so it runs in forked processes which inherit the context.
+    pool = multiprocessing.Pool(processes, _init_compile_worker, (context,))
+    try:
+      return pool.map(_compile_job, jobs, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+
+  def _upload(self, pool, config_store, configs):
+    """uploads configs, a map from sha to json, that the store does not have yet.  returns a map
+    from sha to the error uploading it."""
+    existing = config_store.exists_many(configs)
+
+    def put(sha):
+      try:
+        config_store.put(sha, configs[sha])
+      except Exception as e:
+        return sha, str(e) or e.__class__.__name__
+      return sha, None
+
+    return dict(
+        (sha, error) for sha, error in pool.map(put, set(configs) - existing) if error)
+
+  def execute(self, context):
+    jobs = list(self._jobs(context))
+    if len(set(jobspec for jobspec, _ in jobs)) != len(jobs):
+      raise context.CommandError(EXIT_INVALID_PARAMETER, 'Each job may only be staged once.')
+    metadata = get_metadata(context)
+    metadata.update(stage_timestamp=str(time.time()))
+
+    compiled = self._compile(context, jobs)
+    errors = dict(
+        (jobspec, 'Could not compile %s: %s' % (config_file, error))
+        for (jobspec, config_file), (_, error) in zip(jobs, compiled) if error)
+
+    # each distinct config is uploaded once per cluster, however many jobs share it.
+    shas = {}
+    configs_by_cluster = {}
+    for (jobspec, _), (result, _) in zip(jobs, compiled):
+      if result is not None:
+        json_pretty, shas[jobspec] = result
+        cluster = AuroraJobKey.from_path(jobspec).cluster
+        configs_by_cluster.setdefault(cluster, {})[shas[jobspec]] = json_pretty
+
+    ledgers = {}
+    pool = ThreadPool(self.CONCURRENCY)
+    try:
+      for cluster, configs in sorted(configs_by_cluster.items()):
+        ledgers[cluster] = get_ledger(CLUSTERS[cluster])
+        failed = self._upload(pool, get_store(CLUSTERS[cluster]), configs)
+        for jobspec, sha in shas.items():
+          if sha in failed and AuroraJobKey.from_path(jobspec).cluster == cluster:
+            errors[jobspec] = 'Could not upload %s: %s' % (sha, failed[sha])
+
+      def add(jobspec):
+        jobkey = AuroraJobKey.from_path(jobspec)
+        try:
+          return ledgers[jobkey.cluster].add(
+              jobkey_to_config_name(jobkey), 'config.json', shas[jobspec], CONFIG_MODE,
+              metadata=metadata), None
+        except Exception as e:
+          return None, 'Could not add to ledger: %s' % (str(e) or e.__class__.__name__)
+
+      staged = [jobspec for jobspec, _ in jobs if jobspec not in errors]
+      for jobspec, (version, error) in zip(staged, pool.map(add, staged)):
+        if error:
+          errors[jobspec] = error
+        else:
+          context.print_out('Staged %s version %d' % (jobspec, version))
+    finally:
+      pool.close()
+
+    for jobspec, _ in jobs:
+      if jobspec in errors:
+        context.print_err('Failed to stage %s: %s' % (jobspec, errors[jobspec]))
+    context.print_out('Staged %d of %d jobs (%d distinct configs).' % (
+        len(jobs) - len(errors), len(jobs), len(set(shas.values()))))
+
+    return EXIT_COMMAND_FAILURE if errors else EXIT_OK
+
+
 class ReleaseCommand(Verb):
   @property
   def name(self):
@@ -350,13 +487,13 @@ class ReleaseCommand(Verb):
     config_ledger = get_ledger(CLUSTERS[context.options.jobspec.cluster])
     release_key = jobkey_to_release_name(context.options.jobspec)
 
-    versions = sorted(config_ledger.list_package_versions(release_key))
+    versions = list(config_ledger.list_package_versions(release_key, limit=2, reverse=True))
 
     if not versions:
       return (None, None)
 
     try:
-      latest_version = config_ledger.info(release_key, versions[-1])
+      latest_version = config_ledger.info(release_key, versions[0])
     except config_ledger.Error:
       raise context.CommandError(EXIT_API_ERROR, 'Corrupted ledger.')
 
@@ -367,7 +504,7 @@ class ReleaseCommand(Verb):
       raise context.CommandError(EXIT_API_ERROR, 'Corrupted ledger.')
 
     try:
-      previous_version = config_ledger.info(release_key, versions[-2])
+      previous_version = config_ledger.info(release_key, versions[1])
     except config_ledger.Error:
       raise context.CommandError(EXIT_API_ERROR, 'Corrupted ledger.')
 
@@ -423,14 +560,20 @@ class LogCommand(Verb):
     return [
         JOBSPEC_ARGUMENT,
         OPTIONAL_VERSION_ARGUMENT,
+        CommandOption(
+            '--limit',
+            type=int,
+            default=None,
+            help='Only show this many of the most recent releases.'),
     ]
 
   def execute(self, context):
     config_ledger = get_ledger(CLUSTERS[context.options.jobspec.cluster])
     release_package_name = jobkey_to_release_name(context.options.jobspec)
+    releases = reversed(list(config_ledger.info_all(
+        release_package_name, limit=context.options.limit, reverse=True)))
 
-    for version in config_ledger.list_package_versions(release_package_name):
-      package = config_ledger.info(release_package_name, version)
+    for package in releases:
       metadata = package.metadata.copy()
 
       deploy_timestamp = metadata.pop('deploy_timestamp', None)
@@ -474,12 +617,12 @@ class VersionsCommand(Verb):
     config_ledger = get_ledger(CLUSTERS[context.options.jobspec.cluster])
     config_package_name = jobkey_to_config_name(context.options.jobspec)
 
-    for version in config_ledger.list_package_versions(config_package_name):
-      if not context.options.full:
+    if not context.options.full:
+      for version in config_ledger.list_package_versions(config_package_name):
         context.print_out('%s %4d' % (context.options.jobspec, version))
-        continue
+      return EXIT_OK
 
-      package = config_ledger.info(config_package_name, version)
+    for package in config_ledger.info_all(config_package_name):
       metadata = package.metadata.copy()
       stage_timestamp = metadata.pop('stage_timestamp', None)
 
@@ -487,7 +630,7 @@ class VersionsCommand(Verb):
           time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(float(stage_timestamp)))
           if stage_timestamp else '????/??/?? ??:??:??',
           context.options.jobspec,
-          version,
+          package.version,
           package.sha[:8],
           json.dumps(metadata, indent=4)))
 
@@ -572,6 +715,7 @@ class DeployNoun(Noun):
   def __init__(self):
     super(DeployNoun, self).__init__()
     self.register_verb(StageCommand())
+    self.register_verb(StageBatchCommand())
     self.register_verb(ReleaseCommand())
     self.register_verb(LogCommand())
     self.register_verb(VersionsCommand())
@@ -585,9 +729,9 @@ class DeployCommandPlugin(Plugin):
 
   def before_dispatch(self, raw_args):
     # register backends
-    sacker_store.register_store('s3', S3Store)
-    sacker_ledger.register_ledger('s3', S3Ledger)
-    sacker_ledger.register_ledger('dynamo', DynamoLedger)
+    sacker_store.register_store('s3', 'sacker.stores.s3:S3Store')
+    sacker_ledger.register_ledger('s3', 'sacker.ledgers.s3:S3Ledger')
+    sacker_ledger.register_ledger('dynamo', 'sacker.ledgers.dynamo:DynamoLedger')
 
     # blackhole boto logging unless verbosity is enabled
     if '-v' not in raw_args and '--verbose' not in raw_args:
@@ -4,6 +4,7 @@ from textwrap import dedent
 from apache.thermos.config.schema import Process
 from pystachio import (
     Default,
+    Integer,
     Map,
     Required,
     String,
@@ -13,8 +14,8 @@ from pystachio import (
 
 DEFAULT_COPY_COMMAND = (
 """
-curl --retry 5 -o "{{filename}}~" {{uri}}
-if [[ "{{sha}}" == $(openssl sha -sha256 < "{{filename}}~" | awk '{ print $NF }') ]]; then
+curl --retry 5 -o "{{filename}}~" "{{uri}}"
+if [[ "{{digest}}" == $({{hash_command}} < "{{filename}}~" | awk '{ print $NF }') ]]; then
   mv -f "{{filename}}~" "{{filename}}"
   chmod {{mode}} {{filename}}
 else
@@ -26,11 +27,15 @@ fi
 
 class SackerObject(Struct):
   sha = Required(String)
+  digest = Default(String, '{{sha}}')
+  hash_command = Default(String, 'openssl sha -sha256')
   filename = Required(String)
   version = Required(String)
   mode = Required(String)
   bucket = Required(String)
-  uri = Default(String, 'http://{{bucket}}.s3.amazonaws.com/{{sha}}')
+  # the key of the blob in the layout of the store, e.g. ab/cd/<sha> for sharded stores.
+  key = Default(String, '{{sha}}')
+  uri = Default(String, 'http://{{bucket}}.s3.amazonaws.com/{{key}}')
   metadata = Default(Map(String, String), {})
   copy_command = Default(String, DEFAULT_COPY_COMMAND)
 
@@ -40,39 +45,94 @@ class SackerClientTrait(Struct):
   sacker_store_uri = Required(String)
   sacker_uri_override = String
   sacker_download_command = String
+  # if set, packages are fetched from presigned URLs valid for this many seconds (at most a
+  # week), so that private buckets can be fetched from without credentials.  URLs are signed at
+  # deploy time, so this must exceed the time for which tasks may be rescheduled without a new
+  # deploy.
+  sacker_presign_expires = Integer
 
 
 class Sacker(object):
   COPY_COMMAND = "{{{{pkg}}.copy_command}}"
   UNPACK_COMMAND = COPY_COMMAND + dedent("""
-     function _delete_pkg() { rm -f {{{{pkg}}.package}}; }
-
-     if [[ "{{{{pkg}}.package}}" == *".tar" ]]; then
-       tar -xf {{{{pkg}}.package}} && _delete_pkg
-     elif [[ "{{{{pkg}}.package}}" == *".tar.gz" || "{{{{pkg}}.package}}" == *".tgz" ]]; then
-       tar -xzf {{{{pkg}}.package}} && _delete_pkg
-     elif [[ "{{{{pkg}}.package}}" == *".tar.bz2" || "{{{{pkg}}.package}}" == *".tbz2" ]]; then
-       tar -xjf {{{{pkg}}.package}} && _delete_pkg
-     elif [[ "{{{{pkg}}.package}}" == *".zip" ]]; then
-       unzip -qo {{{{pkg}}.package}} && _delete_pkg
-     elif [[ "{{{{pkg}}.package}}" == *".shar" ]]; then
-       sh {{{{pkg}}.package}} && _delete_pkg
+     function _delete_pkg() { rm -f {{{{pkg}}.filename}}; }
+
+     if [[ "{{{{pkg}}.filename}}" == *".tar" ]]; then
+       tar -xf {{{{pkg}}.filename}} && _delete_pkg
+     elif [[ "{{{{pkg}}.filename}}" == *".tar.gz" || "{{{{pkg}}.filename}}" == *".tgz" ]]; then
+       tar -xzf {{{{pkg}}.filename}} && _delete_pkg
+     elif [[ "{{{{pkg}}.filename}}" == *".tar.bz2" || "{{{{pkg}}.filename}}" == *".tbz2" ]]; then
+       tar -xjf {{{{pkg}}.filename}} && _delete_pkg
+     elif [[ "{{{{pkg}}.filename}}" == *".zip" ]]; then
+       unzip -qo {{{{pkg}}.filename}} && _delete_pkg
+     elif [[ "{{{{pkg}}.filename}}" == *".shar" ]]; then
+       sh {{{{pkg}}.filename}} && _delete_pkg
      fi
   """)
 
+  # streams the package through the hash command straight into tar in a single pass, extracting
+  # into a staging directory that is only merged into the sandbox once the digest has been
+  # verified.  tar may exit before the end of the stream, e.g. before trailing zero blocks, so the
+  # rest is drained for the hash command rather than failing tee with SIGPIPE.  formats that
+  # cannot be extracted from a stream fall back to UNPACK_COMMAND.
+  STREAM_UNPACK_COMMAND = dedent("""
+     function _sacker_stream_unpack() {
+       local staging=$(mktemp -d .sacker.XXXXXX)
+       mkfifo "$staging.fifo"
+       {{{{pkg}}.hash_command}} < "$staging.fifo" | awk '{ print $NF }' > "$staging.digest" &
+       local hasher=$!
+       curl -sSf "{{{{pkg}}.uri}}" | tee "$staging.fifo" | (
+         tar -C "$staging" -x$1f -
+         rc=$?
+         cat > /dev/null
+         exit $rc
+       )
+       local rc=$?
+       wait $hasher
+       if [[ $rc -eq 0 && "{{{{pkg}}.digest}}" == "$(cat "$staging.digest")" ]]; then
+         cp -rlf "$staging"/. . && rm -rf "$staging" "$staging.fifo" "$staging.digest"
+       else
+         rm -rf "$staging" "$staging.fifo" "$staging.digest"
+         return 1
+       fi
+     }
+
+     function _sacker_stream_install() {
+       set -o pipefail
+       for attempt in 1 2 3; do
+         _sacker_stream_unpack $1 && return 0
+       done
+       echo "Package appears to be corrupt."
+       exit 1
+     }
+
+     case "{{{{pkg}}.filename}}" in
+       *.tar) _sacker_stream_install "" ;;
+       *.tar.gz|*.tgz) _sacker_stream_install z ;;
+       *.tar.bz2|*.tbz2) _sacker_stream_install j ;;
+       *)
+  """) + UNPACK_COMMAND + dedent("""
+       ;;
+     esac
+  """)
+
   PROCESS = Process(
       name = 'sacker_{{__package_name}}',
   ).bind(pkg = 'sacker[{{__package_name}}][{{__package_version}}]')
 
   @classmethod
-  def copy(cls, name, version="latest", unpack=False):
+  def copy(cls, name, version="latest", unpack=False, stream=False):
+    if unpack:
+      cmdline = cls.STREAM_UNPACK_COMMAND if stream else cls.UNPACK_COMMAND
+    else:
+      cmdline = cls.COPY_COMMAND
     return cls.PROCESS(
-       cmdline = cls.UNPACK_COMMAND if unpack else cls.COPY_COMMAND
+       cmdline = cmdline
     ).bind(
        __package_name = name,
        __package_version = version
     )
 
   @classmethod
-  def install(cls, name, version="latest"):
-    return cls.copy(name, version, unpack=True)
+  def install(cls, name, version="latest", stream=False):
+    return cls.copy(name, version, unpack=True, stream=stream)
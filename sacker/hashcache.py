@@ -0,0 +1,115 @@
+"""A persistent cache of file hashes.
+
+Hashes are keyed by (device, inode, size, mtime), so a file that has not
+changed since it was last hashed is never read again.  The hash is recorded in
+an extended attribute on the file where the platform and filesystem support it,
+and in a local sqlite database otherwise.
+"""
+
+import os
+import sqlite3
+import time
+
+from .hashing import DEFAULT_ALGORITHM, get_algorithm, make_address
+from .util import safe_mkdir, sacker_home
+
+try:
+  from os import getxattr, setxattr
+except ImportError:
+  try:
+    from xattr import getxattr, setxattr
+  except ImportError:
+    getxattr = setxattr = None
+
+
+# files modified this recently may still be modified again within the same mtime tick, so
+# their hashes are not cached.
+RACY_INTERVAL = 2.0
+
+
+def file_key(st):
+  mtime_ns = getattr(st, 'st_mtime_ns', None)
+  if mtime_ns is None:
+    mtime_ns = int(st.st_mtime * 1000000000)
+  return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+class HashCache(object):
+  XATTR_PREFIX = 'user.sacker.'
+
+  @classmethod
+  def default(cls):
+    return cls(os.path.join(sacker_home(), 'hashes.db'))
+
+  def __init__(self, db_path):
+    self.db_path = db_path
+    self._db = None
+
+  @property
+  def db(self):
+    if self._db is None:
+      safe_mkdir(os.path.dirname(self.db_path))
+      self._db = sqlite3.connect(self.db_path, timeout=5)
+      self._db.execute(
+          'CREATE TABLE IF NOT EXISTS hashes ('
+          'dev INTEGER, ino INTEGER, algorithm TEXT, size INTEGER, mtime_ns INTEGER, digest TEXT, '
+          'PRIMARY KEY (dev, ino, algorithm))')
+    return self._db
+
+  def _get_xattr(self, filename, algorithm, key):
+    try:
+      value = getxattr(filename, self.XATTR_PREFIX + algorithm)
+    except (IOError, OSError):
+      return None
+    stored_key, _, digest = value.decode('ascii').rpartition(':')
+    return digest if stored_key == ':'.join(map(str, key)) else None
+
+  def _set_xattr(self, filename, algorithm, key, digest):
+    value = '%s:%s' % (':'.join(map(str, key)), digest)
+    try:
+      setxattr(filename, self.XATTR_PREFIX + algorithm, value.encode('ascii'))
+    except (IOError, OSError):
+      return False
+    return True
+
+  def get(self, filename, algorithm, key):
+    if getxattr is not None:
+      digest = self._get_xattr(filename, algorithm, key)
+      if digest:
+        return digest
+    dev, ino, size, mtime_ns = key
+    try:
+      row = self.db.execute(
+          'SELECT digest FROM hashes WHERE dev = ? AND ino = ? AND algorithm = ? '
+          'AND size = ? AND mtime_ns = ?', (dev, ino, algorithm, size, mtime_ns)).fetchone()
+    except sqlite3.Error:
+      return None
+    return row[0] if row else None
+
+  def put(self, filename, algorithm, key, digest):
+    if setxattr is not None and self._set_xattr(filename, algorithm, key, digest):
+      return
+    dev, ino, size, mtime_ns = key
+    try:
+      with self.db:
+        self.db.execute(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+            (dev, ino, algorithm, size, mtime_ns, digest))
+    except sqlite3.Error:
+      pass
+
+  def hash_file(self, filename, algorithm=DEFAULT_ALGORITHM):
+    """returns the address of filename using algorithm"""
+    st = os.stat(filename)
+    key = file_key(st)
+    digest = self.get(filename, algorithm, key)
+    if not digest:
+      digest = get_algorithm(algorithm).digest_file(filename)
+      # only cache if the file was not modified while hashing and is not racily clean.
+      if file_key(os.stat(filename)) == key and time.time() - st.st_mtime > RACY_INTERVAL:
+        self.put(filename, algorithm, key, digest)
+    return make_address(algorithm, digest)
+
+
+def hash_file(filename, algorithm=DEFAULT_ALGORITHM):
+  return HashCache.default().hash_file(filename, algorithm)
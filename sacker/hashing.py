@@ -0,0 +1,167 @@
+"""Content addressing.
+
+The address of a blob is the hex digest of its contents, prefixed with the name
+of the hash algorithm and a colon, e.g. "blake2b:8f3a...".  sha256 addresses are
+not prefixed, so addresses predating pluggable algorithms remain valid.
+
+Tree algorithms ("<algorithm>-tree") hash fixed-size segments of a file
+independently, on as many threads as there are cores, and then hash the
+concatenation of the segment digests.
+"""
+
+import hashlib
+import os
+
+from .util import compute_hash
+
+try:
+  from hashlib import blake2b
+except ImportError:
+  try:
+    from pyblake2 import blake2b
+  except ImportError:
+    blake2b = None
+
+
+DEFAULT_ALGORITHM = 'sha256'
+
+
+class UnknownAlgorithm(ValueError): pass
+
+
+class Algorithm(object):
+  def __init__(self, name, hasher):
+    self.name = name
+    self.hasher = hasher
+
+  def digest_file(self, filename):
+    with open(filename, 'rb') as fp:
+      return compute_hash(fp, hasher=self.hasher)
+
+  def digest_stream(self, filelike):
+    return compute_hash(filelike, hasher=self.hasher)
+
+  def digest_bytes(self, data):
+    return self.hasher(data).hexdigest()
+
+
+class TreeAlgorithm(Algorithm):
+  # the segment size is part of the definition of the digest, so it must never change.
+  SEGMENT_SIZE = 64 * 1024 * 1024
+
+  def __init__(self, name, hasher, workers=None):
+    super(TreeAlgorithm, self).__init__(name, hasher)
+    self.workers = workers
+
+  def _combine(self, segment_digests):
+    root = self.hasher(('%s:%d:' % (self.name, self.SEGMENT_SIZE)).encode('ascii'))
+    for digest in segment_digests:
+      root.update(digest)
+    return root.hexdigest()
+
+  def _digest_segment(self, filename, offset):
+    with open(filename, 'rb') as fp:
+      fp.seek(offset)
+      hash = self.hasher()
+      buf = bytearray(min(self.SEGMENT_SIZE, 4 * 1024 * 1024))
+      view = memoryview(buf)
+      remaining = self.SEGMENT_SIZE
+      while remaining:
+        length = fp.readinto(view[:min(len(buf), remaining)])
+        if not length:
+          break
+        hash.update(view[:length])
+        remaining -= length
+      return hash.digest()
+
+  def digest_file(self, filename):
+    size = os.path.getsize(filename)
+    offsets = range(0, size, self.SEGMENT_SIZE) or [0]
+    if len(offsets) == 1:
+      return self._combine([self._digest_segment(filename, 0)])
+    # imported lazily since multiprocessing adds measurably to CLI startup time.
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    # hashlib releases the GIL while hashing large buffers, so threads hash in parallel.
+    pool = ThreadPool(min(self.workers or cpu_count(), len(offsets)))
+    try:
+      return self._combine(pool.map(lambda offset: self._digest_segment(filename, offset), offsets))
+    finally:
+      pool.close()
+
+  def digest_stream(self, filelike):
+    segment_digests = []
+    while True:
+      hash = self.hasher()
+      remaining = self.SEGMENT_SIZE
+      while remaining:
+        data = filelike.read(min(remaining, 4 * 1024 * 1024))
+        if not data:
+          break
+        hash.update(data)
+        remaining -= len(data)
+      if remaining == self.SEGMENT_SIZE and segment_digests:
+        break
+      segment_digests.append(hash.digest())
+      if remaining:
+        break
+    return self._combine(segment_digests)
+
+  def digest_bytes(self, data):
+    offsets = range(0, len(data), self.SEGMENT_SIZE) or [0]
+    return self._combine(
+        self.hasher(data[offset:offset + self.SEGMENT_SIZE]).digest() for offset in offsets)
+
+
+ALGORITHMS = {}
+
+
+def register_algorithm(algorithm):
+  ALGORITHMS[algorithm.name] = algorithm
+
+
+def get_algorithm(name):
+  try:
+    return ALGORITHMS[name]
+  except KeyError:
+    raise UnknownAlgorithm('Unknown hash algorithm %r' % name)
+
+
+def make_address(algorithm, digest):
+  return digest if algorithm == DEFAULT_ALGORITHM else '%s:%s' % (algorithm, digest)
+
+
+def parse_address(address):
+  """returns (algorithm, digest) of address"""
+  algorithm, _, digest = address.rpartition(':')
+  return algorithm or DEFAULT_ALGORITHM, digest
+
+
+def hash_file(filename, algorithm=DEFAULT_ALGORITHM):
+  return make_address(algorithm, get_algorithm(algorithm).digest_file(filename))
+
+
+def hash_stream(filelike, algorithm=DEFAULT_ALGORITHM):
+  return make_address(algorithm, get_algorithm(algorithm).digest_stream(filelike))
+
+
+def hash_bytes(data, algorithm=DEFAULT_ALGORITHM):
+  return make_address(algorithm, get_algorithm(algorithm).digest_bytes(data))
+
+
+def verify_file(filename, address):
+  algorithm, digest = parse_address(address)
+  return get_algorithm(algorithm).digest_file(filename) == digest
+
+
+def verify_stream(filelike, address):
+  algorithm, digest = parse_address(address)
+  return get_algorithm(algorithm).digest_stream(filelike) == digest
+
+
+register_algorithm(Algorithm('sha256', hashlib.sha256))
+register_algorithm(Algorithm('sha512', hashlib.sha512))
+register_algorithm(TreeAlgorithm('sha256-tree', hashlib.sha256))
+if blake2b is not None:
+  register_algorithm(Algorithm('blake2b', blake2b))
+  register_algorithm(TreeAlgorithm('blake2b-tree', blake2b))
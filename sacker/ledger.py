@@ -1,5 +1,7 @@
+from itertools import dropwhile, islice, takewhile
 from urlparse import urlparse
 
+from .registry import Registry
 from .util import die
 
 
@@ -8,6 +10,16 @@ class Ledger(object):
   class Exists(Error): pass
   class DoesNotExist(Error): pass
 
+  RESOLVE_CONCURRENCY = 16
+
+  # the URI the ledger was parsed from by parse_ledger, if any.
+  uri = None
+
+  @classmethod
+  def from_uri(cls, uri):
+    uri = urlparse(uri)
+    return cls.from_netloc(uri.netloc, uri.path)
+
   @classmethod
   def from_netloc(cls, netloc, path):
     raise NotImplementedError
@@ -18,21 +30,64 @@ class Ledger(object):
   def list_packages(self):
     raise NotImplementedError
 
-  def list_package_versions(self, package_name):
+  def list_package_versions(self, package_name, start=None, end=None, limit=None, reverse=False):
+    """yields versions of package_name between start and end inclusive, in ascending order or
+    descending order if reverse, stopping after limit versions"""
     raise NotImplementedError
 
   def add(self, package_name, basename, sha, metadata=None):
     raise NotImplementedError
 
+  def put(self, package):
+    """adds package with its version and all of its attributes, e.g. to copy it from another
+    ledger, raises Exists if the version already exists"""
+    raise NotImplementedError
+
   def remove(self, package_name, version):
     raise NotImplementedError
 
+  def remove_many(self, package_name, versions):
+    """removes versions of package_name, in batches where the backend supports it"""
+    for version in versions:
+      self.remove(package_name, version)
+
   def latest(self, package_name):
     raise NotImplementedError
 
+  def previous(self, package_name, version):
+    """returns the version immediately preceding version, or None"""
+    for previous in self.list_package_versions(
+        package_name, end=int(version) - 1, limit=1, reverse=True):
+      return previous
+
   def info(self, package_name, version):
     raise NotImplementedError
 
+  def resolve_many(self, specs):
+    """returns info for each of a list of (package_name, spec) pairs, in the same order, raises
+    DoesNotExist if any of them does not resolve"""
+    from multiprocessing.pool import ThreadPool
+    unique = sorted(set(specs))
+    if len(unique) <= 1:
+      resolved = [self.info(package_name, spec) for package_name, spec in unique]
+    else:
+      pool = ThreadPool(min(len(unique), self.RESOLVE_CONCURRENCY))
+      try:
+        resolved = pool.map(lambda pair: self.info(*pair), unique)
+      finally:
+        pool.close()
+    resolved = dict(zip(unique, resolved))
+    return [resolved[pair] for pair in specs]
+
+  def info_all(self, package_name, **kw):
+    """yields info for every version of package_name, taking list_package_versions arguments"""
+    for version in self.list_package_versions(package_name, **kw):
+      yield self.info(package_name, version)
+
+  def compact(self, package_name):
+    """compacts any per-package index maintained by the ledger"""
+    pass
+
   def tag(self, package_name, version, tag_name):
     raise NotImplementedError
 
@@ -42,12 +97,35 @@ class Ledger(object):
   def tags(self, package_name):
     raise NotImplementedError
 
+  def poll_tag(self, package_name, tag_name, token=None):
+    """returns (changed, version, token) for tag_name, where token is opaque and may be passed to
+    the next poll.  if changed is False, the tag is unchanged since token and version is None."""
+    version = self.info(package_name, tag_name).version
+    return version != token, version, version
+
+  def watch_tag(self, package_name, tag_name, callback, **kw):
+    """calls callback(package_name, tag_name, version) whenever tag_name changes version."""
+    from .watch import TagWatcher
+    TagWatcher(self, **kw).watch([(package_name, tag_name)], callback)
+
+
+def filter_versions(versions, start=None, end=None, limit=None, reverse=False):
+  """applies list_package_versions arguments to ascending versions, for backends that cannot."""
+  if start is not None:
+    versions = dropwhile(lambda version: version < int(start), versions)
+  if end is not None:
+    versions = takewhile(lambda version: version <= int(end), versions)
+  if reverse:
+    versions = reversed(list(versions))
+  return islice(versions, limit)
+
 
-LEDGERS = {}
+LEDGERS = Registry('sacker.ledgers')
 
 
 def register_ledger(name, impl):
-  LEDGERS[name] = impl
+  """impl is either a Ledger subclass or a 'module:attribute' string imported on first use."""
+  LEDGERS.register(name, impl)
 
 
 def unregister_all():
@@ -55,9 +133,13 @@ def unregister_all():
 
 
 def parse_ledger(uri):
-  uri = urlparse(uri)
+  scheme = urlparse(uri).scheme
 
-  if uri.scheme not in LEDGERS:
-    die('Unknown ledger scheme %r' % uri.scheme)
+  try:
+    impl = LEDGERS.get(scheme)
+  except LEDGERS.UnknownScheme:
+    die('Unknown ledger scheme %r' % scheme)
 
-  return LEDGERS[uri.scheme].from_netloc(uri.netloc, uri.path)
+  ledger = impl.from_uri(uri)
+  ledger.uri = uri
+  return ledger
@@ -1,24 +1,76 @@
 import json
-from urlparse import urlparse
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from urlparse import parse_qsl, urlparse
 
 from sacker.ledger import Ledger
 from sacker.package import Package
+from sacker.throttle import AdaptiveThrottle
 
 import boto3
 from boto3.dynamodb.conditions import Attr, Key
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError
 
 # hash_key=<jobkey>/release S; range_key=release# N
 # hash_key=<jobkey>/config S; range_key=config# N
-# get highest hash/range for particular hash key, conditional set new
+# versions are allocated from an atomic per-package counter in the <table>-counters table, then
+# conditionally put.
+
+THROTTLE_ERRORS = frozenset([
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'ThrottlingException',
+])
+TRANSIENT_ERRORS = frozenset([
+    'InternalServerError',
+    'ServiceUnavailable',
+])
+
+
+def is_throttle(error):
+  return isinstance(error, ClientError) and error.response['Error']['Code'] in THROTTLE_ERRORS
+
+
+def is_transient(error):
+  return isinstance(error, ConnectionError) or (
+      isinstance(error, ClientError) and error.response['Error']['Code'] in TRANSIENT_ERRORS)
+
 
 class DynamoLedger(Ledger):
+  FIRST_VERSION = 1
+  MAX_ADD_ATTEMPTS = 8
+  ADD_BACKOFF_SECS = 0.05
+  BATCH_SIZE = 25
+  BATCH_GET_SIZE = 100
+  REMOVE_CONCURRENCY = 8
+
+  # throttles are shared by every ledger of the process, per table, so that they all back off
+  # together when the table is throttled.
+  _THROTTLES = {}
+  _THROTTLES_LOCK = threading.Lock()
+
   @classmethod
   def from_uri(cls, uri):
+    """dynamo://<region>/<table>[?capacity=on-demand|?rcu=N&wcu=N]"""
     uri = urlparse(uri)
     if uri.scheme != 'dynamo':
       raise ValueError('DynamoLedger does not work with %r URIs!' % uri.scheme)
-    return cls.from_netloc(uri.netloc, uri.path)
+    ledger = cls.from_netloc(uri.netloc, uri.path)
+    for key, value in parse_qsl(uri.query):
+      if key == 'capacity':
+        if value != 'on-demand':
+          raise ValueError('Unknown capacity mode %r' % value)
+        ledger.on_demand = True
+      elif key == 'rcu':
+        ledger.read_capacity = int(value)
+      elif key == 'wcu':
+        ledger.write_capacity = int(value)
+      else:
+        raise ValueError('Unknown dynamo ledger option %r' % key)
+    return ledger
 
   @classmethod
   def from_netloc(cls, netloc, path):
@@ -26,63 +78,106 @@ class DynamoLedger(Ledger):
       path = path[1:]
     return cls(netloc, path)
 
-  def __init__(self, region, table):
+  def __init__(self, region, table, endpoint_url=None, on_demand=False, read_capacity=1,
+               write_capacity=1):
     self.region = region
     self.table = table
-    self._conn = None
+    self.endpoint_url = endpoint_url
+    self.on_demand = on_demand
+    self.read_capacity = read_capacity
+    self.write_capacity = write_capacity
+    # boto3 resources are not thread-safe, so each thread gets its own.
+    self._local = threading.local()
 
   @property
   def connection(self):
-    if self._conn is None:
-      self._conn = boto3.resource('dynamodb')
-    return self._conn
+    if getattr(self._local, 'conn', None) is None:
+      # retries are left to the throttle, which needs to see throttled requests to adapt.
+      self._local.conn = boto3.session.Session().resource(
+          'dynamodb', endpoint_url=self.endpoint_url, config=Config(retries={'max_attempts': 0}))
+    return self._local.conn
+
+  def throttle(self, table):
+    key = (self.region, self.endpoint_url, table)
+    with self._THROTTLES_LOCK:
+      if key not in self._THROTTLES:
+        self._THROTTLES[key] = AdaptiveThrottle(is_throttle, is_transient)
+      return self._THROTTLES[key]
+
+  def _call(self, table, operation, **kw):
+    return self.throttle(table).call(getattr(self.connection.Table(table), operation), **kw)
 
   @property
   def tags_table(self):
     return self.table + '-tags'
 
+  @property
+  def counters_table(self):
+    return self.table + '-counters'
+
+  def _create_table(self, table, key_schema, attribute_definitions, capacity):
+    try:
+      boto3.session.Session(region_name=self.region).client(
+          'dynamodb', endpoint_url=self.endpoint_url).create_table(
+          TableName=table,
+          KeySchema=key_schema,
+          AttributeDefinitions=attribute_definitions,
+          **capacity
+      )
+    except ClientError as e:
+      # init creates tables missing from existing ledgers, e.g. the counters table.
+      if e.response['Error']['Code'] != 'ResourceInUseException':
+        raise
+
   def init(self):
+    if self.on_demand:
+      capacity = {'BillingMode': 'PAY_PER_REQUEST'}
+    else:
+      capacity = {
+          'ProvisionedThroughput': {
+              'ReadCapacityUnits': self.read_capacity,
+              'WriteCapacityUnits': self.write_capacity,
+          },
+      }
+
     # create main table
-    attribute_definitions = [
-        {'AttributeName': 'package_name', 'AttributeType': 'S'},
-        {'AttributeName': 'version', 'AttributeType': 'N'},
-    ]
-    key_schema = [
-        {'AttributeName': 'package_name', 'KeyType': 'HASH'},
-        {'AttributeName': 'version', 'KeyType': 'RANGE'},
-    ]
-    provisioned_throughput = {
-        'ReadCapacityUnits': 1,
-        'WriteCapacityUnits': 1
-    }
-    boto3.session.Session(region_name=self.region).client('dynamodb').create_table(
-        TableName=self.table,
-        KeySchema=key_schema,
-        AttributeDefinitions=attribute_definitions,
-        ProvisionedThroughput=provisioned_throughput,
-    )
+    self._create_table(
+        self.table,
+        [
+            {'AttributeName': 'package_name', 'KeyType': 'HASH'},
+            {'AttributeName': 'version', 'KeyType': 'RANGE'},
+        ],
+        [
+            {'AttributeName': 'package_name', 'AttributeType': 'S'},
+            {'AttributeName': 'version', 'AttributeType': 'N'},
+        ],
+        capacity)
 
     # create tags table
-    attribute_definitions = [
-        {'AttributeName': 'package_name', 'AttributeType': 'S'},
-        {'AttributeName': 'tag', 'AttributeType': 'S'},
-    ]
-    key_schema = [
-        {'AttributeName': 'package_name', 'KeyType': 'HASH'},
-        {'AttributeName': 'tag', 'KeyType': 'RANGE'},
-    ]
-    boto3.session.Session(region_name=self.region).client('dynamodb').create_table(
-        TableName=self.tags_table,
-        KeySchema=key_schema,
-        AttributeDefinitions=attribute_definitions,
-        ProvisionedThroughput=provisioned_throughput,
-    )
+    self._create_table(
+        self.tags_table,
+        [
+            {'AttributeName': 'package_name', 'KeyType': 'HASH'},
+            {'AttributeName': 'tag', 'KeyType': 'RANGE'},
+        ],
+        [
+            {'AttributeName': 'package_name', 'AttributeType': 'S'},
+            {'AttributeName': 'tag', 'AttributeType': 'S'},
+        ],
+        capacity)
+
+    # create counters table
+    self._create_table(
+        self.counters_table,
+        [{'AttributeName': 'package_name', 'KeyType': 'HASH'}],
+        [{'AttributeName': 'package_name', 'AttributeType': 'S'}],
+        capacity)
 
   def list_packages(self):
     def iter_packages():
       kw = {}
       while True:
-        response = self.connection.Table(self.table).scan(**kw)
+        response = self._call(self.table, 'scan', **kw)
         for item in response['Items']:
           yield item['package_name']
         if 'LastEvaluatedKey' in response:
@@ -91,68 +186,269 @@ class DynamoLedger(Ledger):
           break
     return list(set(iter_packages()))
 
-  def list_package_versions(self, package_name):
-    response = self.connection.Table(self.table).query(
-        KeyConditionExpression=Key('package_name').eq(package_name))
-    for item in response['Items']:
-      yield int(item['version'])
+  def list_package_versions(self, package_name, start=None, end=None, limit=None, reverse=False):
+    return self._query_versions(package_name, start, end, limit, reverse,
+        lambda item: int(item['version']))
+
+  def _query_versions(self, package_name, start, end, limit, reverse, transform):
+    first = self.FIRST_VERSION
+    start = first if start is None else max(int(start), first)
+    condition = Key('package_name').eq(package_name)
+    if end is None:
+      condition &= Key('version').gte(start)
+    elif int(end) < start:
+      return
+    else:
+      condition &= Key('version').between(start, int(end))
+
+    kw = {'KeyConditionExpression': condition, 'ScanIndexForward': not reverse}
+    remaining = limit
+    while remaining is None or remaining > 0:
+      if remaining is not None:
+        kw['Limit'] = remaining
+      response = self._call(self.table, 'query', **kw)
+      for item in response['Items']:
+        yield transform(item)
+      if remaining is not None:
+        remaining -= len(response['Items'])
+      if 'LastEvaluatedKey' not in response:
+        break
+      kw['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+  def _allocate_version(self, package_name):
+    try:
+      response = self._call(self.counters_table, 'update_item',
+          Key={'package_name': package_name},
+          UpdateExpression='ADD next_version :one',
+          ExpressionAttributeValues={':one': 1},
+          ReturnValues='UPDATED_NEW',
+      )
+    except ClientError as e:
+      if e.response['Error']['Code'] == 'ResourceNotFoundException':
+        raise self.Error('Table %s does not exist, run "sacker init" to create it.' % (
+            self.counters_table))
+      raise
+    return int(response['Attributes']['next_version'])
+
+  def _advance_counter(self, package_name, latest=None):
+    # packages added before versions were allocated from a counter, or with put, need it advanced
+    # past the latest existing version.
+    latest = self.latest(package_name) if latest is None else latest
+    if latest is None:
+      return
+    try:
+      self._call(self.counters_table, 'update_item',
+          Key={'package_name': package_name},
+          UpdateExpression='SET next_version = :latest',
+          ConditionExpression=Attr('next_version').not_exists() | Attr('next_version').lt(latest),
+          ExpressionAttributeValues={':latest': latest},
+      )
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        raise
 
   def add(self, package_name, basename, sha, mode, metadata=None):
-    latest = self.latest(package_name)
-    new_latest = latest + 1 if latest is not None else 1
+    for attempt in range(self.MAX_ADD_ATTEMPTS):
+      version = self._allocate_version(package_name)
+      try:
+        self._call(self.table, 'put_item',
+            Item={
+                'package_name': package_name,
+                'version': version,
+                'basename': basename,
+                'sha': sha,
+                'mode': mode,
+                'metadata': json.dumps(metadata),
+                'timestamp': int(time.time()),
+            },
+            ConditionExpression=Attr('version').not_exists()
+        )
+        return version
+      except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+          raise self.Error('Failed to add version: %s' % e)
+      self._advance_counter(package_name)
+      time.sleep(random.uniform(0, self.ADD_BACKOFF_SECS * 2 ** attempt))
 
+    raise self.Error('Failed to add version of %s after %d attempts.' % (
+        package_name, self.MAX_ADD_ATTEMPTS))
+
+  def put(self, package):
     try:
-      self.connection.Table(self.table).put_item(
+      self._call(self.table, 'put_item',
           Item={
-              'package_name': package_name,
-              'version': new_latest,
-              'basename': basename,
-              'sha': sha,
-              'mode': mode,
-              'metadata': json.dumps(metadata),
+              'package_name': package.name,
+              'version': int(package.version),
+              'basename': package.basename,
+              'sha': package.sha,
+              'mode': package.mode,
+              'metadata': json.dumps(package.metadata),
+              'timestamp': int(package.timestamp if package.timestamp is not None else time.time()),
           },
-          ConditionExpression=Attr('package_name').ne(package_name) & Attr('version').ne(new_latest)
+          ConditionExpression=Attr('version').not_exists()
       )
     except ClientError as e:
-      raise self.Error('Failed to add version, possible dynamo race condition: %s' % e)
-
-    return new_latest
+      if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+        raise self.Exists('Package %s already has version %d' % (package.name, package.version))
+      raise
+    self._advance_counter(package.name, latest=int(package.version))
 
   def remove(self, package_name, version):
-    raise NotImplementedError
+    try:
+      self._call(self.table, 'delete_item',
+          Key={'package_name': package_name, 'version': int(version)},
+          ConditionExpression=Attr('version').exists(),
+      )
+    except ClientError as e:
+      if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+        raise self.DoesNotExist('Package %s has no version %s' % (package_name, version))
+      raise
+
+  def remove_many(self, package_name, versions):
+    def write_batch(batch):
+      with self.connection.Table(self.table).batch_writer() as writer:
+        for version in batch:
+          writer.delete_item(Key={'package_name': package_name, 'version': int(version)})
+
+    def remove_batch(batch):
+      # deletes are idempotent, so a throttled batch can be written again in full.
+      self.throttle(self.table).call(write_batch, batch)
+
+    versions = list(versions)
+    batches = [versions[k:k + self.BATCH_SIZE] for k in range(0, len(versions), self.BATCH_SIZE)]
+    if len(batches) <= 1:
+      for batch in batches:
+        remove_batch(batch)
+      return
+    pool = ThreadPool(min(len(batches), self.REMOVE_CONCURRENCY))
+    try:
+      pool.map(remove_batch, batches)
+    finally:
+      pool.close()
 
   def latest(self, package_name):
-    versions = sorted(self.list_package_versions(package_name))
-    return max(versions) if versions else None
+    for version in self.list_package_versions(package_name, limit=1, reverse=True):
+      return version
 
   def _get_version(self, package_name, spec):
     if spec == 'latest':
       return self.latest(package_name)
     try:
-      return int(spec)
+      version = int(spec)
     except ValueError:
       return self._get_tag(package_name, spec)
+    return version if version >= self.FIRST_VERSION else None
 
   def info(self, package_name, spec):
     version = self._get_version(package_name, spec)
     if version is None:
       raise self.DoesNotExist('Package %s has no version %s' % (package_name, spec))
-    resp = self.connection.Table(self.table).get_item(
+    resp = self._call(self.table, 'get_item',
         Key={'package_name': package_name, 'version': version})
     if 'Item' not in resp:
       raise self.DoesNotExist('Package %s has no version %s' % (package_name, spec))
-    item = resp['Item']
+    return self._package_from_item(package_name, resp['Item'])
+
+  def _package_from_item(self, package_name, item):
     return Package(
         package_name,
-        version,
+        int(item['version']),
         item['sha'],
         item['basename'],
         int(item['mode']),
         json.loads(item['metadata']),
+        timestamp=int(item['timestamp']) if 'timestamp' in item else None,
     )
 
+  def info_all(self, package_name, start=None, end=None, limit=None, reverse=False):
+    # the version query returns whole items, so there is no need to get each version.
+    return self._query_versions(package_name, start, end, limit, reverse,
+        lambda item: self._package_from_item(package_name, item))
+
+  def _batch_get(self, table, keys):
+    """returns the items of table with keys, in no particular order."""
+    items = []
+    for k in range(0, len(keys), self.BATCH_GET_SIZE):
+      request = {table: {'Keys': keys[k:k + self.BATCH_GET_SIZE]}}
+      while request:
+        response = self.throttle(table).call(
+            self.connection.batch_get_item, RequestItems=request)
+        items.extend(response['Responses'].get(table, ()))
+        request = response.get('UnprocessedKeys')
+        if request:
+          # unprocessed keys are how batch reads are throttled.
+          self.throttle(table).throttled()
+    return items
+
+  def _counters(self, package_names):
+    """returns the last version allocated by the counter of each of package_names that has one."""
+    try:
+      items = self._batch_get(
+          self.counters_table, [{'package_name': name} for name in package_names])
+    except ClientError as e:
+      # ledgers created before the counters table have no counters yet.
+      if e.response['Error']['Code'] != 'ResourceNotFoundException':
+        raise
+      return {}
+    return dict((item['package_name'], int(item['next_version'])) for item in items)
+
+  def _batch_get_packages(self, keys):
+    return dict(
+        ((item['package_name'], int(item['version'])),
+         self._package_from_item(item['package_name'], item))
+        for item in self._batch_get(
+            self.table, [{'package_name': name, 'version': version} for name, version in keys]))
+
+  def resolve_many(self, specs):
+    versions = {}
+    tags = set()
+    latest = set()
+    for package_name, spec in set(specs):
+      if spec == 'latest':
+        latest.add(package_name)
+        continue
+      try:
+        version = int(spec)
+      except ValueError:
+        tags.add((package_name, spec))
+      else:
+        versions[(package_name, spec)] = version if version >= self.FIRST_VERSION else None
+
+    # resolve all tags and counters, then all versions, with one batch get per 100 keys.
+    for item in self._batch_get(
+        self.tags_table, [{'package_name': name, 'tag': tag} for name, tag in tags]):
+      versions[(item['package_name'], item['tag'])] = int(item['version'])
+    counters = self._counters(latest)
+
+    keys = set((name, version) for (name, _), version in versions.items() if version is not None)
+    for name, counter in counters.items():
+      keys.update([(name, counter), (name, counter + 1)])
+    packages = self._batch_get_packages(keys)
+
+    # "latest" is the version last allocated by the counter, unless that version was removed or
+    # never put, or the counter is behind because an older client added the next version.  those
+    # packages fall back to querying their latest version.
+    unresolved = []
+    for name in latest:
+      counter = counters.get(name)
+      if (name, counter) in packages and (name, counter + 1) not in packages:
+        versions[(name, 'latest')] = counter
+      else:
+        versions[(name, 'latest')] = self.latest(name)
+        unresolved.append((name, versions[(name, 'latest')]))
+    packages.update(self._batch_get_packages(
+        [key for key in unresolved if key[1] is not None and key not in packages]))
+
+    resolved = []
+    for package_name, spec in specs:
+      package = packages.get((package_name, versions.get((package_name, spec))))
+      if package is None:
+        raise self.DoesNotExist('Package %s has no version %s' % (package_name, spec))
+      resolved.append(package)
+    return resolved
+
   def _get_tag(self, package_name, tag_name):
-    resp = self.connection.Table(self.tags_table).get_item(
+    resp = self._call(self.tags_table, 'get_item',
         Key={'package_name': package_name, 'tag': tag_name}
     )
     if 'Item' in resp:
@@ -160,10 +456,16 @@ class DynamoLedger(Ledger):
     else:
       raise self.Error('Tag %s does not exist for %s' % (tag_name, package_name))
 
+  def poll_tag(self, package_name, tag_name, token=None):
+    version = self._get_version(package_name, tag_name)
+    if version is None:
+      raise self.DoesNotExist('Package %s has no tag %s' % (package_name, tag_name))
+    return version != token, version, version
+
   def tag(self, package_name, version, tag_name):
     if tag_name == 'latest':
       raise self.Error('Cannot alter dynamic tag "latest" for Dynamo ledger.')
-    self.connection.Table(self.tags_table).put_item(
+    self._call(self.tags_table, 'put_item',
         Item={
             'package_name': package_name,
             'tag': tag_name,
@@ -174,7 +476,7 @@ class DynamoLedger(Ledger):
   def untag(self, package_name, tag_name):
     if tag_name == 'latest':
       raise self.Error('Cannot alter dynamic tag "latest" for Dynamo ledger.')
-    self.connection.Table(self.tags_table).delete_item(
+    self._call(self.tags_table, 'delete_item',
         Key={
             'package_name': package_name,
             'tag': tag_name,
@@ -182,7 +484,7 @@ class DynamoLedger(Ledger):
     )
 
   def tags(self, package_name):
-    resp = self.connection.Table(self.tags_table).query(
+    resp = self._call(self.tags_table, 'query',
         KeyConditionExpression=Key('package_name').eq(package_name))
     latest = self.latest(package_name)
     if latest is not None:
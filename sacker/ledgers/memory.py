@@ -0,0 +1,161 @@
+import os
+import threading
+import time
+from urlparse import urlparse
+
+from sacker.ledger import Ledger, filter_versions
+from sacker.package import Package
+from sacker.simulate import Simulator
+
+
+class MemoryLedgerState(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.packages = {}
+
+  def package(self, package_name):
+    return self.packages.setdefault(
+        package_name, {'next_version': 1, 'versions': {}, 'tags': {}})
+
+
+class MemoryLedger(Ledger):
+  """Ledger held in memory, shared by every ledger with the same name in the process.
+
+  Each method makes one simulated round trip, see sacker.simulate.
+  """
+
+  _STATES = {}
+  _STATES_LOCK = threading.Lock()
+
+  @classmethod
+  def from_uri(cls, uri):
+    uri = urlparse(uri)
+    return cls(uri.netloc, Simulator.from_query(uri.query))
+
+  @classmethod
+  def from_netloc(cls, netloc, path):
+    return cls(netloc)
+
+  @classmethod
+  def reset_all(cls):
+    with cls._STATES_LOCK:
+      cls._STATES.clear()
+
+  def __init__(self, name='', simulator=None):
+    self.name = name
+    self.simulator = simulator or Simulator()
+    with self._STATES_LOCK:
+      self._state = self._STATES.setdefault(name, MemoryLedgerState())
+
+  @property
+  def stats(self):
+    return self.simulator.stats
+
+  def _call(self, operation):
+    self.simulator(operation, self.Error)
+
+  def list_packages(self):
+    self._call('list_packages')
+    with self._state.lock:
+      return sorted(name for name, package in self._state.packages.items() if package['versions'])
+
+  def list_package_versions(self, package_name, start=None, end=None, limit=None, reverse=False):
+    self._call('list_package_versions')
+    with self._state.lock:
+      versions = sorted(self._state.package(package_name)['versions'])
+    return filter_versions(versions, start, end, limit, reverse)
+
+  def add(self, package_name, filename, sha, mode, metadata=None):
+    self._call('add')
+    with self._state.lock:
+      package = self._state.package(package_name)
+      version = package['next_version']
+      package['next_version'] += 1
+      package['versions'][version] = Package(
+          package_name, version, sha, os.path.basename(filename), mode, dict(metadata or {}),
+          timestamp=time.time())
+    return version
+
+  def put(self, package):
+    self._call('put')
+    with self._state.lock:
+      entry = self._state.package(package.name)
+      if package.version in entry['versions']:
+        raise self.Exists('Package %s already has version %d' % (package.name, package.version))
+      entry['versions'][package.version] = package
+      entry['next_version'] = max(entry['next_version'], package.version + 1)
+
+  def remove(self, package_name, version):
+    self.remove_many(package_name, [version])
+
+  def remove_many(self, package_name, versions):
+    self._call('remove_many')
+    with self._state.lock:
+      package = self._state.package(package_name)
+      for version in versions:
+        if package['versions'].pop(int(version), None) is None:
+          raise self.DoesNotExist('Package %s has no version %s' % (package_name, version))
+
+  def _get_version(self, package, package_name, spec):
+    if spec == 'latest':
+      return max(package['versions']) if package['versions'] else None
+    try:
+      return int(spec)
+    except ValueError:
+      try:
+        return package['tags'][spec]
+      except KeyError:
+        raise self.DoesNotExist('Package %s has no tag %r' % (package_name, spec))
+
+  def latest(self, package_name):
+    try:
+      return self.info(package_name, 'latest').version
+    except self.DoesNotExist:
+      return None
+
+  def info(self, package_name, spec):
+    self._call('info')
+    with self._state.lock:
+      package = self._state.package(package_name)
+      version = self._get_version(package, package_name, spec)
+      try:
+        return package['versions'][version]
+      except KeyError:
+        raise self.DoesNotExist('Package %s has no version %s' % (package_name, spec))
+
+  def resolve_many(self, specs):
+    self._call('resolve_many')
+    resolved = []
+    with self._state.lock:
+      for package_name, spec in specs:
+        package = self._state.package(package_name)
+        version = self._get_version(package, package_name, spec)
+        try:
+          resolved.append(package['versions'][version])
+        except KeyError:
+          raise self.DoesNotExist('Package %s has no version %s' % (package_name, spec))
+    return resolved
+
+  def poll_tag(self, package_name, tag_name, token=None):
+    version = self.info(package_name, tag_name).version
+    return version != token, version, version
+
+  def tag(self, package_name, version, tag_name):
+    if tag_name == 'latest':
+      raise self.Error('Cannot alter dynamic tag "latest" for memory ledger.')
+    self._call('tag')
+    with self._state.lock:
+      self._state.package(package_name)['tags'][tag_name] = int(version)
+
+  def untag(self, package_name, tag_name):
+    if tag_name == 'latest':
+      raise self.Error('Cannot alter dynamic tag "latest" for memory ledger.')
+    self._call('untag')
+    with self._state.lock:
+      self._state.package(package_name)['tags'].pop(tag_name, None)
+
+  def tags(self, package_name):
+    self._call('tags')
+    with self._state.lock:
+      package = self._state.package(package_name)
+      return (['latest'] if package['versions'] else []) + sorted(package['tags'])
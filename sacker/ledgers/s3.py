@@ -1,21 +1,56 @@
 import json
 import os
+import threading
 import time
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 
-from sacker.ledger import Ledger
+from sacker.ledger import Ledger, filter_versions
 from sacker.package import Package
 
 import boto3
 from botocore.exceptions import ClientError
 
 
+# conditional PutObject parameters, which botocore releases that still run on python 2 do not
+# know of, and which are sent as the headers S3 takes them as instead.
+CONDITIONAL_HEADERS = {'IfMatch': 'If-Match', 'IfNoneMatch': 'If-None-Match'}
+
+
+def stash_conditions(params, context, **kw):
+  for param in CONDITIONAL_HEADERS:
+    if param in params:
+      context.setdefault('sacker_conditions', {})[param] = params.pop(param)
+
+
+def send_conditions(params, context, **kw):
+  for param, value in context.get('sacker_conditions', {}).items():
+    params['headers'][CONDITIONAL_HEADERS[param]] = value
+
+
+def is_conflict(error):
+  """returns True if a conditional write failed because the object was written concurrently."""
+  return error.response['Error']['Code'] in (
+      '409', '412', 'ConditionalRequestConflict', 'PreconditionFailed')
+
+
 class S3Ledger(Ledger):
   """Ledger based on S3, which is compatible with write-only clients e.g. CI"""
 
   PAGE_SIZE = 100
   TAG_SEPARATOR = 'tags'
   VERSION_SEPARATOR = 'versions'
+  INDEX_NAME = 'index.json'
+
+  # once a package has a compacted index, reads compact it again if this many versions have been
+  # added since.
+  COMPACTION_THRESHOLD = 100
+  COMPACTION_CONCURRENCY = 16
+  DELETE_BATCH_SIZE = 1000
+  # reverse listings of packages with more versions than fit in a single listing page scan bands
+  # of versions below the end, starting with an hour of timestamps and doubling each band.
+  REVERSE_BAND_WIDTH = 3600 * 1000
 
   @classmethod
   def from_uri(cls, uri):
@@ -32,26 +67,224 @@ class S3Ledger(Ledger):
 
   def __init__(self, bucket_name):
     self.bucket_name = bucket_name
+    self._conn = None
+    self._conn_lock = threading.Lock()
+
+  @property
+  def connection(self):
+    # clients are thread-safe and reused across calls so that connections are kept alive.
+    with self._conn_lock:
+      if self._conn is None:
+        self._conn = boto3.session.Session().client('s3')
+        self._conn.meta.events.register('before-parameter-build.s3.PutObject', stash_conditions)
+        self._conn.meta.events.register('before-call.s3.PutObject', send_conditions)
+    return self._conn
 
   def init(self):
-    boto3.client('s3').create_bucket(Bucket=self.bucket_name)
+    self.connection.create_bucket(Bucket=self.bucket_name)
+
+  def _list_keys(self, prefix=''):
+    paginator = self.connection.get_paginator('list_objects_v2')
+    for page in paginator.paginate(
+        Bucket=self.bucket_name, Prefix=prefix, PaginationConfig={'PageSize': self.PAGE_SIZE}):
+      for obj in page.get('Contents', ()):
+        yield obj['Key']
 
   def list_packages(self):
-    bucket = boto3.resource('s3').Bucket(self.bucket_name)
     # Restrict to packages with linked 'latest' tags.
     latest_suffix = '/%s/latest' % self.TAG_SEPARATOR
-    for obj in bucket.objects.page_size(self.PAGE_SIZE):
-      if obj.key.endswith(latest_suffix):
-        yield obj.key[:-len(latest_suffix)]
+    for key in self._list_keys():
+      if key.endswith(latest_suffix):
+        yield key[:-len(latest_suffix)]
+
+  def _version_key(self, package_name, version):
+    # versions added here are always 13 digit millisecond timestamps, but versions copied from
+    # other ledgers with put may be shorter and are padded to keep listings in version order.
+    return '%s/%s/%013d' % (package_name, self.VERSION_SEPARATOR, int(version))
+
+  def _index_key(self, package_name):
+    return '%s/%s' % (package_name, self.INDEX_NAME)
+
+  def _list_versions(self, package_name, start_after=None, end=None):
+    kw = {
+        'Bucket': self.bucket_name,
+        'Prefix': '%s/%s/' % (package_name, self.VERSION_SEPARATOR),
+    }
+    if start_after is not None:
+      kw['StartAfter'] = self._version_key(package_name, start_after)
+    # version keys are fixed-width timestamps, so lexicographic order is version order.
+    for page in self.connection.get_paginator('list_objects_v2').paginate(**kw):
+      for obj in page.get('Contents', ()):
+        version = int(obj['Key'].split('/')[-1])
+        if end is not None and version > end:
+          return
+        yield version
+
+  def _list_versions_reverse(self, package_name, start=None, end=None):
+    """yields versions from end down to start in descending order.  S3 only lists in ascending
+    order, so bands of versions below end are listed in turn until enough have been yielded."""
+    response = self.connection.list_objects_v2(
+        Bucket=self.bucket_name, Prefix='%s/%s/' % (package_name, self.VERSION_SEPARATOR))
+    if not response.get('IsTruncated'):
+      versions = [int(obj['Key'].split('/')[-1]) for obj in response.get('Contents', ())]
+      for version in reversed(versions):
+        if (end is None or version <= end) and (start is None or version >= start):
+          yield version
+      return
+
+    # every version yielded is above floor.
+    floor = start - 1 if start else -1
+    upper = end
+    width = self.REVERSE_BAND_WIDTH
+    while True:
+      # each band holds the versions above lower, up to and including upper.
+      lower = max((int(time.time() * 1000) if upper is None else upper) - width, floor)
+      band = list(self._list_versions(
+          package_name, start_after=lower if lower >= 0 else None, end=upper))
+      for version in reversed(band):
+        yield version
+      if lower <= floor:
+        return
+      upper = lower
+      width *= 2
+
+  def _read_index_and_etag(self, package_name):
+    """returns (index, etag) of the compacted index of package_name, or (None, None) if it has
+    none."""
+    try:
+      response = self.connection.get_object(
+          Bucket=self.bucket_name, Key=self._index_key(package_name))
+    except ClientError:
+      return None, None
+    return json.loads(response['Body'].read()), response['ETag']
+
+  def _read_index(self, package_name):
+    """returns the compacted index of package_name, or None if it has none."""
+    return self._read_index_and_etag(package_name)[0]
+
+  def _indexed_versions(self, package_name, index=None):
+    """returns (index, versions) where versions includes versions added since compaction."""
+    index = index or self._read_index(package_name)
+    if index is None:
+      return None, list(self._list_versions(package_name))
+    tail = list(self._list_versions(package_name, start_after=index['high_water']))
+    if len(tail) >= self.COMPACTION_THRESHOLD:
+      try:
+        index = self.compact(package_name)
+        tail = list(self._list_versions(package_name, start_after=index['high_water']))
+      except ClientError:
+        # read-only clients cannot compact.
+        pass
+    return index, sorted(map(int, index['versions'])) + tail
 
   # TODO(wickman) More input validation
-  def list_package_versions(self, package_name):
-    bucket = boto3.resource('s3').Bucket(self.bucket_name)
-    object_iterator = bucket.objects.filter(
-        Prefix='%s/%s/' % (package_name, self.VERSION_SEPARATOR)
-    ).page_size(self.PAGE_SIZE)
-    for obj in object_iterator:
-      yield int(obj.key.split('/')[-1])
+  def list_package_versions(self, package_name, start=None, end=None, limit=None, reverse=False):
+    start = int(start) if start is not None else None
+    end = int(end) if end is not None else None
+    index = self._read_index(package_name)
+    if index is not None:
+      # the index holds every version up to its high water mark in one object.
+      _, versions = self._indexed_versions(package_name, index=index)
+      return filter_versions(versions, start=start, end=end, limit=limit, reverse=reverse)
+    if reverse:
+      return islice(self._list_versions_reverse(package_name, start=start, end=end), limit)
+    # stream the listing, starting after the version preceding start.
+    versions = self._list_versions(
+        package_name, start_after=start - 1 if start else None, end=end)
+    return islice(versions, limit)
+
+  def info_all(self, package_name, **kw):
+    index, versions = self._indexed_versions(package_name)
+    versions = list(filter_versions(versions, **kw))
+    indexed = index['versions'] if index else {}
+    missing = [version for version in versions if str(version) not in indexed]
+    fetched = dict(zip(missing, self._read_versions(package_name, missing)))
+    for version in versions:
+      if version in fetched:
+        yield fetched[version]
+      else:
+        yield self._package_from_index(package_name, version, indexed[str(version)])
+
+  def _package_from_index(self, package_name, version, entry):
+    return Package(
+        package_name,
+        version,
+        entry['sha'],
+        entry['basename'],
+        entry['mode'],
+        entry['metadata'],
+        timestamp=entry.get('timestamp') or version / 1000.0,
+    )
+
+  def _read_versions(self, package_name, versions, skip_missing=False):
+    """returns info for each of versions.  with skip_missing, versions removed since they were
+    listed, e.g. by a concurrent prune, are left out rather than raising DoesNotExist."""
+    def read(version):
+      try:
+        return self.info(package_name, version)
+      except self.DoesNotExist:
+        if not skip_missing:
+          raise
+
+    if len(versions) <= 1:
+      packages = [read(version) for version in versions]
+    else:
+      pool = ThreadPool(min(len(versions), self.COMPACTION_CONCURRENCY))
+      try:
+        packages = pool.map(read, versions)
+      finally:
+        pool.close()
+    return [package for package in packages if package is not None]
+
+  def compact(self, package_name):
+    """merge versions and tags added since the last compaction into the package index."""
+    def merge(index):
+      index = index or {'high_water': None, 'versions': {}, 'tags': {}}
+      tail = list(self._list_versions(package_name, start_after=index['high_water']))
+      for package in self._read_versions(package_name, tail, skip_missing=True):
+        index['versions'][str(package.version)] = self._index_entry(package)
+      if index['versions']:
+        index['high_water'] = max(map(int, index['versions']))
+      # tags are always listed from their own objects, which stay current without compaction.
+      # the copy in the index is only kept up to date for older clients that read tags from it.
+      index['tags'] = dict(
+          (tag_name, self._resolve_tag(package_name, tag_name))
+          for tag_name in self._list_tags(package_name) if tag_name != 'latest')
+      return index
+
+    return self._update_index(package_name, merge)
+
+  def _index_entry(self, package):
+    return {
+        'sha': package.sha,
+        'basename': package.basename,
+        'mode': package.mode,
+        'metadata': package.metadata,
+        'timestamp': package.timestamp,
+    }
+
+  def _update_index(self, package_name, update):
+    """replaces the index of package_name with update(index), where index is None if there is no
+    index yet, unless update returns None.  the index is only written if it has not changed since
+    it was read, and is otherwise read and updated again, so that concurrent updates are never
+    lost.  returns the index written, or None."""
+    while True:
+      index, etag = self._read_index_and_etag(package_name)
+      index = update(index)
+      if index is None:
+        return None
+      conditions = {'IfMatch': etag} if etag is not None else {'IfNoneMatch': '*'}
+      try:
+        self.connection.put_object(
+            Bucket=self.bucket_name,
+            Key=self._index_key(package_name),
+            Body=json.dumps(index),
+            **conditions)
+      except ClientError as e:
+        if not is_conflict(e):
+          raise
+        continue
+      return index
 
   def _make_timestamp(self):
     # micro-ts
@@ -63,9 +296,8 @@ class S3Ledger(Ledger):
         'basename': os.path.basename(filename),
         'mode': mode,
     }
-    s3 = boto3.client('s3')
     timestamp = self._make_timestamp()
-    s3.put_object(
+    self.connection.put_object(
         Bucket=self.bucket_name,
         Key='%s/%s/%s' % (package_name, self.VERSION_SEPARATOR, timestamp),
         Metadata=metadata or {},
@@ -74,14 +306,88 @@ class S3Ledger(Ledger):
     self.tag(package_name, timestamp, 'latest')
     return timestamp
 
+  def put(self, package):
+    key = self._version_key(package.name, package.version)
+    try:
+      self.connection.head_object(Bucket=self.bucket_name, Key=key)
+    except ClientError:
+      pass
+    else:
+      raise self.Exists('Package %s already has version %d' % (package.name, package.version))
+    self.connection.put_object(
+        Bucket=self.bucket_name,
+        Key=key,
+        Metadata=package.metadata or {},
+        Body=json.dumps({
+            'sha': package.sha,
+            'basename': package.basename,
+            'mode': package.mode,
+            'timestamp': package.timestamp,
+        }),
+    )
+    # versions at or below the high water mark of the index are not picked up by compaction.
+    def insert(index):
+      if index is None or index['high_water'] is None or package.version > index['high_water']:
+        return None
+      index['versions'][str(package.version)] = self._index_entry(package)
+      return index
+
+    self._update_index(package.name, insert)
+    latest = self.latest(package.name)
+    if latest is None or package.version > latest:
+      self.tag(package.name, package.version, 'latest')
+
   def remove(self, package_name, version):
-    pass
+    try:
+      self.connection.head_object(
+          Bucket=self.bucket_name, Key=self._version_key(package_name, version))
+    except ClientError:
+      raise self.DoesNotExist('Package %s has no version %s' % (package_name, version))
+    self.remove_many(package_name, [version])
+
+  def remove_many(self, package_name, versions):
+    versions = [int(version) for version in versions]
+    keys = [{'Key': self._version_key(package_name, version)} for version in versions]
+    batches = [
+        keys[k:k + self.DELETE_BATCH_SIZE] for k in range(0, len(keys), self.DELETE_BATCH_SIZE)]
+
+    def delete_batch(batch):
+      self.connection.delete_objects(
+          Bucket=self.bucket_name, Delete={'Objects': batch, 'Quiet': True})
+
+    if len(batches) > 1:
+      pool = ThreadPool(min(len(batches), self.COMPACTION_CONCURRENCY))
+      try:
+        pool.map(delete_batch, batches)
+      finally:
+        pool.close()
+    else:
+      for batch in batches:
+        delete_batch(batch)
+
+    def drop(index):
+      indexed = [version for version in versions if index and str(version) in index['versions']]
+      if not indexed:
+        return None
+      for version in indexed:
+        del index['versions'][str(version)]
+      return index
+
+    self._update_index(package_name, drop)
+
+    # repoint "latest" if it was removed.
+    if self.latest(package_name) in versions:
+      for latest in self.list_package_versions(package_name, limit=1, reverse=True):
+        self.tag(package_name, latest, 'latest')
+        break
+      else:
+        self.untag(package_name, 'latest')
 
   def _resolve_tag(self, package_name, tag_name):
     try:
-      tag_info = (boto3.resource('s3')
-          .Bucket(self.bucket_name)
-          .Object('%s/%s/%s' % (package_name, self.TAG_SEPARATOR, tag_name))).get()
+      tag_info = self.connection.get_object(
+          Bucket=self.bucket_name,
+          Key='%s/%s/%s' % (package_name, self.TAG_SEPARATOR, tag_name))
     except ClientError:
       raise self.DoesNotExist('Package %s has no tag %r' % (package_name, tag_name))
     tag_info = json.loads(tag_info['Body'].read())
@@ -96,16 +402,14 @@ class S3Ledger(Ledger):
   def latest(self, package_name):
     try:
       return self._resolve_tag(package_name, 'latest')
-    except ValueError:
+    except (ValueError, self.DoesNotExist):
       return None
 
   def info(self, package_name, spec):
     version = self._get_version(package_name, spec)
     try:
-      package_info = (boto3.resource('s3')
-          .Bucket(self.bucket_name)
-          .Object('%s/%s/%s' % (package_name, self.VERSION_SEPARATOR, version))
-      ).get()
+      package_info = self.connection.get_object(
+          Bucket=self.bucket_name, Key=self._version_key(package_name, version))
     except ClientError:
       raise self.DoesNotExist('Package %s has no version %d' % (package_name, version))
     package_content = json.loads(package_info['Body'].read())
@@ -116,14 +420,29 @@ class S3Ledger(Ledger):
         package_content['basename'],
         package_content['mode'],
         package_info['Metadata'],
+        timestamp=package_content.get('timestamp') or version / 1000.0,
     )
 
+  def poll_tag(self, package_name, tag_name, token=None):
+    kw = {
+        'Bucket': self.bucket_name,
+        'Key': '%s/%s/%s' % (package_name, self.TAG_SEPARATOR, tag_name),
+    }
+    if token is not None:
+      kw['IfNoneMatch'] = token
+    try:
+      response = self.connection.get_object(**kw)
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('304', 'NotModified'):
+        return False, None, token
+      raise self.DoesNotExist('Package %s has no tag %r' % (package_name, tag_name))
+    return True, int(json.loads(response['Body'].read())['version']), response['ETag']
+
   def tag(self, package_name, version, tag_name):
     if '/' in tag_name:
       raise self.Error('S3 ledger does not support "/" in tag names.')
     json_blob = {'version': version}
-    s3 = boto3.client('s3')
-    s3.put_object(
+    self.connection.put_object(
         Bucket=self.bucket_name,
         Key='%s/%s/%s' % (package_name, self.TAG_SEPARATOR, tag_name),
         Body=json.dumps(json_blob)
@@ -132,16 +451,16 @@ class S3Ledger(Ledger):
   def untag(self, package_name, tag_name):
     if '/' in tag_name:
       raise self.Error('S3 ledger does not support "/" in tag names.')
-    s3 = boto3.client('s3')
-    s3.delete_object(
+    self.connection.delete_object(
         Bucket=self.bucket_name,
         Key='%s/%s/%s' % (package_name, self.TAG_SEPARATOR, tag_name),
     )
 
   def tags(self, package_name):
-    bucket = boto3.resource('s3').Bucket(self.bucket_name)
-    object_iterator = bucket.objects.filter(
-        Prefix='%s/%s/' % (package_name, self.TAG_SEPARATOR)
-    ).page_size(self.PAGE_SIZE)
-    for obj in object_iterator:
-      yield obj.key.split('/')[-1]
+    # "latest" is only listed while the package has versions, since removing the last version
+    # deletes it.
+    return self._list_tags(package_name)
+
+  def _list_tags(self, package_name):
+    for key in self._list_keys('%s/%s/' % (package_name, self.TAG_SEPARATOR)):
+      yield key.split('/')[-1]
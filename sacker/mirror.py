@@ -0,0 +1,175 @@
+"""Incremental replication of a ledger and store to another pair.
+
+Each run copies the versions of every package added since the previous run,
+the blobs they reference that the target store does not have yet, and any tags
+that changed.  The highest mirrored version and the mirrored tags of each
+package are kept in a state file, so that a run only reads what is new from
+the source and only writes changes to the target.  Blobs are always copied
+before the versions that reference them and the state is only advanced once a
+package is fully copied, so an interrupted run is resumed by the next one.
+Package blobs are verified against their sha as they are read from the source,
+and a package with a corrupt blob is not mirrored until the source is fixed.
+"""
+
+import json
+import os
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from .archive import index_name
+from .delta import delta_name
+from .hashing import verify_stream
+from .util import TeeReader, safe_mkdir, warn
+
+
+# blobs are spooled in memory up to this size while they are verified, before spilling to disk.
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+class MirrorError(Exception): pass
+
+
+class MirrorState(object):
+  def __init__(self, filename):
+    self.filename = filename
+    try:
+      with open(filename) as fp:
+        self.packages = json.load(fp)
+    except IOError:
+      self.packages = {}
+
+  def get(self, package_name):
+    return self.packages.get(package_name, {'high_water': 0, 'tags': {}})
+
+  def update(self, package_name, high_water, tags):
+    self.packages[package_name] = {'high_water': high_water, 'tags': tags}
+    safe_mkdir(os.path.dirname(self.filename) or '.')
+    temporary = self.filename + '.tmp'
+    with open(temporary, 'w') as fp:
+      json.dump(self.packages, fp, sort_keys=True)
+    os.rename(temporary, self.filename)
+
+
+class Mirror(object):
+  CONCURRENCY = 8
+
+  def __init__(self, source_ledger, source_store, target_ledger, target_store, state,
+               concurrency=CONCURRENCY):
+    self.source_ledger = source_ledger
+    self.source_store = source_store
+    self.target_ledger = target_ledger
+    self.target_store = target_store
+    self.state = state
+    self.concurrency = concurrency
+    self.failures = []
+
+  def copy_blob(self, name, verify=False):
+    """copies blob name to the target store.  returns True if the blob was copied, or False if
+    the source store does not have it.  if verify is set, name is the sha of the blob, and
+    MirrorError is raised without writing to the target if the blob does not match it."""
+    try:
+      blob = self.source_store.open(name)
+    except self.source_store.DoesNotExist:
+      return False
+    if not verify:
+      try:
+        self.target_store.put(name, blob)
+      finally:
+        blob.close()
+      return True
+    # the blob is hashed as it is spooled, so that it is read from the source only once.
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as fp:
+      try:
+        verified = verify_stream(TeeReader(blob, fp), name)
+      finally:
+        blob.close()
+      if not verified:
+        raise MirrorError('Blob %s appears to be corrupt in the source store.' % name)
+      fp.seek(0)
+      self.target_store.put(name, fp)
+    return True
+
+  def _blobs(self, packages, previous):
+    """yields (name, verify) of the blobs of packages, including their member indexes and
+    deltas.  only package blobs are named by the sha of their contents."""
+    for package in packages:
+      yield package.sha, True
+      yield index_name(package.sha), False
+      if previous is not None:
+        yield delta_name(previous.sha, package.sha), False
+      previous = package
+
+  def _copy_blobs(self, blobs):
+    # one bulk existence check rather than one per blob.
+    existing = self.target_store.exists_many([name for name, _ in blobs])
+    blobs = [(name, verify) for name, verify in blobs if name not in existing]
+
+    def copy_blob(blob):
+      return self.copy_blob(*blob)
+
+    if len(blobs) <= 1:
+      return sum(map(copy_blob, blobs))
+    pool = ThreadPool(min(len(blobs), self.concurrency))
+    try:
+      return sum(pool.map(copy_blob, blobs))
+    finally:
+      pool.close()
+
+  def _source_tags(self, package_name):
+    tags = {}
+    for tag_name in self.source_ledger.tags(package_name):
+      # "latest" is maintained by the target ledger itself.
+      if tag_name == 'latest':
+        continue
+      try:
+        tags[tag_name] = self.source_ledger.poll_tag(package_name, tag_name)[1]
+      except self.source_ledger.Error:
+        continue
+    return tags
+
+  def mirror_package(self, package_name):
+    """returns (versions, blobs, tags) copied."""
+    state = self.state.get(package_name)
+    packages = list(self.source_ledger.info_all(package_name, start=state['high_water'] + 1))
+    previous = None
+    if packages and state['high_water']:
+      try:
+        previous = self.source_ledger.info(package_name, state['high_water'])
+      except self.source_ledger.DoesNotExist:
+        pass
+
+    blobs = self._copy_blobs(list(self._blobs(packages, previous)))
+    versions = 0
+    for package in packages:
+      try:
+        self.target_ledger.put(package)
+        versions += 1
+      except self.target_ledger.Exists:
+        continue
+
+    tags = self._source_tags(package_name)
+    mirrored_tags = state['tags']
+    for tag_name, version in sorted(tags.items()):
+      if mirrored_tags.get(tag_name) != version:
+        self.target_ledger.tag(package_name, version, tag_name)
+    for tag_name in sorted(set(mirrored_tags) - set(tags)):
+      self.target_ledger.untag(package_name, tag_name)
+    changed_tags = sum(mirrored_tags.get(tag_name) != version for tag_name, version in tags.items())
+    changed_tags += len(set(mirrored_tags) - set(tags))
+
+    high_water = max([state['high_water']] + [package.version for package in packages])
+    self.state.update(package_name, high_water, tags)
+    return versions, blobs, changed_tags
+
+  def run(self, package_names=None):
+    """yields (package_name, versions, blobs, tags) copied for each package.  packages that fail
+    with a MirrorError are skipped and recorded in failures, and retried by the next run."""
+    self.failures = []
+    for package_name in package_names or self.source_ledger.list_packages():
+      try:
+        versions, blobs, tags = self.mirror_package(package_name)
+      except MirrorError as e:
+        warn('Not mirroring %s: %s' % (package_name, e))
+        self.failures.append(package_name)
+        continue
+      yield package_name, versions, blobs, tags
@@ -1,7 +1,32 @@
 class Package(object):
-  def __init__(self, name, version, sha, basename, mode, metadata=None):
+  def __init__(self, name, version, sha, basename, mode, metadata=None, timestamp=None):
     self.name, self.version, self.sha, self.basename, self.mode, self.metadata = (
         name, version, sha, basename, mode, metadata or {})
+    # seconds since the epoch when the version was added, if known.
+    self.timestamp = timestamp
+
+  @classmethod
+  def from_dict(cls, blob):
+    return cls(
+        blob['name'],
+        int(blob['version']),
+        blob['sha'],
+        blob['basename'],
+        int(blob['mode']),
+        blob.get('metadata'),
+        timestamp=blob.get('timestamp'),
+    )
+
+  def to_dict(self):
+    return {
+        'name': self.name,
+        'version': self.version,
+        'sha': self.sha,
+        'basename': self.basename,
+        'mode': self.mode,
+        'metadata': self.metadata,
+        'timestamp': self.timestamp,
+    }
 
   def __str__(self):
     return 'Package(name: %r, version: %d, sha: %s..., filename: %s, mode: %o)' % (
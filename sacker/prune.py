@@ -0,0 +1,75 @@
+import time
+
+
+class RetentionPolicy(object):
+  """Decides which versions of a package to prune.
+
+  A version is kept if any of the policies applies to it: it is among the keep_last most recent
+  versions, it was added less than keep_newer_than seconds ago, or it is tagged and keep_tagged
+  is set.  The latest version is always kept.  Versions whose age is unknown are never pruned
+  by age alone.
+  """
+
+  def __init__(self, keep_last=None, keep_newer_than=None, keep_tagged=True):
+    if keep_last is None and keep_newer_than is None:
+      raise ValueError('A retention policy must keep the last N or recent versions.')
+    self.keep_last = keep_last
+    self.keep_newer_than = keep_newer_than
+    self.keep_tagged = keep_tagged
+
+  @property
+  def needs_timestamps(self):
+    return self.keep_newer_than is not None
+
+  def _keep(self, rank, version, timestamp, tagged, now):
+    if rank == 0:
+      return True
+    if self.keep_last is not None and rank < self.keep_last:
+      return True
+    if self.keep_tagged and version in tagged:
+      return True
+    if self.keep_newer_than is not None:
+      if timestamp is None or now - timestamp < self.keep_newer_than:
+        return True
+    return False
+
+  def select(self, versions, tagged, now=None):
+    """returns the versions to prune from (version, timestamp) pairs, given the set of tagged
+    versions.  timestamps are only consulted if needs_timestamps and may otherwise be None."""
+    now = time.time() if now is None else now
+    newest_first = sorted(versions, reverse=True)
+    return sorted(
+        version for rank, (version, timestamp) in enumerate(newest_first)
+        if not self._keep(rank, version, timestamp, tagged, now))
+
+
+def tagged_versions(ledger, package_name):
+  versions = set()
+  for tag_name in ledger.tags(package_name):
+    try:
+      versions.add(ledger.poll_tag(package_name, tag_name)[1])
+    except ledger.Error:
+      continue
+  return versions
+
+
+def prune(ledger, package_name, policy, dry_run=False, now=None):
+  """removes the versions of package_name selected by policy unless dry_run.  returns (pruned,
+  versions) where pruned are the selected versions and versions is the number considered.
+
+  tags are read again from the ledger just before removal, so that a version tagged while the
+  versions were being listed is kept.
+  """
+  if policy.needs_timestamps:
+    versions = [(package.version, package.timestamp) for package in ledger.info_all(package_name)]
+  else:
+    versions = [(version, None) for version in ledger.list_package_versions(package_name)]
+  tagged = tagged_versions(ledger, package_name) if policy.keep_tagged else set()
+  prunable = policy.select(versions, tagged, now=now)
+  if prunable and not dry_run:
+    if policy.keep_tagged:
+      tagged = tagged_versions(ledger, package_name)
+      prunable = [version for version in prunable if version not in tagged]
+    if prunable:
+      ledger.remove_many(package_name, prunable)
+  return prunable, len(versions)
@@ -0,0 +1,49 @@
+from importlib import import_module
+
+
+class Registry(object):
+  """A mapping of URI schemes to backend implementations.
+
+  Implementations may be registered either directly or as 'module:attribute' strings, which
+  are only imported the first time a URI with that scheme is parsed.  Schemes that are not
+  registered are looked up in the setuptools entry point group of the registry.
+  """
+
+  class UnknownScheme(KeyError): pass
+
+  def __init__(self, entry_point_group):
+    self.entry_point_group = entry_point_group
+    self._impls = {}
+
+  def register(self, scheme, impl):
+    self._impls[scheme] = impl
+
+  def clear(self):
+    self._impls.clear()
+
+  def _load_entry_point(self, scheme):
+    try:
+      from importlib.metadata import entry_points
+    except ImportError:
+      from pkg_resources import iter_entry_points
+      for entry_point in iter_entry_points(self.entry_point_group, scheme):
+        return entry_point.load()
+    else:
+      group = entry_points()
+      if hasattr(group, 'select'):
+        group = group.select(group=self.entry_point_group)
+      else:
+        group = group.get(self.entry_point_group, ())
+      for entry_point in group:
+        if entry_point.name == scheme:
+          return entry_point.load()
+    raise self.UnknownScheme(scheme)
+
+  def get(self, scheme):
+    impl = self._impls.get(scheme)
+    if impl is None:
+      impl = self._impls[scheme] = self._load_entry_point(scheme)
+    elif isinstance(impl, str):
+      module_name, _, attribute = impl.partition(':')
+      impl = self._impls[scheme] = getattr(import_module(module_name), attribute)
+    return impl
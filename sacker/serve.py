@@ -0,0 +1,149 @@
+"""A caching HTTP proxy in front of a store.
+
+GET /<sha> serves the blob from a local cache, filling the cache from the
+store on a miss.  Concurrent misses for the same sha are coalesced into a single
+fill, blobs are verified against their sha before they are served, and single
+byte ranges are supported.
+"""
+
+import errno
+import os
+import re
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+BLOB_PATH = re.compile(r'^/([\w:-]+)$')
+RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+COPY_SIZE = 1024 * 1024
+
+
+class BlobServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  OPEN_ATTEMPTS = 3
+
+  def __init__(self, address, store, cache, max_cache_size=None):
+    HTTPServer.__init__(self, address, BlobRequestHandler)
+    self.store = store
+    self.cache = cache
+    self.max_cache_size = max_cache_size
+    self._fills = {}
+    self._fills_lock = threading.Lock()
+
+  def fill(self, sha):
+    """returns the cached path of sha, fetching it from the store at most once concurrently."""
+    if self.cache.touch(sha):
+      return self.cache.path(sha)
+
+    with self._fills_lock:
+      fill = self._fills.get(sha)
+      leader = fill is None
+      if leader:
+        fill = self._fills[sha] = {'done': threading.Event(), 'error': None}
+
+    if leader:
+      try:
+        self.cache.fetch(self.store, sha)
+      except Exception as e:
+        fill['error'] = e
+      finally:
+        with self._fills_lock:
+          self._fills.pop(sha)
+        fill['done'].set()
+      if self.max_cache_size is not None:
+        self.cache.trim(self.max_cache_size, keep=sha)
+    else:
+      fill['done'].wait()
+
+    if fill['error'] is not None:
+      raise fill['error']
+    return self.cache.path(sha)
+
+  def open(self, sha):
+    """returns the cached blob sha opened for reading, filling it first if necessary."""
+    for _ in range(self.OPEN_ATTEMPTS):
+      path = self.fill(sha)
+      try:
+        # once open, the blob can be read even if it is evicted.
+        return open(path, 'rb')
+      except IOError as e:
+        # the trim of a concurrent fill evicted the blob between filling and opening it.
+        if e.errno != errno.ENOENT:
+          raise
+    raise IOError(errno.ENOENT, 'Blob %s was evicted from the cache while opening it.' % sha)
+
+
+class BlobRequestHandler(BaseHTTPRequestHandler):
+  def _parse_range(self, size):
+    """returns (start, end) inclusive of the requested range, None for the whole blob or raises
+    ValueError if the range cannot be satisfied."""
+    header = self.headers.get('Range')
+    if not header:
+      return None
+    match = RANGE_HEADER.match(header.strip())
+    if not match or match.groups() == ('', ''):
+      # multiple or malformed ranges are answered with the whole blob.
+      return None
+    start, end = match.groups()
+    if not start:
+      start, end = max(size - int(end), 0), size - 1
+    else:
+      start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+      raise ValueError('Unsatisfiable range %r' % header)
+    return start, end
+
+  def _serve(self, send_body):
+    match = BLOB_PATH.match(self.path.split('?', 1)[0])
+    if not match:
+      self.send_error(404)
+      return
+    sha = match.group(1)
+
+    try:
+      fp = self.server.open(sha)
+    except self.server.store.DoesNotExist:
+      self.send_error(404)
+      return
+    except Exception as e:
+      self.send_error(502, str(e))
+      return
+
+    with fp:
+      size = os.fstat(fp.fileno()).st_size
+      try:
+        byte_range = self._parse_range(size)
+      except ValueError:
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */%d' % size)
+        self.end_headers()
+        return
+
+      if byte_range is None:
+        start, end = 0, size - 1
+        self.send_response(200)
+      else:
+        start, end = byte_range
+        self.send_response(206)
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+      self.send_header('Accept-Ranges', 'bytes')
+      self.send_header('Content-Type', 'application/octet-stream')
+      self.send_header('Content-Length', str(end - start + 1))
+      self.end_headers()
+
+      if send_body:
+        fp.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+          data = fp.read(min(COPY_SIZE, remaining))
+          if not data:
+            break
+          self.wfile.write(data)
+          remaining -= len(data)
+
+  def do_GET(self):
+    self._serve(send_body=True)
+
+  def do_HEAD(self):
+    self._serve(send_body=False)
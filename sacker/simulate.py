@@ -0,0 +1,64 @@
+"""Simulated backend behaviour for the memory:// ledger and store.
+
+Every operation of a simulated backend is counted as one round trip and may be
+delayed or failed, as configured by the query of its URI:
+
+    memory://name?latency=5&jitter=2&errors=0.01
+
+latency and jitter are in milliseconds, errors is the probability that an
+operation fails.  Each may be overridden for a single operation by suffixing it
+with the operation name, e.g. latency.upload=100.
+"""
+
+import random
+import threading
+import time
+from collections import defaultdict
+from urlparse import parse_qsl
+
+
+class Simulator(object):
+  PARAMETERS = ('latency', 'jitter', 'errors')
+
+  @classmethod
+  def from_query(cls, query):
+    settings = {}
+    seed = None
+    for key, value in parse_qsl(query):
+      if key == 'seed':
+        seed = int(value)
+        continue
+      parameter, _, operation = key.partition('.')
+      if parameter not in cls.PARAMETERS:
+        raise ValueError('Unknown simulation parameter %r' % key)
+      settings[(parameter, operation or None)] = float(value)
+    return cls(settings, seed=seed)
+
+  def __init__(self, settings=None, seed=None):
+    self.settings = settings or {}
+    self.stats = defaultdict(int)
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+
+  def _get(self, parameter, operation):
+    return self.settings.get((parameter, operation), self.settings.get((parameter, None), 0))
+
+  def __call__(self, operation, error):
+    """accounts for one round trip of operation, raising error if it is chosen to fail."""
+    with self._lock:
+      self.stats[operation] += 1
+      jitter = self._random.uniform(-1, 1) * self._get('jitter', operation)
+      failed = self._random.random() < self._get('errors', operation)
+    delay = max(0, self._get('latency', operation) + jitter)
+    if delay:
+      time.sleep(delay / 1000.0)
+    if failed:
+      raise error('Injected failure in %s' % operation)
+
+  @property
+  def round_trips(self):
+    return sum(self.stats.values())
+
+  def reset(self):
+    with self._lock:
+      self.stats.clear()
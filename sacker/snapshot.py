@@ -0,0 +1,201 @@
+"""A local, read-only snapshot of a ledger.
+
+The snapshot is a sqlite database holding every version and tag of every
+package, which serves read-only queries without any round trips.  It is
+refreshed incrementally: only versions newer than the newest version held of
+each package are fetched, along with the current tags.  Versions removed from
+the ledger since they were snapshotted are only dropped by a full refresh.
+
+Each ledger has its own snapshot, keyed by its URI.  The snapshot also records
+the URI of the ledger it was refreshed from, and counts as stale until it has
+been refreshed from its own ledger.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from .ledger import Ledger, filter_versions
+from .package import Package
+from .util import safe_mkdir, sacker_home
+
+
+class SnapshotLedger(Ledger):
+  REFRESH_CONCURRENCY = 8
+
+  _REFRESH_LOCK = threading.Lock()
+
+  @classmethod
+  def default(cls, ledger_uri):
+    """returns the snapshot of the ledger at ledger_uri."""
+    digest = hashlib.sha1(ledger_uri).hexdigest()[:16]
+    return cls(os.path.join(sacker_home(), 'snapshot', '%s.db' % digest), ledger_uri)
+
+  @classmethod
+  def fresh(cls, ledger, max_age):
+    """returns the snapshot of ledger, refreshing it first if it is older than max_age.  concurrent
+    callers, e.g. the requests of a batch, refresh it at most once."""
+    with cls._REFRESH_LOCK:
+      snapshot = cls.default(ledger.uri)
+      if snapshot.is_stale(max_age):
+        snapshot.refresh(ledger)
+      return snapshot
+
+  def __init__(self, db_path, ledger_uri):
+    self.db_path = db_path
+    self.ledger_uri = ledger_uri
+    self._db = None
+    # the connection is shared by threads, e.g. those of resolve_many.
+    self._lock = threading.RLock()
+
+  @property
+  def db(self):
+    with self._lock:
+      if self._db is None:
+        safe_mkdir(os.path.dirname(self.db_path) or '.')
+        self._db = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS versions ('
+            'package_name TEXT, version INTEGER, sha TEXT, basename TEXT, mode INTEGER, '
+            'metadata TEXT, timestamp REAL, PRIMARY KEY (package_name, version));'
+            'CREATE TABLE IF NOT EXISTS tags ('
+            'package_name TEXT, tag TEXT, version INTEGER, PRIMARY KEY (package_name, tag));'
+            'CREATE TABLE IF NOT EXISTS packages ('
+            'package_name TEXT PRIMARY KEY);'
+            'CREATE TABLE IF NOT EXISTS snapshot (refreshed REAL, ledger_uri TEXT);')
+      return self._db
+
+  def _query(self, sql, *args):
+    with self._lock:
+      return self.db.execute(sql, args).fetchall()
+
+  def _source(self):
+    """returns (refreshed, ledger_uri) of the last refresh, or (None, None)."""
+    rows = self._query('SELECT refreshed, ledger_uri FROM snapshot')
+    return rows[0] if rows else (None, None)
+
+  @property
+  def refreshed(self):
+    """returns when the snapshot was last refreshed from its ledger, in seconds since the epoch,
+    or None."""
+    refreshed, ledger_uri = self._source()
+    return refreshed if ledger_uri == self.ledger_uri else None
+
+  def is_stale(self, max_age, now=None):
+    refreshed = self.refreshed
+    return refreshed is None or (time.time() if now is None else now) - refreshed > max_age
+
+  def _fetch_package(self, ledger, package_name, high_water):
+    packages = list(ledger.info_all(package_name, start=high_water + 1))
+    tags = {}
+    for tag_name in ledger.tags(package_name):
+      if tag_name == 'latest':
+        continue
+      try:
+        tags[tag_name] = ledger.poll_tag(package_name, tag_name)[1]
+      except ledger.Error:
+        continue
+    return package_name, packages, tags
+
+  def refresh(self, ledger, full=False):
+    """brings the snapshot up to date with ledger.  returns the number of versions fetched."""
+    package_names = list(ledger.list_packages())
+    # the versions held from any other ledger are dropped.
+    full = full or self._source()[1] != self.ledger_uri
+    if full:
+      high_water = {}
+    else:
+      high_water = dict(self._query(
+          'SELECT package_name, MAX(version) FROM versions GROUP BY package_name'))
+
+    def fetch(package_name):
+      return self._fetch_package(ledger, package_name, high_water.get(package_name, 0))
+
+    pool = ThreadPool(max(1, min(len(package_names), self.REFRESH_CONCURRENCY)))
+    try:
+      fetched = pool.map(fetch, package_names)
+    finally:
+      pool.close()
+
+    versions = 0
+    with self._lock:
+      with self.db:
+        if full:
+          self.db.execute('DELETE FROM versions')
+        self.db.execute('DELETE FROM packages')
+        self.db.execute('DELETE FROM tags')
+        for package_name, packages, tags in fetched:
+          self.db.execute('INSERT INTO packages VALUES (?)', (package_name,))
+          self.db.executemany(
+              'INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?, ?, ?)',
+              [(package.name, package.version, package.sha, package.basename, package.mode,
+                json.dumps(package.metadata), package.timestamp) for package in packages])
+          self.db.executemany(
+              'INSERT INTO tags VALUES (?, ?, ?)',
+              [(package_name, tag_name, version) for tag_name, version in tags.items()])
+          versions += len(packages)
+        self.db.execute('DELETE FROM snapshot')
+        self.db.execute('INSERT INTO snapshot VALUES (?, ?)', (time.time(), self.ledger_uri))
+    return versions
+
+  def _read_only(self, *args, **kw):
+    raise self.Error('The ledger snapshot is read-only.')
+
+  init = add = put = remove = remove_many = compact = tag = untag = _read_only
+
+  def list_packages(self):
+    return [row[0] for row in self._query('SELECT package_name FROM packages ORDER BY 1')]
+
+  def list_package_versions(self, package_name, start=None, end=None, limit=None, reverse=False):
+    versions = [row[0] for row in self._query(
+        'SELECT version FROM versions WHERE package_name = ? ORDER BY version', package_name)]
+    return filter_versions(versions, start, end, limit, reverse)
+
+  def latest(self, package_name):
+    return self._query(
+        'SELECT MAX(version) FROM versions WHERE package_name = ?', package_name)[0][0]
+
+  def _get_version(self, package_name, spec):
+    if spec == 'latest':
+      return self.latest(package_name)
+    try:
+      return int(spec)
+    except ValueError:
+      rows = self._query(
+          'SELECT version FROM tags WHERE package_name = ? AND tag = ?', package_name, spec)
+      if not rows:
+        raise self.DoesNotExist('Package %s has no tag %r' % (package_name, spec))
+      return rows[0][0]
+
+  def _package_from_row(self, row):
+    package_name, version, sha, basename, mode, metadata, timestamp = row
+    return Package(
+        package_name, version, sha, basename, mode, json.loads(metadata), timestamp=timestamp)
+
+  def info(self, package_name, spec):
+    rows = self._query(
+        'SELECT * FROM versions WHERE package_name = ? AND version = ?',
+        package_name, self._get_version(package_name, spec))
+    if not rows:
+      raise self.DoesNotExist('Package %s has no version %s' % (package_name, spec))
+    return self._package_from_row(rows[0])
+
+  def info_all(self, package_name, start=None, end=None, limit=None, reverse=False):
+    packages = self._query(
+        'SELECT * FROM versions WHERE package_name = ? ORDER BY version', package_name)
+    versions = set(filter_versions([row[1] for row in packages], start, end, limit, reverse))
+    packages = [self._package_from_row(row) for row in packages if row[1] in versions]
+    return reversed(packages) if reverse else iter(packages)
+
+  def resolve_many(self, specs):
+    # lookups are local, so there is nothing to gain from concurrency.
+    return [self.info(package_name, spec) for package_name, spec in specs]
+
+  def tags(self, package_name):
+    tags = [row[0] for row in self._query(
+        'SELECT tag FROM tags WHERE package_name = ? ORDER BY tag', package_name)]
+    return (['latest'] if self.latest(package_name) is not None else []) + tags
@@ -1,5 +1,6 @@
 from urlparse import urlparse
 
+from .registry import Registry
 from .util import die
 
 
@@ -8,6 +9,11 @@ class Store(object):
   class Exists(Error): pass
   class DoesNotExist(Error): pass
 
+  @classmethod
+  def from_uri(cls, uri):
+    uri = urlparse(uri)
+    return cls.from_netloc(uri.netloc, uri.path)
+
   @classmethod
   def from_netloc(cls, netloc, path):
     raise NotImplementedError
@@ -20,13 +26,47 @@ class Store(object):
     raise NotImplementedError
 
   def download(self, sha, filename):
-    """saves sha to filename"""
+    """saves sha to filename, raises DoesNotExist"""
+    raise NotImplementedError
+
+  def open(self, sha):
+    """returns a readable file-like object streaming sha, raises DoesNotExist"""
+    raise NotImplementedError
+
+  def exists(self, sha):
+    try:
+      self.open(sha).close()
+    except self.DoesNotExist:
+      return False
+    return True
+
+  def exists_many(self, shas):
+    """returns the subset of shas that exist, in as few requests as the store can"""
+    return set(sha for sha in shas if self.exists(sha))
+
+  def build_index(self):
+    """rebuilds the existence index used by exists_many, if the store keeps one.  returns the
+    number of blobs indexed, or None."""
+    return None
+
+  def put(self, sha, data):
+    """stores data, either bytes or a readable file-like object, as sha"""
+    raise NotImplementedError
+
+  def read_range(self, sha, offset, length):
+    """returns length bytes of sha starting at offset, raises DoesNotExist"""
     raise NotImplementedError
 
   def delete(self, sha):
     """returns nothing, raises ObjectDoesNotExist"""
     raise NotImplementedError
 
+  def url(self, sha, expires=3600, check=False):
+    """returns a URL from which sha can be fetched without credentials for expires seconds.  the
+    URL is signed without checking that sha exists unless check is set, in which case raises
+    DoesNotExist"""
+    raise NotImplementedError
+
 
 class ChainedStore(Store):
   def __init__(self, stores):
@@ -46,21 +86,50 @@ class ChainedStore(Store):
       try:
         store.download(sha, filename)
         break
-      except store.NotExists:
+      except store.DoesNotExist:
         continue
     else:
-      raise self.NotExists('Could not find %s' % sha)
+      raise self.DoesNotExist('Could not find %s' % sha)
+
+  def open(self, sha):
+    for store in self.stores:
+      try:
+        return store.open(sha)
+      except store.DoesNotExist:
+        continue
+    raise self.DoesNotExist('Could not find %s' % sha)
+
+  def exists(self, sha):
+    return any(store.exists(sha) for store in self.stores)
+
+  def exists_many(self, shas):
+    existing = set()
+    for store in self.stores:
+      existing |= store.exists_many(set(shas) - existing)
+    return existing
+
+  def build_index(self):
+    for store in self.stores:
+      store.build_index()
+
+  def put(self, sha, data):
+    # file-like objects can only be consumed once, so they are rewound between stores.
+    for store in self.stores:
+      if hasattr(data, 'seek'):
+        data.seek(0)
+      store.put(sha, data)
 
   def delete(self, sha):
     for store in self.stores:
       store.delete(sha)
 
 
-STORES = {}
+STORES = Registry('sacker.stores')
 
 
 def register_store(name, impl):
-  STORES[name] = impl
+  """impl is either a Store subclass or a 'module:attribute' string imported on first use."""
+  STORES.register(name, impl)
 
 
 def unregister_all():
@@ -68,9 +137,11 @@ def unregister_all():
 
 
 def parse_store(uri):
-  uri = urlparse(uri)
+  scheme = urlparse(uri).scheme
 
-  if uri.scheme not in STORES:
-    die('Unknown store scheme %r' % uri.scheme)
+  try:
+    impl = STORES.get(scheme)
+  except STORES.UnknownScheme:
+    die('Unknown store scheme %r' % scheme)
 
-  return STORES[uri.scheme].from_netloc(uri.netloc, uri.path)
+  return impl.from_uri(uri)
@@ -0,0 +1,97 @@
+import shutil
+import threading
+from io import BytesIO
+from urlparse import urlparse
+
+from ..simulate import Simulator
+from ..store import Store
+
+
+class MemoryStore(Store):
+  """Store held in memory, shared by every store with the same name in the process.
+
+  Each method makes one simulated round trip, see sacker.simulate.
+  """
+
+  _BLOBS = {}
+  _BLOBS_LOCK = threading.Lock()
+
+  @classmethod
+  def from_uri(cls, uri):
+    uri = urlparse(uri)
+    return cls(uri.netloc, Simulator.from_query(uri.query))
+
+  @classmethod
+  def from_netloc(cls, netloc, path):
+    return cls(netloc)
+
+  @classmethod
+  def reset_all(cls):
+    with cls._BLOBS_LOCK:
+      cls._BLOBS.clear()
+
+  def __init__(self, name='', simulator=None):
+    self.name = name
+    self.simulator = simulator or Simulator()
+    with self._BLOBS_LOCK:
+      self._blobs = self._BLOBS.setdefault(name, {})
+
+  @property
+  def stats(self):
+    return self.simulator.stats
+
+  def _call(self, operation):
+    self.simulator(operation, self.Error)
+
+  def _get(self, sha):
+    with self._BLOBS_LOCK:
+      try:
+        return self._blobs[sha]
+      except KeyError:
+        raise self.DoesNotExist('Could not find %s' % sha)
+
+  def upload(self, sha, filename):
+    self._call('upload')
+    with open(filename, 'rb') as fp:
+      data = fp.read()
+    with self._BLOBS_LOCK:
+      self._blobs[sha] = data
+
+  def download(self, sha, filename):
+    self._call('download')
+    data = self._get(sha)
+    with open(filename, 'wb') as fp:
+      fp.write(data)
+
+  def open(self, sha):
+    self._call('open')
+    return BytesIO(self._get(sha))
+
+  def exists(self, sha):
+    self._call('exists')
+    with self._BLOBS_LOCK:
+      return sha in self._blobs
+
+  def exists_many(self, shas):
+    self._call('exists_many')
+    with self._BLOBS_LOCK:
+      return set(sha for sha in shas if sha in self._blobs)
+
+  def put(self, sha, data):
+    self._call('put')
+    if not isinstance(data, bytes):
+      buf = BytesIO()
+      shutil.copyfileobj(data, buf)
+      data = buf.getvalue()
+    with self._BLOBS_LOCK:
+      self._blobs[sha] = data
+
+  def read_range(self, sha, offset, length):
+    self._call('read_range')
+    return self._get(sha)[offset:offset + length]
+
+  def delete(self, sha):
+    self._call('delete')
+    with self._BLOBS_LOCK:
+      if self._blobs.pop(sha, None) is None:
+        raise self.DoesNotExist('Could not find %s' % sha)
@@ -1,34 +1,471 @@
+import hashlib
+import json
+import os
+import threading
+import zlib
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+from urlparse import parse_qsl, urlparse
+
+from ..bandwidth import Uncoordinated
 from ..store import Store
+from ..util import sacker_home, safe_mkdir
 
 import boto3
 from boto3.s3.transfer import S3Transfer
+from botocore.exceptions import ClientError
+
+
+def is_missing(error):
+  return error.response['Error']['Code'] in ('404', 'NoSuchKey')
+
+
+def is_changed(error):
+  """returns True if a request conditional on the ETag of an object failed because the object was
+  written since."""
+  return error.response['Error']['Code'] in ('412', 'PreconditionFailed')
+
+
+def is_retryable(error):
+  """returns True if a request may succeed when retried, i.e. for throttling and server errors."""
+  return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500) >= 500 or (
+      error.response['Error']['Code'] in ('SlowDown', 'RequestTimeout', 'Throttling'))
 
 
 # TODO(wickman) error handling
 class S3Store(Store):
+  """Store based on S3, with blobs keyed by sha.
+
+  exists_many is answered from an existence index kept in the bucket: a sorted list of every
+  sha, rebuilt by build_index, plus an empty marker per sha uploaded since.  markers are written
+  before their blobs, so a sha in neither the index nor the markers definitely does not exist,
+  while a sha in either is confirmed with a HEAD since it may have been deleted.
+
+  the "sharded" layout keys blobs by two levels of prefixes of their sha, e.g. ab/cd/abcd..., to
+  spread requests over many prefixes and stay clear of S3's per-prefix request rate limits.  it
+  falls back to the legacy "flat" layout, keyed by the bare sha, for reads of blobs that have not
+  been moved by rekey yet.
+  """
+
+  LAYOUTS = ('flat', 'sharded')
+
+  INTERNAL_PREFIX = '.sacker/'
+  INDEX_KEY = '.sacker/index'
+  MARKER_PREFIX = '.sacker/new/'
+  HEAD_CONCURRENCY = 16
+  DELETE_BATCH_SIZE = 1000
+
+  # blobs at least this large are transferred in chunks that survive interruptions: downloads
+  # keep a partial file with a sidecar of verified chunks and uploads keep their multipart upload,
+  # so that retrying resumes the transfer.  the sidecar holds the sha256 of each chunk rather than
+  # the state of a running hash of the blob, which hashlib cannot serialize, and is verified
+  # against the partial file before resuming.  multipart uploads that fail in a way a retry cannot
+  # recover from are aborted, but uploads that are interrupted and never retried are left for a
+  # bucket lifecycle rule to abort.
+  RESUMABLE_SIZE = 64 * 1024 * 1024
+  CHUNK_SIZE = 8 * 1024 * 1024
+  MAX_PARTS = 10000
+  # downloads of blobs written again while they are downloaded are restarted this many times.
+  DOWNLOAD_ATTEMPTS = 3
+  # the longest validity of a SigV4 presigned URL.
+  MAX_URL_EXPIRES = 7 * 24 * 3600
+  TRANSFER_CONCURRENCY = 8
+
+  @classmethod
+  def from_uri(cls, uri):
+    """s3://<bucket>[?layout=flat|sharded]"""
+    uri = urlparse(uri)
+    store = cls.from_netloc(uri.netloc, uri.path)
+    for key, value in parse_qsl(uri.query):
+      if key != 'layout' or value not in cls.LAYOUTS:
+        raise ValueError('Unknown S3 store option %s=%s' % (key, value))
+      store.layout = value
+    return store
+
   @classmethod
   def from_netloc(cls, netloc, path):
     if path not in ('', '/'):
       raise ValueError('S3 store does not take path.')
     return cls(netloc)
 
-  def __init__(self, bucket):
+  def __init__(self, bucket, layout='flat'):
     self.bucket = bucket
+    self.layout = layout
+    self._conn = None
+    self._conn_lock = threading.Lock()
+    self._index = None
+    self._index_etag = None
+    # coordinates uploads and downloads with other processes on the host, see sacker.bandwidth.
+    self.coordinator = Uncoordinated()
 
   @property
   def connection(self):
-    return boto3.client('s3')
+    # clients are thread-safe and reused across calls so that connections are kept alive.
+    with self._conn_lock:
+      if self._conn is None:
+        self._conn = boto3.session.Session().client('s3')
+    return self._conn
 
   def init(self):
     self.connection.create_bucket(Bucket=self.bucket)
 
+  def key(self, sha):
+    """returns the key of blob sha in the layout of the store."""
+    if self.layout == 'flat':
+      return sha
+    # blobs that are not bare sha256 addresses, e.g. "blake2b:<digest>", are sharded by digest.
+    digest = sha.rpartition(':')[2]
+    return '%s/%s/%s' % (digest[:2], digest[2:4], sha)
+
+  def _with_fallback(self, sha, read):
+    """returns read(key) for the key of sha, falling back to its legacy flat key."""
+    key = self.key(sha)
+    try:
+      return read(key)
+    except ClientError as e:
+      if key == sha or not is_missing(e):
+        raise
+    return read(sha)
+
+  def _list_keys(self, prefix=''):
+    paginator = self.connection.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+      for obj in page.get('Contents', ()):
+        yield obj['Key']
+
+  def _mark(self, sha):
+    self.connection.put_object(Bucket=self.bucket, Key=self.MARKER_PREFIX + sha, Body=b'')
+
+  def _read_index(self):
+    """returns the set of indexed shas, or None if the store has no index."""
+    kw = {'Bucket': self.bucket, 'Key': self.INDEX_KEY}
+    if self._index_etag is not None:
+      kw['IfNoneMatch'] = self._index_etag
+    try:
+      response = self.connection.get_object(**kw)
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('304', 'NotModified'):
+        return self._index
+      if is_missing(e):
+        return None
+      raise
+    self._index = set(zlib.decompress(response['Body'].read()).split())
+    self._index_etag = response['ETag']
+    return self._index
+
+  def build_index(self):
+    markers = list(self._list_keys(self.MARKER_PREFIX))
+    shas = sorted(set(
+        key.rsplit('/', 1)[-1] for key in self._list_keys()
+        if not key.startswith(self.INTERNAL_PREFIX)))
+    self.connection.put_object(
+        Bucket=self.bucket, Key=self.INDEX_KEY, Body=zlib.compress('\n'.join(shas)))
+    # markers of blobs that are now indexed are redundant, but those of blobs that were still
+    # being uploaded are not.
+    indexed = set(shas)
+    stale = [{'Key': key} for key in markers if key[len(self.MARKER_PREFIX):] in indexed]
+    for k in range(0, len(stale), self.DELETE_BATCH_SIZE):
+      self.connection.delete_objects(
+          Bucket=self.bucket,
+          Delete={'Objects': stale[k:k + self.DELETE_BATCH_SIZE], 'Quiet': True})
+    return len(shas)
+
+  def rekey(self, delete_legacy=False, concurrency=TRANSFER_CONCURRENCY):
+    """copies blobs stored in the legacy flat layout to their sharded keys, optionally deleting
+    them from the flat layout.  yields each sha that was moved."""
+    if self.layout == 'flat':
+      raise ValueError('Only sharded stores can be rekeyed.')
+
+    def copy(sha):
+      try:
+        self.connection.head_object(Bucket=self.bucket, Key=self.key(sha))
+      except ClientError as e:
+        if not is_missing(e):
+          raise
+        # managed copies are server-side, in parts for blobs over 5GB.
+        self.connection.copy({'Bucket': self.bucket, 'Key': sha}, self.bucket, self.key(sha))
+      if delete_legacy:
+        self.connection.delete_object(Bucket=self.bucket, Key=sha)
+      return sha
+
+    # legacy keys are the only keys outside of a directory.
+    legacy = (key for key in self._list_keys() if '/' not in key)
+    pool = ThreadPool(concurrency)
+    try:
+      for sha in pool.imap_unordered(copy, legacy):
+        yield sha
+    finally:
+      pool.close()
+
+  def exists_many(self, shas):
+    shas = set(shas)
+    index = self._read_index()
+    if index is not None:
+      new = set(key[len(self.MARKER_PREFIX):] for key in self._list_keys(self.MARKER_PREFIX))
+      shas &= index | new
+    if len(shas) <= 1:
+      return set(sha for sha in shas if self.exists(sha))
+    pool = ThreadPool(min(len(shas), self.HEAD_CONCURRENCY))
+    try:
+      shas = list(shas)
+      return set(sha for sha, exists in zip(shas, pool.map(self.exists, shas)) if exists)
+    finally:
+      pool.close()
+
+  def _in_windows(self, function, items):
+    """yields function(item) for each item, in order, computing up to TRANSFER_CONCURRENCY at a
+    time so that at most that many chunks are held in memory."""
+    pool = ThreadPool(self.TRANSFER_CONCURRENCY)
+    try:
+      for k in range(0, len(items), self.TRANSFER_CONCURRENCY):
+        for result in pool.map(function, items[k:k + self.TRANSFER_CONCURRENCY]):
+          yield result
+    finally:
+      pool.close()
+
+  def _write_state(self, filename, state):
+    with open(filename + '.tmp', 'w') as fp:
+      json.dump(state, fp)
+    os.rename(filename + '.tmp', filename)
+
+  def _read_state(self, filename):
+    try:
+      with open(filename) as fp:
+        return json.load(fp)
+    except (IOError, ValueError):
+      return None
+
+  def _upload_state_filename(self, sha):
+    return os.path.join(sacker_home(), 'uploads', '%s-%s.json' % (self.bucket, sha))
+
+  def _list_parts(self, key, upload_id):
+    parts = {}
+    kw = {'Bucket': self.bucket, 'Key': key, 'UploadId': upload_id}
+    while True:
+      response = self.connection.list_parts(**kw)
+      for part in response.get('Parts', ()):
+        parts[str(part['PartNumber'])] = part['ETag']
+      if not response.get('IsTruncated'):
+        return parts
+      kw['PartNumberMarker'] = response['NextPartNumberMarker']
+
+  def _upload_resumable(self, sha, filename, size):
+    key = self.key(sha)
+    state_filename = self._upload_state_filename(sha)
+    state = self._read_state(state_filename)
+    if state is not None:
+      try:
+        # only parts that S3 has as well as the state count as uploaded.
+        uploaded = self._list_parts(key, state['upload_id'])
+        state['parts'] = dict(
+            (number, etag) for number, etag in state['parts'].items()
+            if uploaded.get(number) == etag)
+      except ClientError as e:
+        if is_retryable(e):
+          raise
+        # the upload was completed or aborted.
+        state = None
+    if state is None:
+      part_size = max(self.CHUNK_SIZE, -(-size // self.MAX_PARTS))
+      upload_id = self.connection.create_multipart_upload(
+          Bucket=self.bucket, Key=key)['UploadId']
+      state = {'upload_id': upload_id, 'part_size': part_size, 'parts': {}}
+      safe_mkdir(os.path.dirname(state_filename))
+      self._write_state(state_filename, state)
+
+    try:
+      self._upload_parts(key, filename, size, state, state_filename)
+    except ClientError as e:
+      if not is_retryable(e):
+        # e.g. access was denied or the parts are invalid, which no retry fixes, so the parts
+        # uploaded so far are discarded rather than left to be billed.
+        self._abort_upload(key, state['upload_id'], state_filename)
+      raise
+    os.unlink(state_filename)
+
+  def _abort_upload(self, key, upload_id, state_filename):
+    try:
+      self.connection.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+    except ClientError:
+      # the upload was already aborted, or cannot be, and is left to the lifecycle of the bucket.
+      pass
+    os.unlink(state_filename)
+
+  def _upload_parts(self, key, filename, size, state, state_filename):
+    """uploads the parts of filename that state does not have yet and completes the upload."""
+    part_size = state['part_size']
+    remaining = [
+        number for number in range(1, -(-size // part_size) + 1)
+        if str(number) not in state['parts']]
+
+    with self.coordinator.transfer() as callback:
+      def upload_part(number):
+        with open(filename, 'rb') as fp:
+          fp.seek((number - 1) * part_size)
+          data = fp.read(part_size)
+        response = self.connection.upload_part(
+            Bucket=self.bucket, Key=key, UploadId=state['upload_id'], PartNumber=number, Body=data)
+        if callback:
+          callback(len(data))
+        return number, response['ETag']
+
+      for number, etag in self._in_windows(upload_part, remaining):
+        state['parts'][str(number)] = etag
+        self._write_state(state_filename, state)
+
+    self.connection.complete_multipart_upload(
+        Bucket=self.bucket,
+        Key=key,
+        UploadId=state['upload_id'],
+        MultipartUpload={'Parts': [
+            {'PartNumber': int(number), 'ETag': etag}
+            for number, etag in sorted(state['parts'].items(), key=lambda part: int(part[0]))]},
+    )
+
   def upload(self, sha, filename):
+    self._mark(sha)
+    size = os.path.getsize(filename)
+    if size >= self.RESUMABLE_SIZE:
+      return self._upload_resumable(sha, filename, size)
     transfer = S3Transfer(self.connection)
-    transfer.upload_file(filename, self.bucket, sha)
+    with self.coordinator.transfer() as callback:
+      transfer.upload_file(filename, self.bucket, self.key(sha), callback=callback)
+
+  def _verified_length(self, partial, state):
+    """returns the length of the prefix of partial matching the chunk digests of state."""
+    verified = 0
+    try:
+      with open(partial, 'rb') as fp:
+        for digest in state['chunks']:
+          data = fp.read(state['chunk_size'])
+          if len(data) != state['chunk_size'] or hashlib.sha256(data).hexdigest() != digest:
+            break
+          verified += len(data)
+    except IOError:
+      return 0
+    return verified
+
+  def _download_resumable(self, sha, key, filename, size, etag):
+    partial = filename + '.partial'
+    state_filename = partial + '.json'
+    state = self._read_state(state_filename)
+    if state is None or (state['sha'], state['etag'], state['size']) != (sha, etag, size):
+      state = {'sha': sha, 'etag': etag, 'size': size, 'chunk_size': self.CHUNK_SIZE, 'chunks': []}
+    offset = self._verified_length(partial, state)
+    chunk_size = state['chunk_size']
+    del state['chunks'][offset // chunk_size:]
+
+    with self.coordinator.transfer() as callback:
+      def fetch_chunk(start):
+        response = self.connection.get_object(
+            Bucket=self.bucket,
+            Key=key,
+            IfMatch=etag,
+            Range='bytes=%d-%d' % (start, min(start + chunk_size, size) - 1))
+        data = response['Body'].read()
+        if callback:
+          callback(len(data))
+        return data
+
+      with open(partial, 'ab') as fp:
+        fp.truncate(offset)
+        try:
+          for data in self._in_windows(fetch_chunk, range(offset, size, chunk_size)):
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+            state['chunks'].append(hashlib.sha256(data).hexdigest())
+            self._write_state(state_filename, state)
+        except ClientError as e:
+          if is_changed(e):
+            # the chunks downloaded so far may belong to the previous object, so they are
+            # discarded and the download starts over.
+            for name in (partial, state_filename):
+              if os.path.exists(name):
+                os.unlink(name)
+          raise
+
+    os.rename(partial, filename)
+    os.unlink(state_filename)
 
   def download(self, sha, filename):
-    transfer = S3Transfer(self.connection)
-    transfer.download_file(self.bucket, sha, filename)
+    for attempt in range(1, self.DOWNLOAD_ATTEMPTS + 1):
+      try:
+        key, head = self._with_fallback(
+            sha, lambda key: (key, self.connection.head_object(Bucket=self.bucket, Key=key)))
+        if head['ContentLength'] >= self.RESUMABLE_SIZE:
+          return self._download_resumable(sha, key, filename, head['ContentLength'], head['ETag'])
+        transfer = S3Transfer(self.connection)
+        with self.coordinator.transfer() as callback:
+          transfer.download_file(self.bucket, key, filename, callback=callback)
+        return
+      except ClientError as e:
+        if is_missing(e):
+          raise self.DoesNotExist('Could not find %s' % sha)
+        # a blob written again, e.g. uploaded again by another client or moved by rekey, has the
+        # same content under a new ETag.
+        if not is_changed(e) or attempt == self.DOWNLOAD_ATTEMPTS:
+          raise
+
+  def open(self, sha):
+    try:
+      return self._with_fallback(
+          sha, lambda key: self.connection.get_object(Bucket=self.bucket, Key=key)['Body'])
+    except ClientError as e:
+      if is_missing(e):
+        raise self.DoesNotExist('Could not find %s' % sha)
+      raise
+
+  def exists(self, sha):
+    try:
+      self._with_fallback(
+          sha, lambda key: self.connection.head_object(Bucket=self.bucket, Key=key))
+    except ClientError as e:
+      if is_missing(e):
+        return False
+      raise
+    return True
+
+  def put(self, sha, data):
+    if isinstance(data, bytes):
+      data = BytesIO(data)
+    self._mark(sha)
+    with self.coordinator.transfer() as callback:
+      self.connection.upload_fileobj(data, self.bucket, self.key(sha), Callback=callback)
+
+  def read_range(self, sha, offset, length):
+    try:
+      response = self._with_fallback(sha, lambda key: self.connection.get_object(
+          Bucket=self.bucket,
+          Key=key,
+          Range='bytes=%d-%d' % (offset, offset + length - 1)))
+    except ClientError as e:
+      if is_missing(e):
+        raise self.DoesNotExist('Could not find %s' % sha)
+      raise
+    return response['Body'].read()
 
   def delete(self, sha):
-    self.connection.delete(Bucket=self.bucket, Key=sha)
+    self.connection.delete_object(Bucket=self.bucket, Key=self.key(sha))
+    if self.key(sha) != sha:
+      self.connection.delete_object(Bucket=self.bucket, Key=sha)
+
+  def url(self, sha, expires=3600, check=False):
+    if not 0 < int(expires) <= self.MAX_URL_EXPIRES:
+      raise ValueError('Presigned URLs expire after at most %d seconds.' % self.MAX_URL_EXPIRES)
+    key = self.key(sha)
+    if check:
+      def head(key):
+        self.connection.head_object(Bucket=self.bucket, Key=key)
+        return key
+
+      # blobs that have not been rekeyed yet are signed at their legacy flat key.
+      try:
+        key = self._with_fallback(sha, head)
+      except ClientError as e:
+        if is_missing(e):
+          raise self.DoesNotExist('Could not find %s' % sha)
+        raise
+    # urls are signed locally with the credentials of the client.
+    return self.connection.generate_presigned_url(
+        'get_object', Params={'Bucket': self.bucket, 'Key': key}, ExpiresIn=int(expires))
@@ -0,0 +1,87 @@
+import random
+import threading
+import time
+from collections import deque
+
+
+class AdaptiveThrottle(object):
+  """Client-side rate limiting that adapts to throttling by a backend.
+
+  Calls are admitted by a token bucket, which is unlimited until the backend first throttles a
+  call.  Every throttled call then multiplies the rate by decrease, starting from the rate that
+  was actually sent over the last second, and every successful call raises it by increase, so
+  that throughput converges on what the backend accepts instead of failing.  Throttled and
+  transient failures are retried with jittered exponential backoff.  A throttle is thread-safe
+  and meant to be shared by every client of the same backend resource.
+  """
+
+  def __init__(self, is_throttle, is_transient=lambda error: False, min_rate=1.0, decrease=0.5,
+               increase=0.5, max_attempts=8, backoff=0.05, max_backoff=5.0, clock=time):
+    self.is_throttle = is_throttle
+    self.is_transient = is_transient
+    self.min_rate = min_rate
+    self.decrease = decrease
+    self.increase = increase
+    self.max_attempts = max_attempts
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.clock = clock
+    # calls per second, or None while unlimited.
+    self.rate = None
+    self._tokens = 0.0
+    self._last_refill = clock.time()
+    self._sent = deque()
+    self._lock = threading.Lock()
+
+  def _sent_rate(self, now):
+    while self._sent and self._sent[0] <= now - 1:
+      self._sent.popleft()
+    return len(self._sent)
+
+  def acquire(self):
+    """blocks until the bucket admits another call."""
+    with self._lock:
+      now = self.clock.time()
+      self._sent.append(now)
+      self._sent_rate(now)
+      if self.rate is None:
+        return
+      self._tokens = min(
+          max(1.0, self.rate), self._tokens + (now - self._last_refill) * self.rate)
+      self._last_refill = now
+      # tokens may go negative, which reserves a slot for this call behind those already waiting.
+      self._tokens -= 1
+      wait = -self._tokens / self.rate
+    if wait > 0:
+      self.clock.sleep(wait)
+
+  def throttled(self):
+    with self._lock:
+      now = self.clock.time()
+      if self.rate is None:
+        self.rate = max(self.min_rate, self._sent_rate(now))
+        self._tokens, self._last_refill = 0.0, now
+      self.rate = max(self.min_rate, self.rate * self.decrease)
+
+  def succeeded(self):
+    with self._lock:
+      if self.rate is not None:
+        self.rate += self.increase
+
+  def call(self, function, *args, **kw):
+    """returns function(*args, **kw), admitted by the bucket and retried if throttled."""
+    for attempt in range(self.max_attempts):
+      self.acquire()
+      try:
+        result = function(*args, **kw)
+      except Exception as e:
+        throttled = self.is_throttle(e)
+        if not (throttled or self.is_transient(e)) or attempt == self.max_attempts - 1:
+          raise
+        if throttled:
+          self.throttled()
+        self.clock.sleep(
+            random.uniform(0.5, 1.0) * min(self.max_backoff, self.backoff * 2 ** attempt))
+      else:
+        self.succeeded()
+        return result
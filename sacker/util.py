@@ -1,12 +1,29 @@
 from __future__ import print_function
 
+import errno
 import hashlib
+import os
+import shutil
 import sys
+import tempfile
+from contextlib import contextmanager
 
 
-def compute_hash(filelike, chunksize=65536, hasher=hashlib.sha256):
+def compute_hash(filelike, chunksize=4 * 1024 * 1024, hasher=hashlib.sha256):
   hash = hasher()
 
+  # read into a single reusable buffer where possible to avoid allocating per chunk.
+  if hasattr(filelike, 'readinto'):
+    buf = bytearray(chunksize)
+    view = memoryview(buf)
+    while True:
+      length = filelike.readinto(buf)
+      if length:
+        hash.update(view[:length])
+      else:
+        break
+    return hash.hexdigest()
+
   while True:
     data = filelike.read(chunksize)
     if data:
@@ -17,6 +34,44 @@ def compute_hash(filelike, chunksize=65536, hasher=hashlib.sha256):
   return hash.hexdigest()
 
 
+class TeeReader(object):
+  """a readable file-like object that copies everything read from filelike to out."""
+
+  def __init__(self, filelike, out):
+    self.filelike = filelike
+    self.out = out
+
+  def read(self, size=-1):
+    data = self.filelike.read(size) if size >= 0 else self.filelike.read()
+    self.out.write(data)
+    return data
+
+
 def die(msg, rc=1):
   print(msg, file=sys.stderr)
   sys.exit(rc)
+
+
+def warn(msg):
+  print(msg, file=sys.stderr)
+
+
+def safe_mkdir(dirname):
+  try:
+    os.makedirs(dirname)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+
+def sacker_home():
+  return os.environ.get('SACKER_HOME', os.path.expanduser('~/.sacker'))
+
+
+@contextmanager
+def temporary_dir():
+  dirname = tempfile.mkdtemp()
+  try:
+    yield dirname
+  finally:
+    shutil.rmtree(dirname, ignore_errors=True)
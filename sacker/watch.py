@@ -0,0 +1,60 @@
+import random
+import time
+
+
+class TagWatcher(object):
+  """Watches any number of package tags from a single loop.
+
+  Each tag is polled with Ledger.poll_tag, which backends implement as cheaply as they can, e.g.
+  with conditional requests.  The polling interval of a tag backs off while it is unchanged and
+  resets as soon as it changes.
+  """
+
+  def __init__(self, ledger, min_interval=1.0, max_interval=60.0, backoff=1.5):
+    self.ledger = ledger
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.backoff = backoff
+
+  def _poll(self, package_name, tag_name, token):
+    try:
+      return self.ledger.poll_tag(package_name, tag_name, token)
+    except self.ledger.Error:
+      # the tag does not exist (yet).
+      return True, None, None
+
+  def watch(self, tags, callback, initial=False, clock=time):
+    """calls callback(package_name, tag_name, version) whenever one of tags changes version.
+
+    tags is a list of (package_name, tag_name) pairs.  if initial is True, callback is also called
+    with the version of each tag when the watch starts.  returns when callback returns False.
+    """
+    state = {}
+    now = clock.time()
+    for package_name, tag_name in tags:
+      _, version, token = self._poll(package_name, tag_name, None)
+      state[(package_name, tag_name)] = {
+          'version': version,
+          'token': token,
+          'interval': self.min_interval,
+          'next_poll': now + self.min_interval,
+      }
+      if initial and version is not None and callback(package_name, tag_name, version) is False:
+        return
+
+    while True:
+      key, watched = min(state.items(), key=lambda item: item[1]['next_poll'])
+      clock.sleep(max(0, watched['next_poll'] - clock.time()))
+
+      changed, version, token = self._poll(key[0], key[1], watched['token'])
+      watched['token'] = token
+      if changed and version != watched['version']:
+        watched['version'] = version
+        watched['interval'] = self.min_interval
+        if version is not None and callback(key[0], key[1], version) is False:
+          return
+      else:
+        watched['interval'] = min(watched['interval'] * self.backoff, self.max_interval)
+
+      # jitter so that many watchers started together do not poll in lockstep.
+      watched['next_poll'] = clock.time() + watched['interval'] * random.uniform(0.9, 1.1)
@@ -9,6 +9,15 @@ setup(
     'console_scripts': [
       'sacker = sacker.bin.sacker:main',
     ],
+    'sacker.ledgers': [
+        'dynamo = sacker.ledgers.dynamo:DynamoLedger',
+        'memory = sacker.ledgers.memory:MemoryLedger',
+        's3 = sacker.ledgers.s3:S3Ledger',
+    ],
+    'sacker.stores': [
+        'memory = sacker.stores.memory:MemoryStore',
+        's3 = sacker.stores.s3:S3Store',
+    ],
     'apache.aurora.client.cli.plugin': [
         'SackerBindingHelperPlugin = sacker.extensions.aurora.binding_helper:SackerBindingHelperPlugin',
         'SackerDeployCommandPlugin = sacker.extensions.aurora.deploy_noun:DeployCommandPlugin',
@@ -25,5 +34,9 @@ setup(
   # todo use extras_require
   install_requires = [
     'boto3',
-  ]
+  ],
+  extras_require = {
+    'blake2': ['pyblake2'],
+    'delta': ['bsdiff4'],
+  },
 )
@@ -0,0 +1,149 @@
+import os
+
+import pytest
+
+from sacker.hashing import hash_bytes
+from sacker.ledgers.memory import MemoryLedger
+from sacker.package import Package
+from sacker.stores.memory import MemoryStore
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmpdir, monkeypatch):
+  # keep caches, state files and credentials of the host out of the tests.
+  monkeypatch.setenv('SACKER_HOME', str(tmpdir.join('sacker')))
+  monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+  monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+  monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+  MemoryLedger.reset_all()
+  MemoryStore.reset_all()
+  yield
+  MemoryLedger.reset_all()
+  MemoryStore.reset_all()
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.0
+    self.sleeps = []
+    self.on_sleep = None
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+    if self.on_sleep:
+      self.on_sleep()
+
+
+@pytest.fixture
+def clock():
+  """a clock whose sleeps only advance its time and call its on_sleep, if set."""
+  return FakeClock()
+
+
+@pytest.fixture
+def ledger():
+  return MemoryLedger('test')
+
+
+@pytest.fixture
+def store():
+  return MemoryStore('test')
+
+
+@pytest.fixture
+def cli(capsys):
+  """returns cli(*argv), which runs a sacker command against the memory ledger and store of the
+  ledger and store fixtures and returns what it printed."""
+  from sacker.bin.sacker import register_all, setup_argparser, setup_defaults
+  register_all()
+  parser = setup_argparser()
+
+  def cli(*argv):
+    args = parser.parse_args(['--ledger', 'memory://test', '--store', 'memory://test'] +
+                             list(argv))
+    setup_defaults(args)
+    args.func(args.ledger, args.store, args)
+    return capsys.readouterr().out
+  return cli
+
+
+@pytest.fixture
+def put_versions():
+  """returns put_versions(ledger, package_name, versions), which puts placeholder packages
+  timestamped with their version."""
+  def put_versions(ledger, package_name, versions):
+    for version in versions:
+      ledger.put(Package(package_name, version, 'sha%d' % version, 'pkg.tar', 0644, {},
+                         timestamp=float(version)))
+  return put_versions
+
+
+@pytest.fixture
+def add_version():
+  """returns add_version(ledger, store, package_name, data), which stores data and adds it as
+  the next version of the package, returning its info."""
+  def add_version(ledger, store, package_name, data):
+    sha = hash_bytes(data)
+    store.put(sha, data)
+    return ledger.info(package_name, ledger.add(package_name, 'pkg.tar', sha, 0644))
+  return add_version
+
+
+@pytest.fixture
+def emulate_conditions():
+  """returns emulate_conditions(connection), which makes an S3 client honor IfMatch and
+  IfNoneMatch on writes and reads of an object, as S3 does and moto does not."""
+  from botocore.exceptions import ClientError
+
+  def emulate_conditions(connection):
+    def check(params, model, **kw):
+      if 'IfMatch' not in params and 'IfNoneMatch' not in params:
+        return
+      try:
+        etag = connection.head_object(Bucket=params['Bucket'], Key=params['Key'])['ETag']
+      except ClientError:
+        etag = None
+      if 'IfMatch' in params and etag != params['IfMatch']:
+        raise ClientError({'Error': {'Code': 'PreconditionFailed', 'Message': ''}}, model.name)
+      if 'IfNoneMatch' in params and etag is not None and params['IfNoneMatch'] in ('*', etag):
+        # reads of an unchanged object are not modified, writes over any object fail.
+        code = '304' if model.name == 'GetObject' else 'PreconditionFailed'
+        raise ClientError({'Error': {'Code': code, 'Message': ''}}, model.name)
+
+    for operation in ('GetObject', 'PutObject'):
+      connection.meta.events.register_first('before-parameter-build.s3.%s' % operation, check)
+    return connection
+  return emulate_conditions
+
+
+@pytest.fixture
+def s3_ledger():
+  moto = pytest.importorskip('moto')
+  from sacker.ledgers.s3 import S3Ledger
+  with moto.mock_s3():
+    ledger = S3Ledger('sacker-test-ledger')
+    ledger.init()
+    yield ledger
+
+
+@pytest.fixture
+def s3_store():
+  moto = pytest.importorskip('moto')
+  from sacker.stores.s3 import S3Store
+  with moto.mock_s3():
+    store = S3Store('sacker-test-store')
+    store.init()
+    yield store
+
+
+@pytest.fixture
+def s3_calls(s3_store):
+  """returns the names of the S3 operations that s3_store calls from then on."""
+  calls = []
+  s3_store.connection.meta.events.register(
+      'before-call.s3', lambda model, **kw: calls.append(model.name))
+  return calls
@@ -0,0 +1,79 @@
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from sacker.archive import ArchiveError, build_index, index_name, iter_member
+from sacker.hashing import hash_file
+
+MEMBERS = {'bin/tool': b'#!/bin/sh\n' * 1000, 'README': b'read me\n'}
+
+
+def make_tar(filename):
+  with tarfile.open(filename, 'w') as tf:
+    for name, data in sorted(MEMBERS.items()):
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      tf.addfile(info, io.BytesIO(data))
+  return filename
+
+
+def make_zip(filename, compression=zipfile.ZIP_DEFLATED):
+  with zipfile.ZipFile(filename, 'w', compression) as zf:
+    zf.writestr('bin/', b'')
+    for name, data in sorted(MEMBERS.items()):
+      zf.writestr(name, data)
+  return filename
+
+
+def read_member(store, sha, index, member_name):
+  return b''.join(iter_member(store, sha, index, member_name))
+
+
+@pytest.mark.parametrize('make_archive', [
+    make_tar,
+    make_zip,
+    lambda filename: make_zip(filename, zipfile.ZIP_STORED),
+])
+def test_members_read_by_range(tmpdir, store, make_archive):
+  filename = make_archive(str(tmpdir.join('archive')))
+  sha = hash_file(filename)
+  store.upload(sha, filename)
+  index = build_index(filename)
+  assert sorted(index['members']) == sorted(MEMBERS)
+  for name, data in MEMBERS.items():
+    assert read_member(store, sha, index, name) == data
+  with pytest.raises(ArchiveError):
+    read_member(store, sha, index, 'missing')
+
+
+def test_compressed_tar_is_not_indexed(tmpdir):
+  filename = str(tmpdir.join('archive.tar.gz'))
+  with tarfile.open(filename, 'w:gz') as tf:
+    tf.add(make_tar(str(tmpdir.join('archive.tar'))), 'archive.tar')
+  assert build_index(filename) is None
+
+
+def test_add_index_and_cat(tmpdir, cli, store):
+  filename = make_tar(str(tmpdir.join('archive.tar')))
+  assert cli('add', '--index', 'pkg', filename).strip() == '1'
+  assert store.exists(index_name(hash_file(filename)))
+  assert cli('cat', 'pkg', 'latest', 'README') == MEMBERS['README']
+
+
+def test_add_index_rejects_other_files_before_uploading(tmpdir, cli, ledger, store):
+  filename = str(tmpdir.join('package.bin'))
+  with open(filename, 'wb') as fp:
+    fp.write(b'not an archive')
+  with pytest.raises(SystemExit):
+    cli('add', '--index', 'pkg', filename)
+  assert not store.exists(hash_file(filename))
+  assert list(ledger.list_package_versions('pkg')) == []
+
+
+def test_cat_without_index(tmpdir, cli, store):
+  cli('add', 'pkg', make_tar(str(tmpdir.join('archive.tar'))))
+  with pytest.raises(SystemExit):
+    cli('cat', 'pkg', 'latest', 'README')
+
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from sacker.bandwidth import BandwidthMeter, TransferCoordinator
+
+
+@pytest.fixture
+def coordinator(tmpdir, clock):
+  """returns coordinator(**kw), which makes a coordinator of the host sharing tmpdir."""
+  def coordinator(**kw):
+    return TransferCoordinator(str(tmpdir.join('transfers')), clock=clock, **kw)
+  return coordinator
+
+
+def release_after(clock, polls, ticket):
+  """releases ticket, as returned by _enqueue, once clock has slept polls times."""
+  queue_dir, (name, fp) = ticket
+
+  def release():
+    if len(clock.sleeps) == polls:
+      os.unlink(os.path.join(queue_dir, name))
+      fp.close()
+  clock.on_sleep = release
+
+
+def test_reserve_within_budget(coordinator, clock):
+  background = coordinator(bandwidth_limit=1000, priority='background')
+  background.reserve(600)
+  assert clock.sleeps == []
+  background.reserve(600)
+  # the second reservation waits for the 200 bytes the bucket lacks.
+  assert sum(clock.sleeps) == pytest.approx(0.2)
+
+
+def test_reserve_waits_for_higher_priority(coordinator, clock):
+  interactive = coordinator(bandwidth_limit=1000, priority='interactive')
+  background = coordinator(bandwidth_limit=1000, priority='background')
+  # an interactive reservation is waiting for tokens, so a background one must wait too even
+  # though the bucket is full.
+  queue_dir = interactive.bandwidth_queue_dir
+  release_after(clock, 3, (queue_dir, interactive._enqueue(queue_dir)))
+  background.reserve(100)
+  assert len(clock.sleeps) == 3
+  assert os.listdir(queue_dir) == []
+
+
+def test_reserve_ahead_of_lower_priority(coordinator, clock):
+  interactive = coordinator(bandwidth_limit=1000, priority='interactive')
+  background = coordinator(bandwidth_limit=1000, priority='background')
+  background.reserve(1000)
+  # a background reservation queued before is served after the interactive one.
+  queue_dir = background.bandwidth_queue_dir
+  waiting, _ = background._enqueue(queue_dir)
+  interactive.reserve(500)
+  assert sum(clock.sleeps) == pytest.approx(0.5)
+  assert os.listdir(queue_dir) == [waiting]
+
+
+def test_slots_go_to_higher_priority(coordinator, clock):
+  interactive = coordinator(max_transfers=1, priority='interactive')
+  background = coordinator(max_transfers=1, priority='background')
+  slot = background._acquire_slot()
+  waiting, _ = background._enqueue(background.queue_dir)
+
+  def release_slot():
+    if len(clock.sleeps) == 2:
+      slot.close()
+  clock.on_sleep = release_slot
+  with interactive.transfer() as callback:
+    assert callback is None
+    assert len(clock.sleeps) == 2
+    assert os.listdir(interactive.queue_dir) == [waiting]
+
+
+def test_meter_reserves_in_chunks(coordinator, clock, monkeypatch):
+  reserved = []
+  limited = coordinator(bandwidth_limit=10 * 1024 * 1024)
+  monkeypatch.setattr(limited, 'reserve', reserved.append)
+  with limited.transfer() as callback:
+    assert isinstance(callback, BandwidthMeter)
+    for _ in range(5):
+      callback(300 * 1024)
+  assert reserved == [1200 * 1024]
+
+
+def test_unknown_priority(coordinator):
+  with pytest.raises(ValueError):
+    coordinator(priority='urgent')
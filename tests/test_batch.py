@@ -0,0 +1,47 @@
+import json
+from StringIO import StringIO
+
+import pytest
+
+
+@pytest.fixture
+def batch(cli, monkeypatch):
+  """returns batch(lines, *argv), which runs lines through sacker batch and returns its stdout."""
+  def batch(lines, *argv):
+    monkeypatch.setattr('sys.stdin', StringIO(''.join(line + '\n' for line in lines)))
+    return cli('batch', *argv)
+  return batch
+
+
+@pytest.fixture
+def pkg(ledger, put_versions):
+  put_versions(ledger, 'pkg', range(1, 4))
+
+
+def test_batch_output_is_in_request_order(batch, pkg):
+  requests = ['# comment', ''] + ['versions pkg --since %d' % since for since in (3, 1, 2)]
+  assert batch(requests, '-j', '3') == '3\n1\n2\n3\n2\n3\n'
+
+
+def test_batch_requests_share_the_ledger(batch, ledger, pkg):
+  assert batch(['tag pkg 2 live', 'tags pkg']) == 'latest\nlive\n'
+  assert ledger.info('pkg', 'live').version == 2
+
+
+def test_batch_json_reports_each_request(batch, pkg):
+  requests = [['versions', 'pkg', '--since', '3'], {'args': ['info', 'pkg']}]
+  responses = [json.loads(line) for line in batch(map(json.dumps, requests), '--json').splitlines()]
+  assert responses[0] == {'rc': 0, 'stdout': '3\n', 'stderr': ''}
+  # argparse exits with 2 on bad arguments, and the batch carries on.
+  assert responses[1]['rc'] == 2
+  assert 'too few arguments' in responses[1]['stderr']
+
+
+@pytest.mark.parametrize('request_line, error', [
+    ('add pkg -', 'Requests in a batch cannot use "-"'),
+    ('batch', 'Batches cannot be nested.'),
+])
+def test_batch_rejects_requests(batch, pkg, request_line, error):
+  response = json.loads(batch([json.dumps(request_line.split())], '--json'))
+  assert response['rc'] == 1
+  assert error in response['stderr']
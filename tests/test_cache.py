@@ -0,0 +1,54 @@
+import os
+
+from sacker.cache import LocalCache
+from sacker.hashing import hash_bytes
+from sacker.serve import BlobServer
+
+
+def put_blob(store, data):
+  sha = hash_bytes(data)
+  store.put(sha, data)
+  return sha
+
+
+def age(cache, sha, seconds_ago):
+  mtime = os.path.getmtime(cache.path(sha)) - seconds_ago
+  os.utime(cache.path(sha), (mtime, mtime))
+
+
+def test_trim_evicts_least_recently_used(tmpdir, store):
+  cache = LocalCache(str(tmpdir.join('cache')))
+  old, used, new = [put_blob(store, data) for data in (b'a' * 10, b'b' * 10, b'c' * 10)]
+  for sha, seconds_ago in ((old, 30), (used, 20), (new, 10)):
+    cache.fetch(store, sha)
+    age(cache, sha, seconds_ago)
+  # a cache hit makes the blob the most recently used, whatever the atime of the mount.
+  cache.fetch(store, used)
+  cache.trim(20)
+  assert old not in cache
+  assert used in cache
+  assert new in cache
+
+
+def test_serve_refills_blob_evicted_before_open(tmpdir, store, monkeypatch):
+  cache = LocalCache(str(tmpdir.join('cache')))
+  sha = put_blob(store, b'blob')
+  server = BlobServer(('127.0.0.1', 0), store, cache)
+  try:
+    fill = server.fill
+    evictions = []
+
+    def fill_then_evict(sha):
+      path = fill(sha)
+      if not evictions:
+        # a concurrent fill trims the blob before it is opened.
+        evictions.append(sha)
+        cache.remove(sha)
+      return path
+
+    monkeypatch.setattr(server, 'fill', fill_then_evict)
+    with server.open(sha) as fp:
+      assert fp.read() == b'blob'
+    assert evictions == [sha]
+  finally:
+    server.server_close()
@@ -0,0 +1,40 @@
+import pytest
+
+from sacker.bin.sacker import register_all, setup_argparser, setup_defaults
+from sacker.ledgers.memory import MemoryLedger
+from sacker.snapshot import SnapshotLedger
+
+
+@pytest.fixture
+def parse():
+  register_all()
+  parser = setup_argparser()
+
+  def parse(*argv):
+    args = parser.parse_args(['--ledger', 'memory://test', '--store', 'memory://test'] +
+                             list(argv))
+    setup_defaults(args)
+    return args
+  return parse
+
+
+@pytest.mark.parametrize('argv', [
+    ['info', 'pkg', 'latest'],
+    ['versions', 'pkg'],
+    ['tags', 'pkg'],
+])
+def test_snapshot_serves_reads(parse, argv):
+  assert isinstance(parse('--snapshot', *argv).ledger, SnapshotLedger)
+
+
+@pytest.mark.parametrize('argv', [
+    ['tag', 'pkg', '1', 'live'],
+    ['remove', 'pkg', '1'],
+    ['prune', 'pkg', '--keep-last', '1'],
+])
+def test_snapshot_leaves_writes_on_ledger(parse, argv):
+  assert isinstance(parse('--snapshot', *argv).ledger, MemoryLedger)
+
+
+def test_ledger_without_snapshot(parse):
+  assert isinstance(parse('info', 'pkg', 'latest').ledger, MemoryLedger)
@@ -0,0 +1,84 @@
+import argparse
+
+import pytest
+
+import sacker.delta
+from sacker.bin.sacker import add_delta, download_package
+from sacker.cache import LocalCache
+from sacker.delta import delta_name, publish_delta
+from sacker.hashing import hash_file
+
+BASE = b'base' * 1000
+TARGET = BASE + b'target'
+
+
+@pytest.fixture
+def cache(tmpdir):
+  return LocalCache(str(tmpdir.join('cache')))
+
+
+def write(filename, data):
+  with open(filename, 'wb') as fp:
+    fp.write(data)
+  return filename
+
+
+def download(ledger, store, cache, info, output_filename):
+  args = argparse.Namespace(output_filename=output_filename, delta=True, cache=cache)
+  download_package(ledger, store, args, info)
+  with open(output_filename, 'rb') as fp:
+    return fp.read()
+
+
+@pytest.fixture
+def target(tmpdir, ledger, store, cache, add_version):
+  """returns the second of two versions of pkg, with the first in the cache."""
+  base = add_version(ledger, store, 'pkg', BASE)
+  cache.insert(base.sha, write(str(tmpdir.join('base')), BASE))
+  return add_version(ledger, store, 'pkg', TARGET)
+
+
+def test_download_applies_delta(tmpdir, ledger, store, cache, target):
+  pytest.importorskip('bsdiff4')
+  base = ledger.info('pkg', 1)
+  assert publish_delta(
+      store, base.sha, cache.path(base.sha), target.sha, write(str(tmpdir.join('v2')), TARGET))
+  assert download(ledger, store, cache, target, str(tmpdir.join('out'))) == TARGET
+  assert target.sha in cache
+
+
+def test_download_falls_back_on_corrupt_delta(tmpdir, ledger, store, cache, target):
+  pytest.importorskip('bsdiff4')
+  store.put(delta_name(ledger.info('pkg', 1).sha, target.sha), b'not a delta')
+  assert download(ledger, store, cache, target, str(tmpdir.join('out'))) == TARGET
+
+
+def test_download_falls_back_without_bsdiff4(tmpdir, ledger, store, cache, target, monkeypatch):
+  monkeypatch.setattr(sacker.delta, 'bsdiff4', None)
+  assert download(ledger, store, cache, target, str(tmpdir.join('out'))) == TARGET
+
+
+def test_download_falls_back_on_store_error(tmpdir, ledger, store, cache, target, monkeypatch):
+  pytest.importorskip('bsdiff4')
+  downloads = []
+  store_download = store.download
+
+  def fail_first(sha, filename):
+    # the delta is the first blob downloaded, the full package the second.
+    downloads.append(sha)
+    if len(downloads) == 1:
+      raise store.Error('store unavailable')
+    return store_download(sha, filename)
+
+  monkeypatch.setattr(store, 'download', fail_first)
+  assert download(ledger, store, cache, target, str(tmpdir.join('out'))) == TARGET
+  assert downloads == [delta_name(ledger.info('pkg', 1).sha, target.sha), target.sha]
+
+
+def test_add_skips_delta_without_bsdiff4(tmpdir, ledger, store, cache, target, monkeypatch):
+  monkeypatch.setattr(sacker.delta, 'bsdiff4', None)
+  filename = write(str(tmpdir.join('v3')), TARGET + b'next')
+  sha = hash_file(filename)
+  add_delta(ledger, store, cache, 'pkg', sha, filename)
+  assert sha in cache
+  assert not store.exists(delta_name(target.sha, sha))
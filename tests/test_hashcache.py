@@ -0,0 +1,89 @@
+import hashlib
+import io
+import os
+import time
+
+import pytest
+
+import sacker.hashcache
+from sacker.hashcache import HashCache
+from sacker.util import TeeReader, compute_hash
+
+
+def write(filename, data, seconds_ago=60):
+  with open(filename, 'wb') as fp:
+    fp.write(data)
+  mtime = time.time() - seconds_ago
+  os.utime(filename, (mtime, mtime))
+  return filename
+
+
+@pytest.fixture
+def hashcache(tmpdir):
+  return HashCache(str(tmpdir.join('hashes.db')))
+
+
+@pytest.fixture
+def no_rehash(monkeypatch):
+  """fails the test if a file is hashed rather than served from the cache."""
+  def rehash():
+    def get_algorithm(name):
+      raise AssertionError('file was hashed again')
+    monkeypatch.setattr(sacker.hashcache, 'get_algorithm', get_algorithm)
+  return rehash
+
+
+@pytest.fixture(params=['xattr', 'sqlite'])
+def backend(request, monkeypatch):
+  """runs the test with hashes kept in extended attributes, emulated since few test hosts have
+  them, and again with them kept in sqlite."""
+  if request.param == 'xattr':
+    attributes = {}
+
+    def getxattr(filename, name):
+      try:
+        return attributes[filename, name]
+      except KeyError:
+        raise IOError('no such attribute')
+
+    def setxattr(filename, name, value):
+      attributes[filename, name] = value
+  else:
+    getxattr = setxattr = None
+  monkeypatch.setattr(sacker.hashcache, 'getxattr', getxattr)
+  monkeypatch.setattr(sacker.hashcache, 'setxattr', setxattr)
+  return request.param
+
+
+def test_compute_hash_matches_hashlib():
+  data = os.urandom(10000)
+  assert compute_hash(io.BytesIO(data), chunksize=4096) == hashlib.sha256(data).hexdigest()
+  # file-likes without readinto are read in chunks.
+  reader = TeeReader(io.BytesIO(data), io.BytesIO())
+  assert compute_hash(reader, chunksize=4096, hasher=hashlib.sha1) == hashlib.sha1(data).hexdigest()
+
+
+def test_unchanged_file_is_not_hashed_again(tmpdir, hashcache, no_rehash, backend):
+  filename = write(str(tmpdir.join('pkg')), b'v1')
+  sha = hashcache.hash_file(filename)
+  assert sha == hashlib.sha256(b'v1').hexdigest()
+  no_rehash()
+  assert hashcache.hash_file(filename) == sha
+  # algorithms are cached independently.
+  with pytest.raises(AssertionError):
+    hashcache.hash_file(filename, 'sha512')
+
+
+def test_modified_file_is_hashed_again(tmpdir, hashcache, backend):
+  filename = write(str(tmpdir.join('pkg')), b'v1')
+  hashcache.hash_file(filename)
+  write(filename, b'v2', seconds_ago=30)
+  assert hashcache.hash_file(filename) == hashlib.sha256(b'v2').hexdigest()
+
+
+def test_racily_clean_file_is_not_cached(tmpdir, hashcache, no_rehash, backend):
+  filename = write(str(tmpdir.join('pkg')), b'v1', seconds_ago=0)
+  hashcache.hash_file(filename)
+  no_rehash()
+  with pytest.raises(AssertionError):
+    hashcache.hash_file(filename)
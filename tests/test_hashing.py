@@ -0,0 +1,64 @@
+import hashlib
+import io
+
+import pytest
+
+from sacker.hashing import (
+    TreeAlgorithm,
+    UnknownAlgorithm,
+    hash_bytes,
+    hash_file,
+    parse_address,
+    verify_file,
+    verify_stream,
+)
+
+
+@pytest.fixture
+def tree():
+  algorithm = TreeAlgorithm('sha256-tree', hashlib.sha256, workers=3)
+  algorithm.SEGMENT_SIZE = 16
+  return algorithm
+
+
+def tree_digest(data, segment_size):
+  root = hashlib.sha256(b'sha256-tree:%d:' % segment_size)
+  for offset in range(0, len(data), segment_size) or [0]:
+    root.update(hashlib.sha256(data[offset:offset + segment_size]).digest())
+  return root.hexdigest()
+
+
+@pytest.mark.parametrize('size', [0, 1, 15, 16, 17, 32, 100])
+def test_tree_digest_is_the_same_for_files_streams_and_bytes(tmpdir, tree, size):
+  data = bytes(bytearray(i % 251 for i in range(size)))
+  filename = str(tmpdir.join('pkg'))
+  with open(filename, 'wb') as fp:
+    fp.write(data)
+  expected = tree_digest(data, 16)
+  assert tree.digest_file(filename) == expected
+  assert tree.digest_stream(io.BytesIO(data)) == expected
+  assert tree.digest_bytes(data) == expected
+
+
+def test_addresses_name_their_algorithm(tmpdir):
+  filename = str(tmpdir.join('pkg'))
+  with open(filename, 'wb') as fp:
+    fp.write(b'pkg')
+  # sha256 addresses are unprefixed, so they are compatible with older ledgers.
+  assert hash_file(filename) == hashlib.sha256(b'pkg').hexdigest()
+  address = hash_file(filename, 'sha256-tree')
+  assert address == 'sha256-tree:%s' % tree_digest(b'pkg', TreeAlgorithm.SEGMENT_SIZE)
+  assert parse_address(address) == ('sha256-tree', address.split(':')[1])
+  assert hash_bytes(b'pkg', 'sha512') == 'sha512:%s' % hashlib.sha512(b'pkg').hexdigest()
+
+  # the algorithm to verify with is taken from the address.
+  assert verify_file(filename, address)
+  assert verify_stream(io.BytesIO(b'pkg'), address)
+  assert not verify_stream(io.BytesIO(b'other'), address)
+
+
+def test_unknown_algorithm():
+  with pytest.raises(UnknownAlgorithm):
+    hash_bytes(b'pkg', 'md4-tree')
+  with pytest.raises(UnknownAlgorithm):
+    verify_stream(io.BytesIO(b'pkg'), 'md4-tree:00')
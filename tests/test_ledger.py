@@ -0,0 +1,171 @@
+import pytest
+
+
+def test_tags_lists_latest_only_with_versions(ledger, put_versions):
+  assert list(ledger.tags('pkg')) == []
+  put_versions(ledger, 'pkg', [1])
+  ledger.tag('pkg', 1, 'live')
+  assert list(ledger.tags('pkg')) == ['latest', 'live']
+  ledger.remove('pkg', 1)
+  assert list(ledger.tags('pkg')) == ['live']
+
+
+def test_s3_tags_current_after_compaction(s3_ledger, put_versions):
+  put_versions(s3_ledger, 'pkg', range(1, 4))
+  s3_ledger.tag('pkg', 1, 'live')
+  s3_ledger.compact('pkg')
+  s3_ledger.tag('pkg', 2, 'staging')
+  s3_ledger.untag('pkg', 'live')
+  # a write-only client tags by writing the tag object alone.
+  s3_ledger.connection.put_object(
+      Bucket=s3_ledger.bucket_name, Key='pkg/tags/canary', Body='{"version": 3}')
+  assert sorted(s3_ledger.tags('pkg')) == ['canary', 'latest', 'staging']
+  assert s3_ledger.info('pkg', 'canary').version == 3
+  assert s3_ledger.info('pkg', 'staging').version == 2
+  with pytest.raises(s3_ledger.DoesNotExist):
+    s3_ledger.info('pkg', 'live')
+
+
+def test_s3_tags_without_versions(s3_ledger, put_versions):
+  put_versions(s3_ledger, 'pkg', range(1, 3))
+  s3_ledger.compact('pkg')
+  s3_ledger.remove_many('pkg', [1, 2])
+  assert 'latest' not in list(s3_ledger.tags('pkg'))
+
+
+@pytest.fixture
+def s3_client(s3_ledger, emulate_conditions):
+  """returns a function that makes another client of the bucket of s3_ledger.  like their
+  ledger, clients fail conditional writes as S3 does."""
+  from sacker.ledgers.s3 import S3Ledger
+
+  def conditional(ledger):
+    emulate_conditions(ledger.connection)
+    # versions are read in order.
+    ledger.COMPACTION_CONCURRENCY = 1
+    return ledger
+
+  conditional(s3_ledger)
+  return lambda: conditional(S3Ledger(s3_ledger.bucket_name))
+
+
+def during_compaction(ledger, monkeypatch, write):
+  """runs write once compaction of ledger has read the index and is reading new versions."""
+  info = ledger.info
+
+  def interrupt(package_name, spec):
+    monkeypatch.setattr(ledger, 'info', info)
+    write()
+    return info(package_name, spec)
+
+  monkeypatch.setattr(ledger, 'info', interrupt)
+
+
+def test_s3_index_writes_are_conditional(s3_ledger, put_versions):
+  headers = []
+  s3_ledger.connection.meta.events.register(
+      'before-sign.s3.PutObject', lambda request, **kw: headers.append(dict(request.headers)))
+  put_versions(s3_ledger, 'pkg', [1])
+  s3_ledger.compact('pkg')
+  assert headers[-1]['If-None-Match'] == '*'
+  etag = s3_ledger.connection.head_object(
+      Bucket=s3_ledger.bucket_name, Key='pkg/index.json')['ETag']
+  s3_ledger.compact('pkg')
+  assert headers[-1]['If-Match'] == etag
+
+
+def test_s3_put_during_compaction_is_kept(s3_ledger, s3_client, put_versions, monkeypatch):
+  put_versions(s3_ledger, 'pkg', [1, 2, 4, 5])
+  s3_ledger.compact('pkg')
+  put_versions(s3_ledger, 'pkg', [6, 7])
+  # a version below the high water mark is put while the index is being compacted.
+  during_compaction(s3_ledger, monkeypatch, lambda: put_versions(s3_client(), 'pkg', [3]))
+  s3_ledger.compact('pkg')
+  assert sorted(s3_ledger._read_index('pkg')['versions']) == ['1', '2', '3', '4', '5', '6', '7']
+  assert list(s3_ledger.list_package_versions('pkg')) == [1, 2, 3, 4, 5, 6, 7]
+
+
+def test_s3_remove_during_compaction_is_kept(s3_ledger, s3_client, put_versions, monkeypatch):
+  put_versions(s3_ledger, 'pkg', [1, 2, 3])
+  s3_ledger.compact('pkg')
+  put_versions(s3_ledger, 'pkg', [4, 5])
+  during_compaction(s3_ledger, monkeypatch, lambda: s3_client().remove_many('pkg', [2]))
+  s3_ledger.compact('pkg')
+  assert list(s3_ledger.list_package_versions('pkg')) == [1, 3, 4, 5]
+
+
+def test_s3_listing_during_prune(s3_ledger, s3_client, put_versions, monkeypatch):
+  put_versions(s3_ledger, 'pkg', [1, 2])
+  s3_ledger.compact('pkg')
+  put_versions(s3_ledger, 'pkg', [3, 4, 5])
+  # listing compacts the new versions, while another client prunes one of them.
+  monkeypatch.setattr(s3_ledger, 'COMPACTION_THRESHOLD', 3)
+  during_compaction(s3_ledger, monkeypatch, lambda: s3_client().remove_many('pkg', [5]))
+  assert list(s3_ledger.list_package_versions('pkg')) == [1, 2, 3, 4]
+  assert s3_ledger._read_index('pkg')['high_water'] == 4
+
+
+def test_resolve_many_integer_specs(ledger, put_versions):
+  put_versions(ledger, 'pkg', range(1, 4))
+  ledger.tag('pkg', 1, 'live')
+  resolved = ledger.resolve_many([('pkg', 2), ('pkg', '3'), ('pkg', 'live'), ('pkg', 'latest')])
+  assert [info.version for info in resolved] == [2, 3, 1, 3]
+
+
+def test_resolve_many_missing_version(ledger, put_versions):
+  put_versions(ledger, 'pkg', [1])
+  with pytest.raises(ledger.DoesNotExist):
+    ledger.resolve_many([('pkg', 1), ('pkg', 2)])
+
+
+def test_resolve_many_integer_specs_dynamo():
+  moto = pytest.importorskip('moto')
+  from sacker.ledgers.dynamo import DynamoLedger
+  with moto.mock_dynamodb2():
+    ledger = DynamoLedger('us-east-1', 'sacker-test-ledger')
+    ledger.init()
+    for _ in range(3):
+      ledger.add('pkg', 'pkg.tar', 'sha', 0644)
+    resolved = ledger.resolve_many([('pkg', 2), ('pkg', '1'), ('pkg', 'latest')])
+    assert [info.version for info in resolved] == [2, 1, 3]
+    assert list(ledger.list_packages()) == ['pkg']
+    assert list(ledger.list_package_versions('pkg')) == [1, 2, 3]
+
+
+def test_dynamo_capacity_from_uri():
+  moto = pytest.importorskip('moto')
+  from sacker.ledgers.dynamo import DynamoLedger
+  with moto.mock_dynamodb2():
+    ledger = DynamoLedger.from_uri('dynamo://us-east-1/sacker-test-ledger?rcu=5&wcu=2')
+    ledger.init()
+    for table in (ledger.table, ledger.tags_table, ledger.counters_table):
+      throughput = ledger.connection.Table(table).provisioned_throughput
+      assert (throughput['ReadCapacityUnits'], throughput['WriteCapacityUnits']) == (5, 2)
+  assert DynamoLedger.from_uri('dynamo://us-east-1/ledger?capacity=on-demand').on_demand
+  with pytest.raises(ValueError):
+    DynamoLedger.from_uri('dynamo://us-east-1/ledger?capacity=unlimited')
+
+
+def test_dynamo_retries_throttled_calls(monkeypatch):
+  moto = pytest.importorskip('moto')
+  from botocore.exceptions import ClientError
+  from sacker.ledgers.dynamo import DynamoLedger
+  monkeypatch.setattr(DynamoLedger, '_THROTTLES', {})
+  with moto.mock_dynamodb2():
+    ledger = DynamoLedger('us-east-1', 'sacker-test-ledger')
+    ledger.init()
+    ledger.add('pkg', 'pkg.tar', 'sha', 0644)
+    throttled = []
+
+    def throttle_once(model, **kw):
+      if not throttled:
+        throttled.append(model.name)
+        raise ClientError(
+            {'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': ''}},
+            model.name)
+
+    ledger.connection.meta.client.meta.events.register('before-call.dynamodb.Query', throttle_once)
+    assert list(ledger.list_package_versions('pkg')) == [1]
+    assert throttled == ['Query']
+    # the table is rate limited from then on, for every ledger of the process.
+    assert DynamoLedger('us-east-1', 'sacker-test-ledger').throttle(ledger.table).rate is not None
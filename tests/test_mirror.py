@@ -0,0 +1,74 @@
+from sacker.ledgers.memory import MemoryLedger
+from sacker.mirror import Mirror, MirrorState
+from sacker.stores.memory import MemoryStore
+
+
+def make_mirror(tmpdir, ledger, store):
+  return Mirror(ledger, store, MemoryLedger('target'), MemoryStore('target'),
+                MirrorState(str(tmpdir.join('mirror.json'))))
+
+
+def test_mirror_copies_only_new_versions(tmpdir, ledger, store, add_version):
+  add_version(ledger, store, 'pkg', b'v1')
+  ledger.tag('pkg', 1, 'live')
+  assert list(make_mirror(tmpdir, ledger, store).run()) == [('pkg', 1, 1, 1)]
+
+  add_version(ledger, store, 'pkg', b'v2')
+  ledger.tag('pkg', 2, 'live')
+  # a new run reads the high water mark from the state file left by the previous one.
+  mirror = make_mirror(tmpdir, ledger, store)
+  assert mirror.state.get('pkg')['high_water'] == 1
+  assert list(mirror.run()) == [('pkg', 1, 1, 1)]
+  assert mirror.state.get('pkg') == {'high_water': 2, 'tags': {'live': 2}}
+  assert list(mirror.target_ledger.list_package_versions('pkg')) == [1, 2]
+  assert mirror.target_ledger.info('pkg', 'live').version == 2
+
+  assert list(make_mirror(tmpdir, ledger, store).run()) == [('pkg', 0, 0, 0)]
+
+
+def test_mirror_resumes_interrupted_run(tmpdir, ledger, store, add_version, monkeypatch):
+  for data in (b'v1', b'v2', b'v3'):
+    add_version(ledger, store, 'pkg', data)
+  mirror = make_mirror(tmpdir, ledger, store)
+  target_put = mirror.target_ledger.put
+
+  def interrupt(package):
+    # the run is interrupted after mirroring version 1, before the state is advanced.
+    if package.version == 2:
+      raise KeyboardInterrupt
+    target_put(package)
+
+  monkeypatch.setattr(mirror.target_ledger, 'put', interrupt)
+  try:
+    list(mirror.run())
+  except KeyboardInterrupt:
+    pass
+  assert mirror.state.get('pkg')['high_water'] == 0
+
+  mirror = make_mirror(tmpdir, ledger, store)
+  # version 1 is already in the target, so only versions 2 and 3 are added.
+  assert list(mirror.run()) == [('pkg', 2, 0, 0)]
+  assert mirror.state.get('pkg')['high_water'] == 3
+  assert list(mirror.target_ledger.list_package_versions('pkg')) == [1, 2, 3]
+  for version in (1, 2, 3):
+    assert mirror.target_store.exists(ledger.info('pkg', version).sha)
+
+
+def test_mirror_skips_package_with_corrupt_blob(tmpdir, ledger, store, add_version, capsys):
+  good = add_version(ledger, store, 'good', b'good')
+  bad = add_version(ledger, store, 'bad', b'bad')
+  store.put(bad.sha, b'corrupt')
+  mirror = make_mirror(tmpdir, ledger, store)
+  assert list(mirror.run(['bad', 'good'])) == [('good', 1, 1, 0)]
+  assert mirror.failures == ['bad']
+  assert 'Blob %s appears to be corrupt' % bad.sha in capsys.readouterr().err
+  assert mirror.target_store.exists(good.sha)
+  assert not mirror.target_store.exists(bad.sha)
+  assert list(mirror.target_ledger.list_package_versions('bad')) == []
+  assert mirror.state.get('bad')['high_water'] == 0
+
+  # once the source is repaired, the next run mirrors the package.
+  store.put(bad.sha, b'bad')
+  mirror = make_mirror(tmpdir, ledger, store)
+  assert list(mirror.run(['bad'])) == [('bad', 1, 1, 0)]
+  assert mirror.failures == []
@@ -0,0 +1,56 @@
+from sacker.prune import RetentionPolicy, prune
+
+
+def test_select_keeps_last_tagged_and_latest():
+  policy = RetentionPolicy(keep_last=2)
+  versions = [(version, None) for version in range(1, 7)]
+  assert policy.select(versions, tagged=set([2])) == [1, 3, 4]
+
+
+def test_select_keeps_recent_and_unknown_ages():
+  policy = RetentionPolicy(keep_newer_than=10)
+  versions = [(1, 0.0), (2, None), (3, 95.0), (4, 96.0)]
+  assert policy.select(versions, tagged=set(), now=100.0) == [1]
+
+
+def test_prune_removes_untagged(ledger, put_versions):
+  put_versions(ledger, 'pkg', range(1, 6))
+  ledger.tag('pkg', 2, 'live')
+  pruned, versions = prune(ledger, 'pkg', RetentionPolicy(keep_last=1))
+  assert (pruned, versions) == ([1, 3, 4], 5)
+  assert list(ledger.list_package_versions('pkg')) == [2, 5]
+
+
+def test_prune_dry_run(ledger, put_versions):
+  put_versions(ledger, 'pkg', range(1, 4))
+  pruned, _ = prune(ledger, 'pkg', RetentionPolicy(keep_last=1), dry_run=True)
+  assert pruned == [1, 2]
+  assert list(ledger.list_package_versions('pkg')) == [1, 2, 3]
+
+
+def test_prune_rereads_tags_before_removing(ledger, put_versions, monkeypatch):
+  put_versions(ledger, 'pkg', range(1, 5))
+  tags = ledger.tags
+
+  def tag_while_listing(package_name):
+    # the version is tagged after the tags were first listed, e.g. by a concurrent release.
+    listed = list(tags(package_name))
+    monkeypatch.setattr(ledger, 'tags', tags)
+    ledger.tag(package_name, 2, 'live')
+    return listed
+
+  monkeypatch.setattr(ledger, 'tags', tag_while_listing)
+  pruned, _ = prune(ledger, 'pkg', RetentionPolicy(keep_last=1))
+  assert pruned == [1, 3]
+  assert list(ledger.list_package_versions('pkg')) == [2, 4]
+
+
+def test_prune_keeps_version_tagged_after_compaction(s3_ledger, put_versions):
+  put_versions(s3_ledger, 'pkg', range(1, 6))
+  s3_ledger.compact('pkg')
+  # a write-only client, e.g. CI, tags by writing the tag object alone.
+  s3_ledger.connection.put_object(
+      Bucket=s3_ledger.bucket_name, Key='pkg/tags/live', Body='{"version": 2}')
+  prune(s3_ledger, 'pkg', RetentionPolicy(keep_last=1))
+  assert list(s3_ledger.list_package_versions('pkg')) == [2, 5]
+  assert s3_ledger.info('pkg', 'live').version == 2
@@ -0,0 +1,210 @@
+import functools
+import os
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+
+def test_url_signs_without_requests(s3_store, s3_calls):
+  s3_store.layout = 'sharded'
+  url = s3_store.url('abcdef', expires=60)
+  assert s3_calls == []
+  assert '/ab/cd/abcdef?' in url
+  assert 'Expires=' in url
+
+
+def test_url_rejects_expiry_beyond_a_week(s3_store):
+  with pytest.raises(ValueError):
+    s3_store.url('abcdef', expires=s3_store.MAX_URL_EXPIRES + 1)
+  with pytest.raises(ValueError):
+    s3_store.url('abcdef', expires=0)
+
+
+def test_url_check_signs_legacy_key(s3_store):
+  s3_store.put('abcdef', b'data')
+  s3_store.layout = 'sharded'
+  assert '/abcdef?' in s3_store.url('abcdef', check=True)
+  assert '/ab/cd/abcdef?' in s3_store.url('abcdef')
+  with pytest.raises(s3_store.DoesNotExist):
+    s3_store.url('missing', check=True)
+
+
+DATA = b''.join(b'%02d' % k for k in range(20))
+
+
+@pytest.fixture
+def chunked(s3_store, monkeypatch):
+  """s3_store transferring blobs of 16 bytes or more in resumable chunks of 8 bytes, one at a
+  time."""
+  from moto.s3 import models
+  monkeypatch.setattr(models, 'UPLOAD_PART_MIN_SIZE', 1)
+  monkeypatch.setattr(s3_store, 'RESUMABLE_SIZE', 16)
+  monkeypatch.setattr(s3_store, 'CHUNK_SIZE', 8)
+  monkeypatch.setattr(s3_store, 'TRANSFER_CONCURRENCY', 1)
+  return s3_store
+
+
+def intercept(monkeypatch, client, operation, fail_after=None, error=None):
+  """returns the arguments of every call of operation made by client from then on, which fails
+  with error, by default a connection error, after fail_after calls."""
+  method = functools.partial(getattr(type(client), operation), client)
+  calls = []
+
+  def intercepted(**kw):
+    calls.append(kw)
+    if fail_after is not None and len(calls) > fail_after:
+      raise error or EndpointConnectionError(endpoint_url='https://s3.amazonaws.com')
+    return method(**kw)
+
+  monkeypatch.setattr(client, operation, intercepted)
+  return calls
+
+
+def client_error(code, status):
+  return ClientError(
+      {'Error': {'Code': code, 'Message': ''}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+      'UploadPart')
+
+
+def test_download_resumes(tmpdir, chunked, monkeypatch):
+  chunked.put('blob', DATA)
+  filename = str(tmpdir.join('blob'))
+  intercept(monkeypatch, chunked.connection, 'get_object', fail_after=2)
+  with pytest.raises(EndpointConnectionError):
+    chunked.download('blob', filename)
+  assert os.path.getsize(filename + '.partial') == 16
+
+  calls = intercept(monkeypatch, chunked.connection, 'get_object')
+  chunked.download('blob', filename)
+  assert [call['Range'] for call in calls] == ['bytes=16-23', 'bytes=24-31', 'bytes=32-39']
+  assert tmpdir.join('blob').read('rb') == DATA
+  assert sorted(os.listdir(str(tmpdir))) == ['blob']
+
+
+def test_download_restarts_when_blob_changes(tmpdir, chunked, emulate_conditions, monkeypatch):
+  chunked.put('blob', DATA)
+  emulate_conditions(chunked.connection)
+  changed = DATA[::-1]
+  get_object = functools.partial(type(chunked.connection).get_object, chunked.connection)
+
+  def change_after_first_chunk(**kw):
+    response = get_object(**kw)
+    if kw.get('Range') == 'bytes=0-7' and not changes:
+      changes.append(chunked.connection.put_object(Bucket=chunked.bucket, Key='blob', Body=changed))
+    return response
+
+  changes = []
+
+  monkeypatch.setattr(chunked.connection, 'get_object', change_after_first_chunk)
+  filename = str(tmpdir.join('blob'))
+  chunked.download('blob', filename)
+  assert len(changes) == 1
+  assert tmpdir.join('blob').read('rb') == changed
+  assert sorted(os.listdir(str(tmpdir))) == ['blob']
+
+
+def test_upload_resumes(tmpdir, chunked, monkeypatch):
+  tmpdir.join('blob').write(DATA, 'wb')
+  intercept(monkeypatch, chunked.connection, 'upload_part', fail_after=2)
+  with pytest.raises(EndpointConnectionError):
+    chunked.upload('blob', str(tmpdir.join('blob')))
+  assert os.path.exists(chunked._upload_state_filename('blob'))
+
+  calls = intercept(monkeypatch, chunked.connection, 'upload_part')
+  chunked.upload('blob', str(tmpdir.join('blob')))
+  assert [call['PartNumber'] for call in calls] == [3, 4, 5]
+  assert chunked.open('blob').read() == DATA
+  assert not os.path.exists(chunked._upload_state_filename('blob'))
+
+
+def test_upload_kept_for_retryable_errors(tmpdir, chunked, monkeypatch):
+  tmpdir.join('blob').write(DATA, 'wb')
+  intercept(monkeypatch, chunked.connection, 'upload_part', fail_after=1,
+            error=client_error('InternalError', 500))
+  with pytest.raises(ClientError):
+    chunked.upload('blob', str(tmpdir.join('blob')))
+  assert os.path.exists(chunked._upload_state_filename('blob'))
+  assert chunked.connection.list_multipart_uploads(Bucket=chunked.bucket).get('Uploads')
+
+
+def test_upload_aborted_for_other_errors(tmpdir, chunked, monkeypatch):
+  tmpdir.join('blob').write(DATA, 'wb')
+  intercept(monkeypatch, chunked.connection, 'upload_part', fail_after=1,
+            error=client_error('AccessDenied', 403))
+  with pytest.raises(ClientError):
+    chunked.upload('blob', str(tmpdir.join('blob')))
+  assert not os.path.exists(chunked._upload_state_filename('blob'))
+  assert not chunked.connection.list_multipart_uploads(Bucket=chunked.bucket).get('Uploads')
+
+
+def test_exists_many_without_index_heads_every_sha(s3_store, s3_calls):
+  s3_store.put('aaaa', b'a')
+  del s3_calls[:]
+  assert s3_store.exists_many(['aaaa', 'bbbb', 'cccc']) == {'aaaa'}
+  assert s3_calls.count('HeadObject') == 3
+
+
+def test_exists_many_consults_index(s3_store, s3_calls, emulate_conditions):
+  emulate_conditions(s3_store.connection)
+  for sha in ('aaaa', 'bbbb'):
+    s3_store.put(sha, sha.encode('ascii'))
+  assert s3_store.build_index() == 2
+  # markers of indexed blobs are removed.
+  assert list(s3_store._list_keys(s3_store.MARKER_PREFIX)) == []
+  s3_store.put('cccc', b'c')
+  s3_store.delete('bbbb')
+
+  del s3_calls[:]
+  assert s3_store.exists_many(['aaaa', 'bbbb', 'cccc', 'dddd', 'eeee']) == {'aaaa', 'cccc'}
+  # shas in neither the index nor the markers are known to be missing without a HEAD.
+  assert s3_calls.count('HeadObject') == 3
+
+  # the unchanged index is not read again.
+  index = s3_store._index
+  assert s3_store.exists_many(['aaaa', 'dddd']) == {'aaaa'}
+  assert s3_store._index is index
+
+
+def test_sharded_layout_keys_by_digest_prefixes(s3_store):
+  from sacker.stores.s3 import S3Store
+  assert S3Store.from_uri('s3://bucket?layout=sharded').layout == 'sharded'
+  with pytest.raises(ValueError):
+    S3Store.from_uri('s3://bucket?layout=nested')
+  s3_store.layout = 'sharded'
+  s3_store.put('abcdef', b'sha256')
+  s3_store.put('blake2b:123456', b'blake2b')
+  assert sorted(key for key in s3_store._list_keys() if not key.startswith('.sacker/')) == [
+      '12/34/blake2b:123456', 'ab/cd/abcdef']
+  assert s3_store.open('blake2b:123456').read() == b'blake2b'
+
+
+def test_sharded_reads_fall_back_to_flat_keys(tmpdir, s3_store):
+  s3_store.put('abcdef', b'legacy')
+  s3_store.layout = 'sharded'
+  assert s3_store.exists('abcdef')
+  assert s3_store.exists_many(['abcdef', 'missing']) == {'abcdef'}
+  assert s3_store.open('abcdef').read() == b'legacy'
+  assert s3_store.read_range('abcdef', 1, 3) == b'ega'
+  s3_store.download('abcdef', str(tmpdir.join('blob')))
+  assert tmpdir.join('blob').read_binary() == b'legacy'
+  assert not s3_store.exists('missing')
+
+
+def test_rekey_moves_flat_keys(s3_store, s3_calls):
+  with pytest.raises(ValueError):
+    list(s3_store.rekey())
+  for sha in ('abcdef', 'fedcba'):
+    s3_store.put(sha, sha.encode('ascii'))
+  s3_store.build_index()
+  s3_store.layout = 'sharded'
+  assert sorted(s3_store.rekey()) == ['abcdef', 'fedcba']
+  assert s3_store.connection.get_object(
+      Bucket=s3_store.bucket, Key='ab/cd/abcdef')['Body'].read() == b'abcdef'
+  # legacy keys are kept until asked to delete them, and blobs already moved are not copied again.
+  del s3_calls[:]
+  assert sorted(s3_store.rekey(delete_legacy=True)) == ['abcdef', 'fedcba']
+  assert 'CopyObject' not in s3_calls
+  assert list(s3_store.rekey()) == []
+  assert sorted(key for key in s3_store._list_keys() if not key.startswith('.sacker/')) == [
+      'ab/cd/abcdef', 'fe/dc/fedcba']
+  assert s3_store.exists_many(['abcdef', 'fedcba']) == {'abcdef', 'fedcba'}
@@ -0,0 +1,120 @@
+import threading
+from httplib import HTTPConnection
+
+import pytest
+
+from sacker.cache import LocalCache
+from sacker.hashing import hash_bytes
+from sacker.serve import BlobServer
+
+
+BLOB = b'0123456789'
+
+
+@pytest.fixture
+def server(tmpdir, store):
+  server = BlobServer(('127.0.0.1', 0), store, LocalCache(str(tmpdir.join('cache'))))
+  thread = threading.Thread(target=server.serve_forever, args=(0.01,))
+  thread.daemon = True
+  thread.start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+
+@pytest.fixture
+def sha(store):
+  sha = hash_bytes(BLOB)
+  store.put(sha, BLOB)
+  return sha
+
+
+def request(server, path, method='GET', **headers):
+  """returns (status, headers, body) of a request to server."""
+  connection = HTTPConnection(*server.server_address)
+  try:
+    connection.request(method, path, headers=headers)
+    response = connection.getresponse()
+    return response.status, dict(response.getheaders()), response.read()
+  finally:
+    connection.close()
+
+
+def test_serve_whole_blob(server, sha):
+  status, headers, body = request(server, '/' + sha)
+  assert (status, body) == (200, BLOB)
+  assert headers['accept-ranges'] == 'bytes'
+  assert server.cache.touch(sha)
+
+  status, headers, body = request(server, '/' + sha, method='HEAD')
+  assert (status, headers['content-length'], body) == (200, '10', b'')
+
+
+@pytest.mark.parametrize('header, content_range, body', [
+    ('bytes=2-4', 'bytes 2-4/10', b'234'),
+    ('bytes=7-', 'bytes 7-9/10', b'789'),
+    ('bytes=-3', 'bytes 7-9/10', b'789'),
+    ('bytes=8-20', 'bytes 8-9/10', b'89'),
+])
+def test_serve_range(server, sha, header, content_range, body):
+  status, headers, response_body = request(server, '/' + sha, Range=header)
+  assert (status, headers['content-range'], response_body) == (206, content_range, body)
+
+
+def test_serve_unsatisfiable_or_unsupported_range(server, sha):
+  status, headers, _ = request(server, '/' + sha, Range='bytes=10-')
+  assert (status, headers['content-range']) == (416, 'bytes */10')
+  # multiple ranges are answered with the whole blob.
+  assert request(server, '/' + sha, Range='bytes=0-1,4-5')[::2] == (200, BLOB)
+
+
+def test_serve_missing_or_corrupt_blob(server, store, sha):
+  assert request(server, '/' + hash_bytes(b'missing'))[0] == 404
+  assert request(server, '/not/a/blob')[0] == 404
+  corrupt = hash_bytes(b'corrupt')
+  store.put(corrupt, b'tampered')
+  assert request(server, '/' + corrupt)[0] == 502
+  assert corrupt not in server.cache
+
+
+class CountingLock(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.acquired = 0
+
+  def __enter__(self):
+    self.lock.acquire()
+    self.acquired += 1
+
+  def __exit__(self, *exc_info):
+    self.lock.release()
+
+
+def test_concurrent_misses_are_coalesced(server, store, sha, monkeypatch):
+  clients = 5
+  server._fills_lock = lock = CountingLock()
+  download = store.download
+  downloads = []
+  registered = threading.Event()
+
+  def slow_download(sha, filename):
+    downloads.append(sha)
+    # every client has registered for the fill, or become its leader, before it completes.
+    registered.wait(5)
+    download(sha, filename)
+
+  monkeypatch.setattr(store, 'download', slow_download)
+  results = []
+  threads = [threading.Thread(target=lambda: results.append(server.fill(sha)))
+             for _ in range(clients)]
+  for thread in threads:
+    thread.start()
+  for _ in range(500):
+    if lock.acquired >= clients:
+      break
+    threading.Event().wait(0.01)
+  registered.set()
+  for thread in threads:
+    thread.join()
+  assert downloads == [sha]
+  assert results == [server.cache.path(sha)] * clients
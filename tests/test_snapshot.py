@@ -0,0 +1,48 @@
+import pytest
+
+from sacker.bin.sacker import register_all
+from sacker.ledger import parse_ledger
+from sacker.snapshot import SnapshotLedger
+
+
+@pytest.fixture
+def ledgers(put_versions):
+  register_all()
+  first, second = parse_ledger('memory://first'), parse_ledger('memory://second')
+  put_versions(first, 'one', [1, 2])
+  put_versions(second, 'two', [1])
+  return first, second
+
+
+def test_fresh_snapshot_per_ledger(ledgers):
+  first, second = ledgers
+  assert SnapshotLedger.fresh(first, 3600).list_packages() == ['one']
+  # a fresh snapshot of one ledger is not served for another.
+  assert SnapshotLedger.fresh(second, 3600).list_packages() == ['two']
+  assert SnapshotLedger.fresh(first, 3600).db_path != SnapshotLedger.fresh(second, 3600).db_path
+
+
+def test_snapshot_of_another_ledger_is_stale(tmpdir, ledgers):
+  first, second = ledgers
+  db_path = str(tmpdir.join('snapshot.db'))
+  SnapshotLedger(db_path, first.uri).refresh(first)
+  assert not SnapshotLedger(db_path, first.uri).is_stale(3600)
+
+  snapshot = SnapshotLedger(db_path, second.uri)
+  assert snapshot.is_stale(3600)
+  # refreshing from another ledger drops the versions of the first, as a full refresh does.
+  assert snapshot.refresh(second) == 1
+  assert snapshot.list_packages() == ['two']
+  assert list(snapshot.list_package_versions('one')) == []
+
+
+def test_incremental_refresh(ledgers, put_versions):
+  first, _ = ledgers
+  snapshot = SnapshotLedger.default(first.uri)
+  assert snapshot.refresh(first) == 2
+  put_versions(first, 'one', [3])
+  first.tag('one', 3, 'live')
+  assert snapshot.refresh(first) == 1
+  assert snapshot.info('one', 'live').version == 3
+  with pytest.raises(snapshot.Error):
+    snapshot.tag('one', 1, 'live')
@@ -0,0 +1,70 @@
+import pytest
+
+from sacker.throttle import AdaptiveThrottle
+
+
+class Throttled(Exception): pass
+class Transient(Exception): pass
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+  monkeypatch.setattr('sacker.throttle.random.uniform', lambda low, high: 1.0)
+
+
+@pytest.fixture
+def throttle(clock):
+  return AdaptiveThrottle(
+      lambda error: isinstance(error, Throttled),
+      lambda error: isinstance(error, Transient),
+      max_attempts=4, backoff=0.1, clock=clock)
+
+
+def failing(*errors):
+  """returns a function that raises errors in turn, then returns 'ok'."""
+  errors = list(errors)
+
+  def call():
+    if errors:
+      raise errors.pop(0)
+    return 'ok'
+  return call
+
+
+def test_unlimited_until_throttled(throttle, clock):
+  for _ in range(100):
+    assert throttle.call(failing()) == 'ok'
+  assert throttle.rate is None
+  assert clock.sleeps == []
+
+
+def test_throttled_calls_back_off_and_lower_the_rate(throttle, clock):
+  for _ in range(10):
+    throttle.call(failing())
+  assert throttle.call(failing(Throttled(), Throttled())) == 'ok'
+  # the rate starts from the 11 calls sent in the last second, halved per throttled call and
+  # raised on success.
+  assert throttle.rate == 11 * 0.5 * 0.5 + 0.5
+  # retries back off exponentially, and wait for the lowered rate in between.
+  assert clock.sleeps[0:3:2] == [0.1, 0.2]
+
+  clock.sleeps = []
+  for _ in range(4):
+    throttle.call(failing())
+  # calls are spread out at the lowered rate.
+  assert clock.sleeps and sum(clock.sleeps) > 0.5
+
+
+def test_transient_errors_are_retried_without_lowering_the_rate(throttle, clock):
+  assert throttle.call(failing(Transient())) == 'ok'
+  assert throttle.rate is None
+  assert clock.sleeps == [0.1]
+
+
+def test_other_errors_and_exhausted_attempts_are_raised(throttle, clock):
+  with pytest.raises(ValueError):
+    throttle.call(failing(ValueError()))
+  assert clock.sleeps == []
+  with pytest.raises(Throttled):
+    throttle.call(failing(*[Throttled() for _ in range(4)]))
+  assert clock.sleeps[::2] == [0.1, 0.2, 0.4]
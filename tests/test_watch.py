@@ -0,0 +1,67 @@
+import pytest
+
+from sacker.watch import TagWatcher
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+  monkeypatch.setattr('sacker.watch.random.uniform', lambda low, high: 1.0)
+
+
+def on_sleeps(clock, actions):
+  """calls actions[n]() when clock has slept n times."""
+  clock.on_sleep = lambda: actions.get(len(clock.sleeps), lambda: None)()
+
+
+def collect(limit):
+  """returns (changes, callback), where callback records changes and stops after limit."""
+  changes = []
+
+  def callback(package_name, tag_name, version):
+    changes.append((package_name, tag_name, version))
+    return len(changes) < limit
+  return changes, callback
+
+
+def test_watch_backs_off_until_tag_changes(ledger, put_versions, clock):
+  put_versions(ledger, 'pkg', [1, 2])
+  ledger.tag('pkg', 1, 'live')
+  on_sleeps(clock, {5: lambda: ledger.tag('pkg', 2, 'live')})
+  changes, callback = collect(2)
+  TagWatcher(ledger, min_interval=1.0, max_interval=3.0).watch(
+      [('pkg', 'live')], callback, initial=True, clock=clock)
+  assert changes == [('pkg', 'live', 1), ('pkg', 'live', 2)]
+  # unchanged polls back off up to max_interval.
+  assert clock.sleeps == [1.0, 1.5, 2.25, 3.0, 3.0]
+
+
+def test_watch_many_tags(ledger, put_versions, clock):
+  put_versions(ledger, 'pkg', [1, 2])
+  put_versions(ledger, 'other', [1])
+  ledger.tag('pkg', 1, 'live')
+  on_sleeps(clock, {
+      2: lambda: ledger.tag('other', 1, 'live'),
+      4: lambda: ledger.tag('pkg', 2, 'live'),
+  })
+  changes, callback = collect(2)
+  # a tag that does not exist yet is reported once it is created.
+  TagWatcher(ledger, min_interval=1.0, max_interval=1.0).watch(
+      [('pkg', 'live'), ('other', 'live')], callback, clock=clock)
+  assert changes == [('other', 'live', 1), ('pkg', 'live', 2)]
+
+
+def test_s3_poll_tag_is_conditional(s3_ledger, put_versions, emulate_conditions):
+  emulate_conditions(s3_ledger.connection)
+  put_versions(s3_ledger, 'pkg', [1, 2])
+  s3_ledger.tag('pkg', 1, 'live')
+  changed, version, token = s3_ledger.poll_tag('pkg', 'live')
+  assert (changed, version) == (True, 1)
+  # an unchanged tag is not read again.
+  assert s3_ledger.poll_tag('pkg', 'live', token) == (False, None, token)
+
+  s3_ledger.tag('pkg', 2, 'live')
+  changed, version, new_token = s3_ledger.poll_tag('pkg', 'live', token)
+  assert (changed, version) == (True, 2)
+  assert new_token != token
+  with pytest.raises(s3_ledger.DoesNotExist):
+    s3_ledger.poll_tag('pkg', 'staging')